@@ -94,6 +94,14 @@ class Config(object):
     # ROIs kept after tf.nn.top_k and before non-maximum suppression
     PRE_NMS_LIMIT = 6000
 
+    # Optional. ROIs kept per level of the feature pyramid before non-maximum
+    # suppression, one value for each level in RPN_ANCHOR_SCALES. For
+    # example, [2000, 1500, 1000, 1000, 500]. Sorting each level on its own
+    # is cheaper than sorting all anchors, and keeps the many small anchors
+    # of the lower levels from being crowded out by large ones or the other
+    # way around. If None, PRE_NMS_LIMIT applies to all levels together.
+    PRE_NMS_LIMIT_PER_LEVEL = None
+
     # ROIs kept after non-maximum suppression (training and inference)
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
@@ -103,6 +111,17 @@ class Config(object):
     USE_MINI_MASK = True
     MINI_MASK_SHAPE = (56, 56)  # (height, width) of the mini-mask
 
+    # Directory in which to cache the resized images, masks, and bounding
+    # boxes produced by load_image_gt(). Saves decoding and resizing the
+    # same images every epoch. Entries are keyed by image, by
+    # Dataset.gt_version(), and by the resizing and mini-mask settings, so
+    # several configs can share a directory. gt_version() only sees changes
+    # to the image_info entry and to the image file unless the dataset
+    # overrides it. Clear the directory by hand if annotations change in
+    # some other way. Not used with the "crop" resizing mode. None disables
+    # the cache.
+    GT_CACHE_DIR = None
+
     # Input image resizing
     # Generally, use the "square" resizing mode for training and predicting
     # and it should work well in most cases. In this mode, images are scaled
@@ -174,6 +193,12 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # If True, final detections of different classes suppress each other in
+    # non-maximum suppression. Useful when the classes are hard to tell apart
+    # and one object is often detected once per class. By default NMS is done
+    # per class.
+    DETECTION_CLASS_AGNOSTIC_NMS = False
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
@@ -0,0 +1,336 @@
+"""
+Mask R-CNN
+Streaming COCO-style evaluation.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Computes the AP and AR metrics of the COCO API (pycocotools COCOeval)
+incrementally. Detections are matched to the ground truth as each image is
+added, and only the scores and match flags of the detections are kept. Raw
+masks are dropped right away, so memory stays flat over large datasets.
+This is the accumulator for dataset-wide metrics. utils.compute_ap() and
+utils.compute_ap_range() compute the AP of a single image.
+
+Usage:
+    evaluator = Evaluator(iou_type="segm")
+    evaluate_model(model, dataset, evaluator)
+    evaluator.summarize(class_names=dataset.class_names)
+"""
+
+import time
+import numpy as np
+
+from mrcnn import utils
+
+
+# Area ranges of the COCO API: (name, min area, max area) in pixels
+AREA_RANGES = [
+    ("all", 0, 1e10),
+    ("small", 0, 32 ** 2),
+    ("medium", 32 ** 2, 96 ** 2),
+    ("large", 96 ** 2, 1e10),
+]
+
+
+class Evaluator(object):
+    """Accumulates COCO-style matches image by image.
+
+    iou_type: "segm" to match masks or "bbox" to match boxes.
+    iou_thresholds: IoU thresholds. Default is 0.5 to 0.95 with increments
+        of 0.05.
+    max_dets: Maximum number of detections per image and class at which
+        metrics are reported. Sorted from low to high.
+    area_ranges: List of (name, min area, max area) tuples.
+    """
+
+    def __init__(self, iou_type="segm", iou_thresholds=None,
+                 max_dets=(1, 10, 100), area_ranges=None):
+        assert iou_type in ["segm", "bbox"]
+        self.iou_type = iou_type
+        if iou_thresholds is None:
+            iou_thresholds = np.linspace(.5, 0.95, 10)
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self.recall_thresholds = np.linspace(.0, 1.00, 101)
+        self.max_dets = list(max_dets)
+        self.area_ranges = list(area_ranges or AREA_RANGES)
+        self.image_count = 0
+        # Per class ID: lists with one item per image of
+        # scores [dets], ranks [dets] within the image, and
+        # matched, ignored [areas, thresholds, dets] flags
+        self._scores = {}
+        self._ranks = {}
+        self._matched = {}
+        self._ignored = {}
+        # Per class ID: [areas] number of GT instances that aren't ignored
+        self._gt_counts = {}
+        self.precision = None
+        self.recall = None
+        self.class_ids = None
+
+    def _overlaps(self, gt_boxes, gt_masks, pred_boxes, pred_masks, gt_crowd):
+        """Computes the [preds, gts] IoU overlaps. Like the COCO API, the
+        overlap with a crowd region is the intersection over the area of the
+        detection.
+
+        Returns:
+        overlaps: [preds, gts] IoU overlaps.
+        pred_area: [preds] Box areas of the detections. The COCO API uses
+            them for the area ranges of results that have a bbox field.
+        gt_area: [gts] Mask areas of the GT instances, or box areas if
+            there are no masks, the same as the area of COCO annotations.
+        """
+        pred_boxes = pred_boxes.astype(np.float64)
+        gt_boxes = gt_boxes.astype(np.float64)
+        pred_box_area = (pred_boxes[:, 2] - pred_boxes[:, 0]) * \
+            (pred_boxes[:, 3] - pred_boxes[:, 1])
+        gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
+        gt_mask_area = None
+        if self.iou_type == "segm":
+            intersections, pred_area, gt_area = utils.compute_mask_intersections(
+                pred_masks, gt_masks)
+            gt_mask_area = gt_area
+        else:
+            pred_area, gt_area = pred_box_area, gt_box_area
+            height = np.minimum(pred_boxes[:, None, 2], gt_boxes[None, :, 2]) - \
+                np.maximum(pred_boxes[:, None, 0], gt_boxes[None, :, 0])
+            width = np.minimum(pred_boxes[:, None, 3], gt_boxes[None, :, 3]) - \
+                np.maximum(pred_boxes[:, None, 1], gt_boxes[None, :, 1])
+            intersections = np.maximum(height, 0) * np.maximum(width, 0)
+            if gt_masks is not None:
+                gt_mask_area = np.array([np.count_nonzero(m) for m in
+                                         utils.cropped_masks(gt_masks)[1]])
+        union = pred_area[:, None] + gt_area[None, :] - intersections
+        union = np.where(gt_crowd[None, :], pred_area[:, None], union)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            overlaps = np.nan_to_num(intersections / union)
+        gt_area = gt_box_area if gt_mask_area is None else gt_mask_area
+        return overlaps, pred_box_area, gt_area
+
+    def add(self, gt_boxes, gt_class_ids, gt_masks,
+            pred_boxes, pred_class_ids, pred_scores, pred_masks=None,
+            gt_crowd=None):
+        """Matches the detections of one image to its ground truth and
+        records the result. The masks aren't kept.
+
+        gt_boxes: [N, (y1, x1, y2, x2)] GT boxes.
+        gt_class_ids: [N] GT class IDs. Negative IDs mark crowd regions of
+            the class -ID, as returned by CocoDataset.load_mask().
+        gt_masks: [height, width, N] GT masks, InstanceMasks, or
+            (boxes, cropped) tuple. Required with iou_type "segm". With
+            "bbox", optional and only used for the area of GT instances.
+        pred_boxes, pred_class_ids, pred_scores, pred_masks: The detections,
+            as returned by MaskRCNN.detect() in any mask format.
+        gt_crowd: Optional [N] boolean array that marks crowd regions.
+            Defaults to gt_class_ids < 0.
+        """
+        gt_boxes = np.asarray(gt_boxes).reshape([-1, 4])
+        pred_boxes = np.asarray(pred_boxes).reshape([-1, 4])
+        gt_class_ids = np.asarray(gt_class_ids).astype(np.int32)
+        pred_class_ids = np.asarray(pred_class_ids).astype(np.int32)
+        pred_scores = np.asarray(pred_scores)
+        if gt_crowd is None:
+            gt_crowd = gt_class_ids < 0
+        gt_crowd = np.asarray(gt_crowd, dtype=bool)
+        gt_class_ids = np.abs(gt_class_ids)
+        self.image_count += 1
+
+        overlaps, pred_area, gt_area = self._overlaps(
+            gt_boxes, gt_masks, pred_boxes, pred_masks, gt_crowd)
+
+        for class_id in np.union1d(gt_class_ids, pred_class_ids):
+            g = np.where(gt_class_ids == class_id)[0]
+            d = np.where(pred_class_ids == class_id)[0]
+            # Detections sorted by score from high to low, up to the
+            # largest max_dets
+            d = d[np.argsort(-pred_scores[d], kind="mergesort")][:self.max_dets[-1]]
+            matched, ignored, gt_counts = self._match(
+                overlaps[d][:, g], pred_area[d], gt_area[g], gt_crowd[g])
+            if class_id not in self._gt_counts:
+                self._gt_counts[class_id] = np.zeros([len(self.area_ranges)], dtype=np.int64)
+                for l in [self._scores, self._ranks, self._matched, self._ignored]:
+                    l[class_id] = []
+            self._gt_counts[class_id] += gt_counts
+            if d.shape[0]:
+                self._scores[class_id].append(pred_scores[d])
+                self._ranks[class_id].append(np.arange(d.shape[0]))
+                self._matched[class_id].append(matched)
+                self._ignored[class_id].append(ignored)
+
+    def _match(self, overlaps, pred_area, gt_area, gt_crowd):
+        """Greedy matching of the detections of one class in one image, with
+        the rules of the COCO API. All IoU thresholds are matched at once.
+
+        overlaps: [dets, gts] IoU overlaps. Detections sorted by score.
+
+        Returns:
+        matched: [areas, thresholds, dets] True for matched detections.
+        ignored: [areas, thresholds, dets] True for detections that are
+            matched to ignored GT instances or that are unmatched and
+            outside of the area range.
+        gt_counts: [areas] Number of GT instances that aren't ignored.
+        """
+        thresholds = np.minimum(self.iou_thresholds, 1 - 1e-10)
+        shape = [len(self.area_ranges), len(thresholds), overlaps.shape[0]]
+        matched = np.zeros(shape, dtype=bool)
+        ignored = np.zeros(shape, dtype=bool)
+        gt_counts = np.zeros([len(self.area_ranges)], dtype=np.int64)
+        # Detections that reach the lowest threshold with some GT instance
+        reach = np.where(np.any(overlaps >= thresholds.min(), axis=1))[0]
+        for a, (_, min_area, max_area) in enumerate(self.area_ranges):
+            gt_ignore = gt_crowd | (gt_area < min_area) | (gt_area > max_area)
+            gt_counts[a] = np.sum(~gt_ignore)
+            gt_taken = np.zeros([len(thresholds), overlaps.shape[1]], dtype=bool)
+            for i in reach:
+                # [thresholds, gts] Free GT instances above each threshold.
+                # Crowd regions can be matched any number of times.
+                free = ~(gt_taken & ~gt_crowd) & \
+                    (overlaps[i][None, :] >= thresholds[:, None])
+                # Regular instances take precedence over ignored ones. Among
+                # them, the best IoU wins, and ties go to the last one.
+                for group in [~gt_ignore, gt_ignore]:
+                    candidates = free & group & ~matched[a, :, i][:, None]
+                    t = np.where(np.any(candidates, axis=1))[0]
+                    if not t.shape[0]:
+                        continue
+                    iou = np.where(candidates[t], overlaps[i][None, :], -1)
+                    j = iou.shape[1] - 1 - np.argmax(iou[:, ::-1], axis=1)
+                    matched[a, t, i] = True
+                    ignored[a, t, i] = gt_ignore[j]
+                    gt_taken[t, j] = True
+            # Unmatched detections outside of the area range are ignored
+            outside = (pred_area < min_area) | (pred_area > max_area)
+            ignored[a] |= ~matched[a] & outside[None, :]
+        return matched, ignored, gt_counts
+
+    def accumulate(self):
+        """Computes the precision and recall tables from the matches
+        collected so far.
+
+        Sets:
+        precision: [thresholds, recall thresholds, classes, areas, max_dets]
+            interpolated precision. -1 where there are no GT instances.
+        recall: [thresholds, classes, areas, max_dets] recall. -1 where there
+            are no GT instances.
+        class_ids: [classes] Class IDs of the columns.
+        """
+        self.class_ids = np.array(sorted(self._gt_counts.keys()), dtype=np.int32)
+        T, R = len(self.iou_thresholds), len(self.recall_thresholds)
+        K, A, M = len(self.class_ids), len(self.area_ranges), len(self.max_dets)
+        self.precision = -np.ones([T, R, K, A, M])
+        self.recall = -np.ones([T, K, A, M])
+        for k, class_id in enumerate(self.class_ids):
+            if self._scores[class_id]:
+                scores = np.concatenate(self._scores[class_id])
+                ranks = np.concatenate(self._ranks[class_id])
+                matched = np.concatenate(self._matched[class_id], axis=2)
+                ignored = np.concatenate(self._ignored[class_id], axis=2)
+            else:
+                scores = ranks = np.zeros([0])
+                matched = ignored = np.zeros([A, T, 0], dtype=bool)
+            for m, max_det in enumerate(self.max_dets):
+                # Top detections of each image, sorted by score over all images
+                ix = np.where(ranks < max_det)[0]
+                ix = ix[np.argsort(-scores[ix], kind="mergesort")]
+                for a in range(A):
+                    gt_count = self._gt_counts[class_id][a]
+                    if gt_count == 0:
+                        continue
+                    tps = matched[a][:, ix] & ~ignored[a][:, ix]
+                    fps = ~matched[a][:, ix] & ~ignored[a][:, ix]
+                    tp_sum = np.cumsum(tps, axis=1).astype(np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(np.float64)
+                    for t in range(T):
+                        tp, fp = tp_sum[t], fp_sum[t]
+                        rc = tp / gt_count
+                        pr = tp / (fp + tp + np.spacing(1))
+                        self.recall[t, k, a, m] = rc[-1] if tp.shape[0] else 0
+                        # Precision envelope, sampled at the recall thresholds
+                        pr = np.maximum.accumulate(pr[::-1])[::-1]
+                        inds = np.searchsorted(rc, self.recall_thresholds, side="left")
+                        q = np.zeros([R])
+                        valid = inds < pr.shape[0]
+                        q[valid] = pr[inds[valid]]
+                        self.precision[t, :, k, a, m] = q
+
+    def _stat(self, ap=True, iou_threshold=None, area="all", max_det=100):
+        """Mean precision or recall over the classes with GT instances."""
+        a = [name for name, _, _ in self.area_ranges].index(area)
+        m = self.max_dets.index(max_det)
+        s = self.precision[..., a, m] if ap else self.recall[..., a, m]
+        if iou_threshold is not None:
+            s = s[np.isclose(self.iou_thresholds, iou_threshold)]
+        s = s[s > -1]
+        return np.mean(s) if s.size else -1
+
+    def summarize(self, class_names=None, verbose=1):
+        """Prints the standard COCO AP and AR table and, optionally, the AP
+        of each class.
+
+        class_names: Optional list of class names, indexed by class ID.
+
+        Returns: [12] array of the same metrics as COCOeval.stats.
+        """
+        if self.precision is None:
+            self.accumulate()
+        max_det = self.max_dets[-1]
+        areas = [name for name, _, _ in self.area_ranges]
+        # (AP or AR, IoU threshold, area, max detections)
+        rows = [(True, None, "all", max_det), (True, .5, "all", max_det),
+                (True, .75, "all", max_det)]
+        rows += [(True, None, name, max_det) for name in areas[1:]]
+        rows += [(False, None, "all", d) for d in self.max_dets]
+        rows += [(False, None, name, max_det) for name in areas[1:]]
+        stats = []
+        for ap, iou_threshold, area, max_det in rows:
+            value = self._stat(ap, iou_threshold, area, max_det)
+            stats.append(value)
+            if verbose:
+                iou = "{:0.2f}:{:0.2f}".format(self.iou_thresholds[0], self.iou_thresholds[-1]) \
+                    if iou_threshold is None else "{:0.2f}".format(iou_threshold)
+                print(" {:<18} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}".format(
+                    "Average Precision" if ap else "Average Recall", iou, area, max_det, value))
+        if verbose and class_names is not None:
+            for class_id, value in zip(self.class_ids, self.class_ap()):
+                print(" {:<30} AP = {:0.3f}".format(class_names[class_id], value))
+        return np.array(stats)
+
+    def class_ap(self, area="all"):
+        """Returns: [classes] AP@[.5:.95] of each class in class_ids, with
+        the largest max_dets. -1 for classes without GT instances.
+        """
+        if self.precision is None:
+            self.accumulate()
+        a = [name for name, _, _ in self.area_ranges].index(area)
+        aps = []
+        for k in range(len(self.class_ids)):
+            s = self.precision[:, :, k, a, -1]
+            s = s[s > -1]
+            aps.append(np.mean(s) if s.size else -1)
+        return np.array(aps)
+
+
+def evaluate_model(model, dataset, evaluator, image_ids=None, verbose=1):
+    """Runs detection on the images of a dataset in full batches with
+    MaskRCNN.detect_many() and adds the results to an evaluator as they
+    are produced.
+
+    model: MaskRCNN model in inference mode.
+    dataset: A Dataset object. Ground truth comes from load_mask() at the
+        original image resolution.
+    evaluator: An Evaluator.
+    image_ids: Optional list of image IDs. Defaults to all images.
+    """
+    image_ids = dataset.image_ids if image_ids is None else image_ids
+    t_start = time.time()
+    images = (dataset.load_image(image_id) for image_id in image_ids)
+    results = model.detect_many(images, verbose=0, mask_format="cropped")
+    for image_id, r in zip(image_ids, results):
+        gt_masks, gt_class_ids = dataset.load_mask(image_id)
+        gt_boxes = utils.extract_bboxes(gt_masks)
+        evaluator.add(gt_boxes, gt_class_ids, gt_masks,
+                      r["rois"], r["class_ids"], r["scores"], r["masks"])
+    if verbose:
+        t_total = time.time() - t_start
+        print("Total time: {}. Average {}/image".format(
+            t_total, t_total / max(len(image_ids), 1)))
+    return evaluator
@@ -10,11 +10,15 @@ Written by Waleed Abdulla
 import os
 import random
 import datetime
+import hashlib
 import re
 import math
 import logging
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import multiprocessing
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 import keras
@@ -212,43 +216,45 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, (y1, x1, y2, x2)] boxes to update
-    deltas: [N, (dy, dx, log(dh), log(dw))] refinements to apply
+    boxes: [..., (y1, x1, y2, x2)] boxes to update, such as [N, 4] or
+        [batch, N, 4]
+    deltas: [..., (dy, dx, log(dh), log(dw))] refinements to apply
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
 def clip_boxes_graph(boxes, window):
     """
-    boxes: [N, (y1, x1, y2, x2)]
-    window: [4] in the form y1, x1, y2, x2
+    boxes: [..., (y1, x1, y2, x2)], such as [N, 4] or [batch, N, 4]
+    window: [..., 4] in the form y1, x1, y2, x2. Either [4] for all boxes,
+        or a window per batch item, such as [batch, 1, 4].
     """
     # Split
-    wy1, wx1, wy2, wx2 = tf.split(window, 4)
-    y1, x1, y2, x2 = tf.split(boxes, 4, axis=1)
+    wy1, wx1, wy2, wx2 = tf.split(window, 4, axis=-1)
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=-1)
     # Clip
     y1 = tf.maximum(tf.minimum(y1, wy2), wy1)
     x1 = tf.maximum(tf.minimum(x1, wx2), wx1)
     y2 = tf.maximum(tf.minimum(y2, wy2), wy1)
     x2 = tf.maximum(tf.minimum(x2, wx2), wx1)
-    clipped = tf.concat([y1, x1, y2, x2], axis=1, name="clipped_boxes")
-    clipped.set_shape((clipped.shape[0], 4))
+    clipped = tf.concat([y1, x1, y2, x2], axis=-1, name="clipped_boxes")
+    clipped.set_shape(boxes.shape[:-1].concatenate([4]))
     return clipped
 
 
@@ -262,6 +268,9 @@ class ProposalLayer(KE.Layer):
         rpn_probs: [batch, num_anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, num_anchors, (dy, dx, log(dh), log(dw))]
         anchors: [batch, num_anchors, (y1, x1, y2, x2)] anchors in normalized coordinates
+        level_probs: Only with config.PRE_NMS_LIMIT_PER_LEVEL. The rpn_probs
+            of each pyramid level, which give the number of anchors per
+            level. Anchors are ordered by level.
 
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
@@ -274,7 +283,7 @@ class ProposalLayer(KE.Layer):
         self.nms_threshold = nms_threshold
 
     def call(self, inputs):
-        # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
+        # Box Scores. Use the foreground class confidence. [Batch, num_rois]
         scores = inputs[0][:, :, 1]
         # Box deltas [batch, num_rois, 4]
         deltas = inputs[1]
@@ -284,48 +293,52 @@ class ProposalLayer(KE.Layer):
 
         # Improve performance by trimming to top anchors by score
         # and doing the rest on the smaller subset.
-        pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(anchors)[1])
-        ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
-                         name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        if self.config.PRE_NMS_LIMIT_PER_LEVEL:
+            # Take the top anchors of each pyramid level separately
+            level_limits = self.config.PRE_NMS_LIMIT_PER_LEVEL
+            level_probs = inputs[3:]
+            assert len(level_limits) == len(level_probs), \
+                "PRE_NMS_LIMIT_PER_LEVEL needs one value per pyramid level"
+            ix = []
+            start = 0
+            for limit, probs in zip(level_limits, level_probs):
+                size = tf.shape(probs)[1]
+                level_ix = tf.nn.top_k(scores[:, start:start + size],
+                                       tf.minimum(limit, size), sorted=True,
+                                       name="top_anchors_per_level").indices
+                ix.append(level_ix + start)
+                start += size
+            ix = tf.concat(ix, axis=1)
+        else:
+            pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(anchors)[1])
+            ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
+                             name="top_anchors").indices
+        # All ops below work on the whole batch at once, so the graph
+        # doesn't grow with IMAGES_PER_GPU.
+        scores = batch_gather_graph(scores, ix)
+        deltas = batch_gather_graph(deltas, ix)
+        pre_nms_anchors = tf.identity(batch_gather_graph(anchors, ix),
+                                      name="pre_nms_anchors")
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        boxes = tf.identity(apply_box_deltas_graph(pre_nms_anchors, deltas),
+                            name="refined_anchors")
 
         # Clip to image boundaries. Since we're in normalized coordinates,
         # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
         window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = tf.identity(clip_boxes_graph(boxes, window),
+                            name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
         # for small objects, so we're skipping it.
 
-        # Non-max suppression
-        def nms(boxes, scores):
-            indices = tf.image.non_max_suppression(
-                boxes, scores, self.proposal_count,
-                self.nms_threshold, name="rpn_non_max_suppression")
-            proposals = tf.gather(boxes, indices)
-            # Pad if needed
-            padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
-            proposals = tf.pad(proposals, [(0, padding), (0, 0)])
-            return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        # Non-max suppression. Pads with zeros if needed.
+        proposals = batch_non_max_suppression_graph(
+            boxes, scores, self.proposal_count, self.nms_threshold,
+            name="rpn_non_max_suppression")
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -392,21 +405,23 @@ class PyramidROIAlign(KE.Layer):
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
         roi_level = tf.squeeze(roi_level, 2)
 
+        # Split the boxes of all images by level. Box IDs are the positions
+        # of the boxes in the flattened [batch * num_boxes] list.
+        num_boxes = tf.shape(boxes)[1]
+        roi_level = tf.reshape(roi_level, [-1]) - 2
+        box_ids = tf.range(tf.shape(roi_level)[0])
+        level_boxes = tf.dynamic_partition(
+            tf.reshape(boxes, [-1, 4]), roi_level, 4)
+        level_box_ids = tf.dynamic_partition(box_ids, roi_level, 4)
+
         # Loop through levels and apply ROI pooling to each. P2 to P5.
         pooled = []
-        box_to_level = []
-        for i, level in enumerate(range(2, 6)):
-            ix = tf.where(tf.equal(roi_level, level))
-            level_boxes = tf.gather_nd(boxes, ix)
-
+        for i in range(4):
             # Box indices for crop_and_resize.
-            box_indices = tf.cast(ix[:, 0], tf.int32)
-
-            # Keep track of which box is mapped to which level
-            box_to_level.append(ix)
+            box_indices = level_box_ids[i] // num_boxes
 
             # Stop gradient propogation to ROI proposals
-            level_boxes = tf.stop_gradient(level_boxes)
+            boxes_i = tf.stop_gradient(level_boxes[i])
             box_indices = tf.stop_gradient(box_indices)
 
             # Crop and Resize
@@ -417,29 +432,14 @@ class PyramidROIAlign(KE.Layer):
             #
             # Here we use the simplified approach of a single value per bin,
             # which is how it's done in tf.crop_and_resize()
-            # Result: [batch * num_boxes, pool_height, pool_width, channels]
+            # Result: [level_boxes, pool_height, pool_width, channels]
             pooled.append(tf.image.crop_and_resize(
-                feature_maps[i], level_boxes, box_indices, self.pool_shape,
+                feature_maps[i], boxes_i, box_indices, self.pool_shape,
                 method="bilinear"))
 
-        # Pack pooled features into one tensor
-        pooled = tf.concat(pooled, axis=0)
-
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
+        # Write the pooled features of each box to its position in the
+        # original order. [batch * num_boxes, pool_height, pool_width, channels]
+        pooled = tf.dynamic_stitch(level_box_ids, pooled)
 
         # Re-add the batch dimension
         shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
@@ -456,166 +456,206 @@ class PyramidROIAlign(KE.Layer):
 
 def overlaps_graph(boxes1, boxes2):
     """Computes IoU overlaps between two sets of boxes.
-    boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    boxes1: [..., N, (y1, x1, y2, x2)].
+    boxes2: [..., M, (y1, x1, y2, x2)]. Leading dimensions, such as the
+        batch, must be the same as those of boxes1.
+
+    Returns: [..., N, M] overlaps.
     """
-    # 1. Tile boxes2 and repeat boxes1. This allows us to compare
+    # 1. Broadcast boxes1 against boxes2. This allows us to compare
     # every boxes1 against every boxes2 without loops.
-    # TF doesn't have an equivalent to np.repeat() so simulate it
-    # using tf.tile() and tf.reshape.
-    b1 = tf.reshape(tf.tile(tf.expand_dims(boxes1, 1),
-                            [1, 1, tf.shape(boxes2)[0]]), [-1, 4])
-    b2 = tf.tile(boxes2, [tf.shape(boxes1)[0], 1])
+    b1 = tf.expand_dims(boxes1, -2)
+    b2 = tf.expand_dims(boxes2, -3)
     # 2. Compute intersections
-    b1_y1, b1_x1, b1_y2, b1_x2 = tf.split(b1, 4, axis=1)
-    b2_y1, b2_x1, b2_y2, b2_x2 = tf.split(b2, 4, axis=1)
-    y1 = tf.maximum(b1_y1, b2_y1)
-    x1 = tf.maximum(b1_x1, b2_x1)
-    y2 = tf.minimum(b1_y2, b2_y2)
-    x2 = tf.minimum(b1_x2, b2_x2)
+    y1 = tf.maximum(b1[..., 0], b2[..., 0])
+    x1 = tf.maximum(b1[..., 1], b2[..., 1])
+    y2 = tf.minimum(b1[..., 2], b2[..., 2])
+    x2 = tf.minimum(b1[..., 3], b2[..., 3])
     intersection = tf.maximum(x2 - x1, 0) * tf.maximum(y2 - y1, 0)
     # 3. Compute unions
-    b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
-    b2_area = (b2_y2 - b2_y1) * (b2_x2 - b2_x1)
+    b1_area = (b1[..., 2] - b1[..., 0]) * (b1[..., 3] - b1[..., 1])
+    b2_area = (b2[..., 2] - b2[..., 0]) * (b2[..., 3] - b2[..., 1])
     union = b1_area + b2_area - intersection
-    # 4. Compute IoU and reshape to [boxes1, boxes2]
-    iou = intersection / union
-    overlaps = tf.reshape(iou, [tf.shape(boxes1)[0], tf.shape(boxes2)[0]])
+    # 4. Compute IoU. [..., boxes1, boxes2]
+    overlaps = intersection / union
     return overlaps
 
 
 def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config):
-    """Generates detection targets for one image. Subsamples proposals and
-    generates target class IDs, bounding box deltas, and masks for each.
+    """Generates detection targets for all images of a batch at once.
+    Subsamples proposals and generates target class IDs, bounding box deltas,
+    and masks for each. Zero padding is masked out rather than trimmed, so
+    the graph doesn't grow with the batch size.
 
     Inputs:
-    proposals: [POST_NMS_ROIS_TRAINING, (y1, x1, y2, x2)] in normalized coordinates. Might
-               be zero padded if there are not enough proposals.
-    gt_class_ids: [MAX_GT_INSTANCES] int class IDs
-    gt_boxes: [MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized coordinates.
-    gt_masks: [height, width, MAX_GT_INSTANCES] of boolean type.
+    proposals: [batch, POST_NMS_ROIS_TRAINING, (y1, x1, y2, x2)] in normalized
+               coordinates. Might be zero padded if there are not enough
+               proposals.
+    gt_class_ids: [batch, MAX_GT_INSTANCES] int class IDs
+    gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized
+              coordinates.
+    gt_masks: [batch, height, width, MAX_GT_INSTANCES] of boolean type.
 
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
     and masks.
-    rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized coordinates
-    class_ids: [TRAIN_ROIS_PER_IMAGE]. Integer class IDs. Zero padded.
-    deltas: [TRAIN_ROIS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
-    masks: [TRAIN_ROIS_PER_IMAGE, height, width]. Masks cropped to bbox
+    rois: [batch, TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized
+          coordinates
+    class_ids: [batch, TRAIN_ROIS_PER_IMAGE]. Integer class IDs. Zero padded.
+    deltas: [batch, TRAIN_ROIS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
+    masks: [batch, TRAIN_ROIS_PER_IMAGE, height, width]. Masks cropped to bbox
            boundaries and resized to neural network output size.
 
     Note: Returned arrays might be zero padded if not enough target ROIs.
     """
     # Assertions
     asserts = [
-        tf.Assert(tf.greater(tf.shape(proposals)[0], 0), [proposals],
+        tf.Assert(tf.greater(tf.shape(proposals)[1], 0), [proposals],
                   name="roi_assertion"),
     ]
     with tf.control_dependencies(asserts):
         proposals = tf.identity(proposals)
-
-    # Remove zero padding
-    proposals, _ = trim_zeros_graph(proposals, name="trim_proposals")
-    gt_boxes, non_zeros = trim_zeros_graph(gt_boxes, name="trim_gt_boxes")
-    gt_class_ids = tf.boolean_mask(gt_class_ids, non_zeros,
-                                   name="trim_gt_class_ids")
-    gt_masks = tf.gather(gt_masks, tf.where(non_zeros)[:, 0], axis=2,
-                         name="trim_gt_masks")
+    batch_size = tf.shape(proposals)[0]
+    rois_per_image = config.TRAIN_ROIS_PER_IMAGE
+
+    def gt_where(mask, overlaps, value):
+        """Keeps the overlaps with GT boxes in mask and sets the rest to value."""
+        mask = tf.tile(tf.expand_dims(mask, 1), [1, tf.shape(overlaps)[1], 1])
+        return tf.where(mask, overlaps, tf.fill(tf.shape(overlaps), value))
+
+    def box_where(mask, boxes, other):
+        """Picks boxes where mask is True and other boxes elsewhere."""
+        return tf.where(tf.tile(tf.expand_dims(mask, 2), [1, 1, 4]), boxes, other)
+
+    # Zero padding. Masks of the non-zero proposals and GT boxes.
+    valid_proposals = tf.reduce_sum(tf.abs(proposals), axis=2) > 0
+    valid_gt = tf.reduce_sum(tf.abs(gt_boxes), axis=2) > 0
+    # Drop the GT padding after the last GT box of all images, so the
+    # work below depends on the number of GT boxes rather than on
+    # MAX_GT_INSTANCES.
+    gt_count = tf.maximum(tf.reduce_max(
+        tf.cast(valid_gt, tf.int32) * tf.range(1, tf.shape(valid_gt)[1] + 1)), 1)
+    valid_gt = valid_gt[:, :gt_count]
+    gt_class_ids = gt_class_ids[:, :gt_count]
+    gt_boxes = gt_boxes[:, :gt_count]
+    gt_masks = gt_masks[:, :, :, :gt_count]
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
-    crowd_ix = tf.where(gt_class_ids < 0)[:, 0]
-    non_crowd_ix = tf.where(gt_class_ids > 0)[:, 0]
-    crowd_boxes = tf.gather(gt_boxes, crowd_ix)
-    crowd_masks = tf.gather(gt_masks, crowd_ix, axis=2)
-    gt_class_ids = tf.gather(gt_class_ids, non_crowd_ix)
-    gt_boxes = tf.gather(gt_boxes, non_crowd_ix)
-    gt_masks = tf.gather(gt_masks, non_crowd_ix, axis=2)
-
-    # Compute overlaps matrix [proposals, gt_boxes]
+    crowd_bool = tf.logical_and(valid_gt, gt_class_ids < 0)
+    non_crowd_bool = tf.logical_and(valid_gt, gt_class_ids > 0)
+
+    # Compute overlaps matrix [batch, proposals, gt_boxes]
     overlaps = overlaps_graph(proposals, gt_boxes)
 
-    # Compute overlaps with crowd boxes [proposals, crowd_boxes]
-    crowd_overlaps = overlaps_graph(proposals, crowd_boxes)
-    crowd_iou_max = tf.reduce_max(crowd_overlaps, axis=1)
+    # Compute overlaps with crowd boxes. Other GT boxes count as no overlap.
+    crowd_iou_max = tf.reduce_max(gt_where(crowd_bool, overlaps, 0.), axis=2)
     no_crowd_bool = (crowd_iou_max < 0.001)
 
-    # Determine positive and negative ROIs
-    roi_iou_max = tf.reduce_max(overlaps, axis=1)
+    # Determine positive and negative ROIs. Ignore crowds and padding.
+    overlaps = gt_where(non_crowd_bool, overlaps, -1.)
+    roi_iou_max = tf.reduce_max(overlaps, axis=2)
     # 1. Positive ROIs are those with >= 0.5 IoU with a GT box
-    positive_roi_bool = (roi_iou_max >= 0.5)
-    positive_indices = tf.where(positive_roi_bool)[:, 0]
+    positive_roi_bool = tf.logical_and(valid_proposals, roi_iou_max >= 0.5)
     # 2. Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
-    negative_indices = tf.where(tf.logical_and(roi_iou_max < 0.5, no_crowd_bool))[:, 0]
+    negative_roi_bool = tf.logical_and(
+        valid_proposals, tf.logical_and(roi_iou_max < 0.5, no_crowd_bool))
+
+    def shuffle(candidates, count):
+        """Returns the indices of up to count candidates of each image in
+        random order, followed by other indices. Candidates get random keys
+        and the rest -1, and are sorted by key."""
+        keys = tf.where(candidates, tf.random_uniform(tf.shape(candidates)),
+                        -tf.ones(tf.shape(candidates)))
+        return tf.nn.top_k(keys, tf.minimum(count, tf.shape(keys)[1])).indices
+
+    def count(candidates):
+        return tf.reduce_sum(tf.cast(candidates, tf.int32), axis=1)
 
     # Subsample ROIs. Aim for 33% positive
     # Positive ROIs
-    positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
-                         config.ROI_POSITIVE_RATIO)
-    positive_indices = tf.random_shuffle(positive_indices)[:positive_count]
-    positive_count = tf.shape(positive_indices)[0]
+    positive_max = int(config.TRAIN_ROIS_PER_IMAGE *
+                       config.ROI_POSITIVE_RATIO)
+    positive_indices = shuffle(positive_roi_bool, positive_max)
+    positive_count = tf.minimum(count(positive_roi_bool), positive_max)
     # Negative ROIs. Add enough to maintain positive:negative ratio.
     r = 1.0 / config.ROI_POSITIVE_RATIO
     negative_count = tf.cast(r * tf.cast(positive_count, tf.float32), tf.int32) - positive_count
-    negative_indices = tf.random_shuffle(negative_indices)[:negative_count]
-    # Gather selected ROIs
-    positive_rois = tf.gather(proposals, positive_indices)
-    negative_rois = tf.gather(proposals, negative_indices)
+    negative_count = tf.minimum(negative_count, count(negative_roi_bool))
+    negative_indices = shuffle(negative_roi_bool, rois_per_image)
+
+    # Lay out the ROIs of each image: positive ROIs, negative ROIs, and
+    # then zero padding. [batch, TRAIN_ROIS_PER_IMAGE]
+    slots = tf.tile(tf.expand_dims(tf.range(rois_per_image), 0), [batch_size, 1])
+    positive_count = tf.expand_dims(positive_count, 1)
+    negative_count = tf.expand_dims(negative_count, 1)
+    positive_slot_bool = slots < positive_count
+    roi_slot_bool = slots < positive_count + negative_count
+    positive_ix = batch_gather_graph(positive_indices, tf.minimum(
+        slots, tf.shape(positive_indices)[1] - 1))
+    negative_ix = batch_gather_graph(negative_indices, tf.clip_by_value(
+        slots - positive_count, 0, tf.shape(negative_indices)[1] - 1))
+    roi_ix = tf.where(positive_slot_bool, positive_ix, negative_ix)
+    rois = box_where(roi_slot_bool, batch_gather_graph(proposals, roi_ix),
+                     tf.zeros([batch_size, rois_per_image, 4]))
 
     # Assign positive ROIs to GT boxes.
-    positive_overlaps = tf.gather(overlaps, positive_indices)
-    roi_gt_box_assignment = tf.cond(
-        tf.greater(tf.shape(positive_overlaps)[1], 0),
-        true_fn = lambda: tf.argmax(positive_overlaps, axis=1),
-        false_fn = lambda: tf.cast(tf.constant([]),tf.int64)
-    )
-    roi_gt_boxes = tf.gather(gt_boxes, roi_gt_box_assignment)
-    roi_gt_class_ids = tf.gather(gt_class_ids, roi_gt_box_assignment)
-
-    # Compute bbox refinement for positive ROIs
+    roi_gt_box_assignment = tf.argmax(batch_gather_graph(overlaps, roi_ix),
+                                      axis=2, output_type=tf.int32)
+    roi_gt_boxes = batch_gather_graph(gt_boxes, roi_gt_box_assignment)
+    roi_gt_class_ids = tf.where(
+        positive_slot_bool,
+        batch_gather_graph(gt_class_ids, roi_gt_box_assignment),
+        tf.zeros_like(roi_gt_box_assignment, dtype=gt_class_ids.dtype))
+
+    # Compute bbox refinement for positive ROIs. Other slots get a unit box
+    # in place of both boxes, which gives zero deltas without dividing by
+    # zero.
+    unit_boxes = tf.ones([batch_size, rois_per_image, 4]) * [0., 0., 1., 1.]
+    positive_rois = box_where(positive_slot_bool, rois, unit_boxes)
+    roi_gt_boxes = box_where(positive_slot_bool, roi_gt_boxes, unit_boxes)
     deltas = utils.box_refinement_graph(positive_rois, roi_gt_boxes)
     deltas /= config.BBOX_STD_DEV
 
-    # Assign positive ROIs to GT masks
-    # Permute masks to [N, height, width, 1]
-    transposed_masks = tf.expand_dims(tf.transpose(gt_masks, [2, 0, 1]), -1)
-    # Pick the right mask for each ROI
-    roi_masks = tf.gather(transposed_masks, roi_gt_box_assignment)
-
-    # Compute mask targets
+    # Compute mask targets. Positive ROIs take the first positive_max slots
+    # of each image.
+    positive_rois = positive_rois[:, :positive_max]
+    roi_gt_boxes = roi_gt_boxes[:, :positive_max]
+    # Pick the right mask for each ROI. Permute masks to
+    # [batch, instances, height, width] first.
+    roi_masks = batch_gather_graph(tf.transpose(gt_masks, [0, 3, 1, 2]),
+                                   roi_gt_box_assignment[:, :positive_max])
+    mask_shape = tf.shape(roi_masks)
+    roi_masks = tf.reshape(roi_masks, [-1, mask_shape[2], mask_shape[3], 1])
     boxes = positive_rois
     if config.USE_MINI_MASK:
         # Transform ROI coordinates from normalized image space
         # to normalized mini-mask space.
-        y1, x1, y2, x2 = tf.split(positive_rois, 4, axis=1)
-        gt_y1, gt_x1, gt_y2, gt_x2 = tf.split(roi_gt_boxes, 4, axis=1)
+        y1, x1, y2, x2 = tf.split(positive_rois, 4, axis=2)
+        gt_y1, gt_x1, gt_y2, gt_x2 = tf.split(roi_gt_boxes, 4, axis=2)
         gt_h = gt_y2 - gt_y1
         gt_w = gt_x2 - gt_x1
         y1 = (y1 - gt_y1) / gt_h
         x1 = (x1 - gt_x1) / gt_w
         y2 = (y2 - gt_y1) / gt_h
         x2 = (x2 - gt_x1) / gt_w
-        boxes = tf.concat([y1, x1, y2, x2], 1)
+        boxes = tf.concat([y1, x1, y2, x2], 2)
+    boxes = tf.reshape(boxes, [-1, 4])
     box_ids = tf.range(0, tf.shape(roi_masks)[0])
     masks = tf.image.crop_and_resize(tf.cast(roi_masks, tf.float32), boxes,
                                      box_ids,
                                      config.MASK_SHAPE)
-    # Remove the extra dimension from masks.
-    masks = tf.squeeze(masks, axis=3)
+    # Remove the extra dimension from masks and re-add the batch dimension.
+    masks = tf.reshape(masks, [batch_size, positive_max] + list(config.MASK_SHAPE))
 
     # Threshold mask pixels at 0.5 to have GT masks be 0 or 1 to use with
     # binary cross entropy loss.
     masks = tf.round(masks)
 
-    # Append negative ROIs and pad bbox deltas and masks that
-    # are not used for negative ROIs with zeros.
-    rois = tf.concat([positive_rois, negative_rois], axis=0)
-    N = tf.shape(negative_rois)[0]
-    P = tf.maximum(config.TRAIN_ROIS_PER_IMAGE - tf.shape(rois)[0], 0)
-    rois = tf.pad(rois, [(0, P), (0, 0)])
-    roi_gt_boxes = tf.pad(roi_gt_boxes, [(0, N + P), (0, 0)])
-    roi_gt_class_ids = tf.pad(roi_gt_class_ids, [(0, N + P)])
-    deltas = tf.pad(deltas, [(0, N + P), (0, 0)])
-    masks = tf.pad(masks, [[0, N + P], (0, 0), (0, 0)])
+    # Zero the masks of slots that aren't positive ROIs, and pad to
+    # TRAIN_ROIS_PER_IMAGE.
+    masks *= tf.cast(positive_slot_bool[:, :positive_max], tf.float32)[:, :, None, None]
+    masks = tf.pad(masks, [(0, 0), (0, rois_per_image - positive_max), (0, 0), (0, 0)])
 
     return rois, roi_gt_class_ids, deltas, masks
 
@@ -655,15 +695,12 @@ class DetectionTargetLayer(KE.Layer):
         gt_boxes = inputs[2]
         gt_masks = inputs[3]
 
-        # Slice the batch and run a graph for each slice
+        # Run the target graph on all images of the batch at once
         # TODO: Rename target_bbox to target_deltas for clarity
         names = ["rois", "target_class_ids", "target_bbox", "target_mask"]
-        outputs = utils.batch_slice(
-            [proposals, gt_class_ids, gt_boxes, gt_masks],
-            lambda w, x, y, z: detection_targets_graph(
-                w, x, y, z, self.config),
-            self.config.IMAGES_PER_GPU, names=names)
-        return outputs
+        outputs = detection_targets_graph(
+            proposals, gt_class_ids, gt_boxes, gt_masks, self.config)
+        return [tf.identity(o, name=n) for o, n in zip(outputs, names)]
 
     def compute_output_shape(self, input_shape):
         return [
@@ -684,99 +721,74 @@ class DetectionTargetLayer(KE.Layer):
 
 def refine_detections_graph(rois, probs, deltas, window, config):
     """Refine classified proposals and filter overlaps and return final
-    detections.
+    detections. Works on all images of a batch at once.
 
     Inputs:
-        rois: [N, (y1, x1, y2, x2)] in normalized coordinates
-        probs: [N, num_classes]. Class probabilities.
-        deltas: [N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
+        rois: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+        probs: [batch, N, num_classes]. Class probabilities.
+        deltas: [batch, N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
                 bounding box deltas.
-        window: (y1, x1, y2, x2) in normalized coordinates. The part of the image
-            that contains the image excluding the padding.
+        window: [batch, (y1, x1, y2, x2)] in normalized coordinates. The part
+            of each image that contains the image excluding the padding.
 
-    Returns detections shaped: [num_detections, (y1, x1, y2, x2, class_id, score)] where
-        coordinates are normalized.
+    Returns detections shaped:
+        [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
+        where coordinates are normalized. Padded with zeros.
     """
+    batch_size = tf.shape(probs)[0]
+    num_rois = tf.shape(probs)[1]
     # Class IDs per ROI
-    class_ids = tf.argmax(probs, axis=1, output_type=tf.int32)
+    class_ids = tf.argmax(probs, axis=2, output_type=tf.int32)
     # Class probability of the top class of each ROI
-    indices = tf.stack([tf.range(probs.shape[0]), class_ids], axis=1)
-    class_scores = tf.gather_nd(probs, indices)
+    class_scores = tf.reduce_max(probs, axis=2)
     # Class-specific bounding box deltas
-    deltas_specific = tf.gather_nd(deltas, indices)
+    deltas_specific = batch_gather_graph(
+        tf.reshape(deltas, [batch_size * num_rois, -1, 4]),
+        tf.reshape(class_ids, [-1, 1]))
+    deltas_specific = tf.reshape(deltas_specific, [batch_size, num_rois, 4])
     # Apply bounding box deltas
-    # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
+    # Shape: [batch, boxes, (y1, x1, y2, x2)] in normalized coordinates
     refined_rois = apply_box_deltas_graph(
         rois, deltas_specific * config.BBOX_STD_DEV)
-    # Clip boxes to image window
-    refined_rois = clip_boxes_graph(refined_rois, window)
+    # Clip boxes to the window of each image
+    refined_rois = clip_boxes_graph(refined_rois, tf.expand_dims(window, 1))
 
     # TODO: Filter out boxes with zero area
 
     # Filter out background boxes
-    keep = tf.where(class_ids > 0)[:, 0]
+    keep = class_ids > 0
     # Filter out low confidence boxes
     if config.DETECTION_MIN_CONFIDENCE:
-        conf_keep = tf.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[:, 0]
-        keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                        tf.expand_dims(conf_keep, 0))
-        keep = tf.sparse_tensor_to_dense(keep)[0]
-
-    # Apply per-class NMS
-    # 1. Prepare variables
-    pre_nms_class_ids = tf.gather(class_ids, keep)
-    pre_nms_scores = tf.gather(class_scores, keep)
-    pre_nms_rois = tf.gather(refined_rois,   keep)
-    unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
-
-    def nms_keep_map(class_id):
-        """Apply Non-Maximum Suppression on ROIs of the given class."""
-        # Indices of ROIs of the given class
-        ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
-        # Apply NMS
-        class_keep = tf.image.non_max_suppression(
-                tf.gather(pre_nms_rois, ixs),
-                tf.gather(pre_nms_scores, ixs),
-                max_output_size=config.DETECTION_MAX_INSTANCES,
-                iou_threshold=config.DETECTION_NMS_THRESHOLD)
-        # Map indices
-        class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
-        # Pad with -1 so returned tensors have the same shape
-        gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
-        class_keep = tf.pad(class_keep, [(0, gap)],
-                            mode='CONSTANT', constant_values=-1)
-        # Set shape so map_fn() can infer result shape
-        class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
-        return class_keep
-
-    # 2. Map over class IDs
-    nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
-                         dtype=tf.int64)
-    # 3. Merge results into one list, and remove -1 padding
-    nms_keep = tf.reshape(nms_keep, [-1])
-    nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
-    # 4. Compute intersection between keep and nms_keep
-    keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                    tf.expand_dims(nms_keep, 0))
-    keep = tf.sparse_tensor_to_dense(keep)[0]
-    # Keep top detections
-    roi_count = config.DETECTION_MAX_INSTANCES
-    class_scores_keep = tf.gather(class_scores, keep)
-    num_keep = tf.minimum(tf.shape(class_scores_keep)[0], roi_count)
-    top_ids = tf.nn.top_k(class_scores_keep, k=num_keep, sorted=True)[1]
-    keep = tf.gather(keep, top_ids)
-
-    # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
+        keep = tf.logical_and(
+            keep, class_scores >= config.DETECTION_MIN_CONFIDENCE)
+
+    # Apply per-class NMS as one NMS per image. The boxes of each class are
+    # shifted by their class ID, so boxes of different classes never
+    # overlap. Clipped boxes are in the 0..1 range.
+    if config.DETECTION_CLASS_AGNOSTIC_NMS:
+        nms_rois = refined_rois
+    else:
+        nms_rois = refined_rois + tf.expand_dims(tf.to_float(class_ids), 2)
+    # Filtered boxes get a negative score. They come after all other boxes,
+    # so they can't suppress them, and are removed below.
+    nms_scores = tf.where(keep, class_scores, -tf.ones_like(class_scores))
+    nms_keep = batch_non_max_suppression_indices_graph(
+        nms_rois, nms_scores, config.DETECTION_MAX_INSTANCES,
+        config.DETECTION_NMS_THRESHOLD)
+    # Kept boxes are sorted by score. Remove -1 padding and filtered boxes.
+    ix = tf.maximum(nms_keep, 0)
+    valid = tf.logical_and(nms_keep > -1, batch_gather_graph(keep, ix))
+
+    # Arrange output as [batch, N, (y1, x1, y2, x2, class_id, score)]
     # Coordinates are normalized.
     detections = tf.concat([
-        tf.gather(refined_rois, keep),
-        tf.to_float(tf.gather(class_ids, keep))[..., tf.newaxis],
-        tf.gather(class_scores, keep)[..., tf.newaxis]
-        ], axis=1)
-
-    # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-    gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
-    detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
+        batch_gather_graph(refined_rois, ix),
+        tf.to_float(batch_gather_graph(class_ids, ix))[..., tf.newaxis],
+        batch_gather_graph(class_scores, ix)[..., tf.newaxis]
+        ], axis=2)
+
+    # Zero out padding, which only follows the detections
+    detections *= tf.to_float(valid)[..., tf.newaxis]
     return detections
 
 
@@ -807,11 +819,9 @@ class DetectionLayer(KE.Layer):
         image_shape = m['image_shape'][0]
         window = norm_boxes_graph(m['window'], image_shape[:2])
 
-        # Run detection refinement graph on each item in the batch
-        detections_batch = utils.batch_slice(
-            [rois, mrcnn_class, mrcnn_bbox, window],
-            lambda x, y, w, z: refine_detections_graph(x, y, w, z, self.config),
-            self.config.IMAGES_PER_GPU)
+        # Run detection refinement graph on all items of the batch
+        detections_batch = refine_detections_graph(
+            rois, mrcnn_class, mrcnn_bbox, window, self.config)
 
         # Reshape output
         # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in
@@ -1184,6 +1194,85 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 #  Data Generator
 ############################################################
 
+def gt_cache_path(dataset, config, image_id):
+    """Returns the path of the ground truth cache file of an image, or None
+    if config.GT_CACHE_DIR is not set or the cache can't be used with the
+    current config.
+
+    The file name is derived from the image source and id, from
+    dataset.gt_version(), and from the config values that affect the cached
+    data, so changing any of them results in a new cache entry rather than
+    stale data.
+    """
+    if not config.GT_CACHE_DIR or config.IMAGE_RESIZE_MODE == "crop":
+        return None
+    info = dataset.image_info[image_id]
+    key = repr((info["source"], info["id"], dataset.gt_version(image_id),
+                config.IMAGE_RESIZE_MODE, config.IMAGE_MIN_DIM,
+                config.IMAGE_MAX_DIM, config.IMAGE_MIN_SCALE,
+                tuple(config.MINI_MASK_SHAPE)))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(config.GT_CACHE_DIR,
+                        "{}_{}.npz".format(info["source"], digest))
+
+
+def save_gt_cache(path, image, mask, class_ids, window, scale,
+                  original_shape, config):
+    """Writes the resized image and masks of an image to the GT cache.
+
+    Along with the data needed to run augmentation, it stores the filtered
+    class IDs, bounding boxes, and mini-masks of the un-augmented image, so
+    that load_image_gt() can skip all mask processing when no augmentation
+    is used. Masks are stored bit-packed.
+
+    Returns the keep flags, bounding boxes, and mini-masks it stored, for
+    use on a cache miss.
+    """
+    keep = np.sum(mask, axis=(0, 1)) > 0
+    bbox = utils.extract_bboxes_batched(mask[:, :, keep])
+    mini_mask = utils.minimize_mask_batched(bbox, mask[:, :, keep],
+                                    config.MINI_MASK_SHAPE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file and rename it so that concurrent data
+    # loader workers never read a partially written file.
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, image=image,
+                 mask=np.packbits(mask.astype(np.bool), axis=-1),
+                 mask_shape=np.array(mask.shape),
+                 class_ids=class_ids, window=np.array(window),
+                 scale=np.array(scale), original_shape=np.array(original_shape),
+                 keep=keep, bbox=bbox,
+                 mini_mask=np.packbits(mini_mask, axis=-1),
+                 mini_mask_shape=np.array(mini_mask.shape))
+    os.replace(tmp_path, path)
+    return keep, bbox, mini_mask
+
+
+def load_gt_cache(path):
+    """Reads an entry written by save_gt_cache().
+
+    Returns a dict with the stored arrays, with the masks unpacked back to
+    bool arrays, or None if the entry doesn't exist or can't be read.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            entry = {k: data[k] for k in data.files}
+    except Exception:
+        logging.warning("Ignoring unreadable GT cache entry {}".format(path))
+        return None
+    for name in ["mask", "mini_mask"]:
+        shape = tuple(entry.pop(name + "_shape"))
+        entry[name] = np.unpackbits(entry[name], axis=-1)[..., :shape[-1]] \
+            .astype(np.bool).reshape(shape)
+    entry["window"] = tuple(entry["window"])
+    entry["scale"] = float(entry["scale"])
+    entry["original_shape"] = tuple(entry["original_shape"])
+    return entry
+
+
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
                   use_mini_mask=False):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
@@ -1208,17 +1297,48 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
-    image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
-    original_shape = image.shape
-    image, window, scale, padding, crop = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        min_scale=config.IMAGE_MIN_SCALE,
-        max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    # Active classes
+    # Different datasets have different classes, so track the
+    # classes supported in the dataset of this image.
+    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
+    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
+    active_class_ids[source_class_ids] = 1
+
+    # Load image and mask, from the GT cache if one is configured
+    cache_path = gt_cache_path(dataset, config, image_id)
+    cached = load_gt_cache(cache_path) if cache_path else None
+    # Keep flags, bounding boxes, and mini-masks of the cache entry
+    final = None
+    if cached is not None:
+        image = cached["image"]
+        mask = cached["mask"]
+        class_ids = cached["class_ids"]
+        window = cached["window"]
+        scale = cached["scale"]
+        original_shape = cached["original_shape"]
+        final = cached["keep"], cached["bbox"], cached["mini_mask"]
+    else:
+        image = dataset.load_image(image_id)
+        mask, class_ids = dataset.load_mask(image_id)
+        original_shape = image.shape
+        image, window, scale, padding, crop = utils.resize_image(
+            image,
+            min_dim=config.IMAGE_MIN_DIM,
+            min_scale=config.IMAGE_MIN_SCALE,
+            max_dim=config.IMAGE_MAX_DIM,
+            mode=config.IMAGE_RESIZE_MODE)
+        mask = utils.resize_mask(mask, scale, padding, crop)
+        if cache_path:
+            final = save_gt_cache(cache_path, image, mask, class_ids, window,
+                                  scale, original_shape, config)
+
+    # Without augmentation, the cache entry holds the final outputs
+    if final is not None and not augment and not augmentation:
+        keep, bbox, mini_mask = final
+        mask = mini_mask if use_mini_mask else mask[:, :, keep]
+        image_meta = compose_image_meta(image_id, original_shape, image.shape,
+                                        window, scale, active_class_ids)
+        return image, image_meta, class_ids[keep], bbox, mask
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
@@ -1267,18 +1387,11 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     # Bounding boxes. Note that some boxes might be all zeros
     # if the corresponding mask got cropped out.
     # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
-
-    # Active classes
-    # Different datasets have different classes, so track the
-    # classes supported in the dataset of this image.
-    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
-    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
-    active_class_ids[source_class_ids] = 1
+    bbox = utils.extract_bboxes_batched(mask)
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        mask = utils.minimize_mask_batched(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
@@ -1325,18 +1438,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
     # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1443,13 +1546,17 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_index=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional. A utils.AnchorIndex of the anchors. If given, IoU
+        is only computed between GT boxes and the anchors near them, rather
+        than between all anchors and all GT boxes. The results are the same.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
@@ -1472,16 +1579,18 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
         # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        if anchor_index is not None:
+            crowd_iou_max = np.zeros([anchors.shape[0]])
+            a_ix, _, crowd_overlaps = anchor_index.overlaps(crowd_boxes)
+            np.maximum.at(crowd_iou_max, a_ix, crowd_overlaps)
+        else:
+            crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+            crowd_iou_max = np.amax(crowd_overlaps, axis=1)
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
-
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
     # If an anchor overlaps a GT box with IoU < 0.3 then it's negative.
@@ -1489,15 +1598,21 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # and they don't influence the loss function.
     # However, don't keep any GT box unmatched (rare, but happens). Instead,
     # match it to the closest anchor (even if its max IoU is < 0.3).
-    #
+    if anchor_index is not None:
+        anchor_iou_argmax, anchor_iou_max, gt_iou_argmax = \
+            _match_sparse_overlaps(anchor_index, anchors.shape[0], gt_boxes)
+    else:
+        # Compute overlaps [num_anchors, num_gt_boxes]
+        overlaps = utils.compute_overlaps(anchors, gt_boxes)
+        anchor_iou_argmax = np.argmax(overlaps, axis=1)
+        anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+        gt_iou_argmax = np.argmax(overlaps, axis=0)
+
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
@@ -1520,40 +1635,49 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes (closest GT box, which might have
+    # IoU < 0.7), and normalize.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    rpn_bbox[:ids.shape[0]] = utils.box_refinement(
+        anchors[ids], gt_boxes[anchor_iou_argmax[ids]])
+    rpn_bbox[:ids.shape[0]] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
 
+def _match_sparse_overlaps(anchor_index, num_anchors, gt_boxes):
+    """Finds the best matches between anchors and GT boxes from the sparse
+    overlaps of an AnchorIndex. Reproduces np.argmax() over the dense
+    overlaps matrix, including its tie breaking: the lowest index wins, and
+    a row or column of zeros gives index 0.
+
+    Returns:
+    anchor_iou_argmax: [num_anchors] Index of the best GT box of each anchor.
+    anchor_iou_max: [num_anchors] IoU with that GT box.
+    gt_iou_argmax: [num_gt_boxes] Index of the best anchor of each GT box.
+    """
+    a_ix, gt_ix, overlaps = anchor_index.overlaps(gt_boxes)
+
+    # Best GT box per anchor: sort by anchor, then by descending IoU, then
+    # by GT index, and take the first entry of each anchor.
+    anchor_iou_argmax = np.zeros([num_anchors], dtype=np.int64)
+    anchor_iou_max = np.zeros([num_anchors])
+    order = np.lexsort((gt_ix, -overlaps, a_ix))
+    first = order[np.unique(a_ix[order], return_index=True)[1]]
+    best = first[overlaps[first] > 0]
+    anchor_iou_argmax[a_ix[best]] = gt_ix[best]
+    anchor_iou_max[a_ix[best]] = overlaps[best]
+
+    # Best anchor per GT box, the same way
+    gt_iou_argmax = np.zeros([gt_boxes.shape[0]], dtype=np.int64)
+    order = np.lexsort((a_ix, -overlaps, gt_ix))
+    first = order[np.unique(gt_ix[order], return_index=True)[1]]
+    best = first[overlaps[first] > 0]
+    gt_iou_argmax[gt_ix[best]] = a_ix[best]
+
+    return anchor_iou_argmax, anchor_iou_max, gt_iou_argmax
+
+
 def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     """Generates ROI proposals similar to what a region proposal network
     would generate.
@@ -1675,16 +1799,13 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     image_index = -1
     image_ids = np.copy(dataset.image_ids)
     error_count = 0
-    no_augmentation_sources = no_augmentation_sources or []
-
-    # Anchors
-    # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    # Loads the images and builds their targets. It doesn't shuffle, the
+    # order of the images is picked here.
+    generator = DataGenerator(dataset, config, shuffle=False, augment=augment,
+                              augmentation=augmentation, random_rois=random_rois,
+                              batch_size=batch_size,
+                              detection_targets=detection_targets,
+                              no_augmentation_sources=no_augmentation_sources)
 
     # Keras requires a generator to run indefinitely.
     while True:
@@ -1696,110 +1817,23 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
-
-            # If the image source is not to be augmented pass None as augmentation
-            if dataset.image_info[image_id]['source'] in no_augmentation_sources:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=None,
-                              use_mini_mask=config.USE_MINI_MASK)
-            else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                    load_image_gt(dataset, config, image_id, augment=augment,
-                                augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
+            item = generator.load_item(image_id)
 
             # Skip images that have no instances. This can happen in cases
             # where we train on a subset of classes and the image doesn't
             # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
+            if item is None:
                 continue
 
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
-
-            # Mask R-CNN Targets
-            if random_rois:
-                rpn_rois = generate_random_rois(
-                    image.shape, random_rois, gt_class_ids, gt_boxes)
-                if detection_targets:
-                    rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
-                        build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
-
-            # Init batch arrays
-            if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_gt_masks = np.zeros(
-                    (batch_size, gt_masks.shape[0], gt_masks.shape[1],
-                     config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
-                if random_rois:
-                    batch_rpn_rois = np.zeros(
-                        (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
-                    if detection_targets:
-                        batch_rois = np.zeros(
-                            (batch_size,) + rois.shape, dtype=rois.dtype)
-                        batch_mrcnn_class_ids = np.zeros(
-                            (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
-                        batch_mrcnn_bbox = np.zeros(
-                            (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
-                        batch_mrcnn_mask = np.zeros(
-                            (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
-
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-
             # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
-            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
-            if random_rois:
-                batch_rpn_rois[b] = rpn_rois
-                if detection_targets:
-                    batch_rois[b] = rois
-                    batch_mrcnn_class_ids[b] = mrcnn_class_ids
-                    batch_mrcnn_bbox[b] = mrcnn_bbox
-                    batch_mrcnn_mask[b] = mrcnn_mask
+            if b == 0:
+                batch = generator.allocate_batch()
+            generator.add_to_batch(batch, b, item)
             b += 1
 
             # Batch full?
             if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
-                outputs = []
-
-                if random_rois:
-                    inputs.extend([batch_rpn_rois])
-                    if detection_targets:
-                        inputs.extend([batch_rois])
-                        # Keras requires that output and targets have the same number of dimensions
-                        batch_mrcnn_class_ids = np.expand_dims(
-                            batch_mrcnn_class_ids, -1)
-                        outputs.extend(
-                            [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
-
-                yield inputs, outputs
+                yield generator.pack_batch(batch)
 
                 # start a new batch
                 b = 0
@@ -1814,6 +1848,208 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+class DataGenerator(keras.utils.Sequence):
+    """A Keras Sequence that returns batches of images and corresponding
+    target class ids, bounding box deltas, and masks. Batches are addressed
+    by index, so Keras can hand distinct batches to each worker process and
+    prefetch them in parallel, rather than every worker replaying a copy of
+    the same generator.
+
+    The arguments are the same as those of data_generator().
+
+    __getitem__() returns two lists, inputs and outputs, with the content
+    described in data_generator(). Unlike data_generator(), every batch is
+    full: slots of images without instances or with errors are filled with
+    random images of the dataset, and so is the end of the last batch of an
+    epoch.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augment=False,
+                 augmentation=None, random_rois=0, batch_size=1,
+                 detection_targets=False, no_augmentation_sources=None):
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augment = augment
+        self.augmentation = augmentation
+        self.random_rois = random_rois
+        self.batch_size = batch_size
+        self.detection_targets = detection_targets
+        self.no_augmentation_sources = no_augmentation_sources or []
+        self.image_ids = np.copy(dataset.image_ids)
+        if shuffle:
+            np.random.shuffle(self.image_ids)
+        # Images that failed to load, over the life of the generator
+        self.error_count = 0
+
+        # Anchors
+        # [anchor_count, (y1, x1, y2, x2)]
+        backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
+        self.anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                      config.RPN_ANCHOR_RATIOS,
+                                                      backbone_shapes,
+                                                      config.BACKBONE_STRIDES,
+                                                      config.RPN_ANCHOR_STRIDE)
+        self.anchor_index = utils.AnchorIndex(self.anchors)
+        # Process that last seeded the random generators. See __getitem__()
+        self._seeded_pid = os.getpid()
+
+    def __len__(self):
+        return int(np.ceil(len(self.image_ids) / float(self.batch_size)))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.image_ids)
+
+    def load_item(self, image_id):
+        """Loads an image with its ground truth and builds its training
+        targets.
+
+        Returns a list of the arrays that add_to_batch() expects, or None if
+        the image has no instances.
+        """
+        config = self.config
+        # If the image source is not to be augmented pass None as augmentation
+        augmentation = self.augmentation
+        if self.dataset.image_info[image_id]['source'] in self.no_augmentation_sources:
+            augmentation = None
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            load_image_gt(self.dataset, config, image_id,
+                          augment=self.augment,
+                          augmentation=augmentation,
+                          use_mini_mask=config.USE_MINI_MASK)
+        if not np.any(gt_class_ids > 0):
+            return None
+
+        # RPN Targets
+        rpn_match, rpn_bbox = build_rpn_targets(
+            image.shape, self.anchors, gt_class_ids, gt_boxes, config,
+            anchor_index=self.anchor_index)
+
+        # Mask R-CNN Targets
+        rpn_rois = rois = mrcnn_class_ids = mrcnn_bbox = mrcnn_mask = None
+        if self.random_rois:
+            rpn_rois = generate_random_rois(
+                image.shape, self.random_rois, gt_class_ids, gt_boxes)
+            if self.detection_targets:
+                rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
+                    build_detection_targets(
+                        rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
+
+        # If more instances than fits in the array, sub-sample from them.
+        if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+            ids = np.random.choice(
+                np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+            gt_class_ids = gt_class_ids[ids]
+            gt_boxes = gt_boxes[ids]
+            gt_masks = gt_masks[:, :, ids]
+
+        return [image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes,
+                gt_masks, rpn_rois, rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask]
+
+    def allocate_batch(self):
+        """Allocates the arrays of a batch, in the order of pack_batch()."""
+        config = self.config
+        batch_size = self.batch_size
+        mask_shape = tuple(config.MINI_MASK_SHAPE) if config.USE_MINI_MASK \
+            else tuple(config.IMAGE_SHAPE[:2])
+        batch = [
+            np.zeros((batch_size,) + tuple(config.IMAGE_SHAPE), dtype=np.float32),
+            np.zeros((batch_size, config.IMAGE_META_SIZE), dtype=np.float64),
+            np.zeros([batch_size, self.anchors.shape[0], 1], dtype=np.int32),
+            np.zeros([batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=np.float64),
+            np.zeros((batch_size, config.MAX_GT_INSTANCES), dtype=np.int32),
+            np.zeros((batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32),
+            np.zeros((batch_size,) + mask_shape + (config.MAX_GT_INSTANCES,), dtype=bool),
+        ]
+        if self.random_rois:
+            batch.append(np.zeros((batch_size, self.random_rois, 4), dtype=np.int32))
+            if self.detection_targets:
+                batch.extend([
+                    np.zeros((batch_size, config.TRAIN_ROIS_PER_IMAGE, 4), dtype=np.int32),
+                    np.zeros((batch_size, config.TRAIN_ROIS_PER_IMAGE), dtype=np.int32),
+                    np.zeros((batch_size, config.TRAIN_ROIS_PER_IMAGE,
+                              config.NUM_CLASSES, 4), dtype=np.float32),
+                    np.zeros((batch_size, config.TRAIN_ROIS_PER_IMAGE) +
+                             tuple(config.MASK_SHAPE) + (config.NUM_CLASSES,),
+                             dtype=np.float32),
+                ])
+        return batch
+
+    def add_to_batch(self, batch, b, item):
+        """Copies an item of load_item() to slot b of the batch arrays."""
+        image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, \
+            gt_masks, rpn_rois, rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask = item
+        batch[0][b] = mold_image(image, self.config)
+        batch[1][b] = image_meta
+        batch[2][b] = rpn_match[:, np.newaxis]
+        batch[3][b] = rpn_bbox
+        batch[4][b, :gt_class_ids.shape[0]] = gt_class_ids
+        batch[5][b, :gt_boxes.shape[0]] = gt_boxes
+        batch[6][b, :, :, :gt_masks.shape[-1]] = gt_masks
+        if self.random_rois:
+            batch[7][b] = rpn_rois
+            if self.detection_targets:
+                batch[8][b] = rois
+                batch[9][b] = mrcnn_class_ids
+                batch[10][b] = mrcnn_bbox
+                batch[11][b] = mrcnn_mask
+
+    def pack_batch(self, batch):
+        """Returns the inputs and outputs lists of a filled batch."""
+        inputs = batch[:7]
+        outputs = []
+
+        if self.random_rois:
+            inputs.extend([batch[7]])
+            if self.detection_targets:
+                inputs.extend([batch[8]])
+                # Keras requires that output and targets have the same number of dimensions
+                batch_mrcnn_class_ids = np.expand_dims(batch[9], -1)
+                outputs.extend([batch_mrcnn_class_ids, batch[10], batch[11]])
+
+        return inputs, outputs
+
+    def __getitem__(self, idx):
+        batch_size = self.batch_size
+
+        # Worker processes are forked with a copy of the random state of
+        # the parent. Re-seed once per process so that workers don't apply
+        # the same augmentations.
+        if self._seeded_pid != os.getpid():
+            self._seeded_pid = os.getpid()
+            np.random.seed()
+            if self.augmentation:
+                import imgaug
+                imgaug.seed(np.random.randint(0, 2**31 - 1))
+
+        # Allocate the batch arrays up front and fill them in place
+        batch = self.allocate_batch()
+        for b in range(batch_size):
+            # The last batch of an epoch is filled up from the start
+            image_id = self.image_ids[(idx * batch_size + b) % len(self.image_ids)]
+            while True:
+                try:
+                    item = self.load_item(image_id)
+                    # Images without instances can't be used for training,
+                    # so fill this slot with a random image instead.
+                    if item is not None:
+                        break
+                except (GeneratorExit, KeyboardInterrupt):
+                    raise
+                except:
+                    # Log it and use a random image instead
+                    logging.exception("Error processing image {}".format(
+                        self.dataset.image_info[image_id]))
+                    self.error_count += 1
+                    if self.error_count > 5:
+                        raise
+                image_id = np.random.choice(self.image_ids)
+            self.add_to_batch(batch, b, item)
+
+        return self.pack_batch(batch)
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1886,9 +2122,6 @@ class MaskRCNN():
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
-            # Anchors in normalized coordinates
-            input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
         # Build the shared convolutional layers.
         # Bottom-up Layers
@@ -1926,15 +2159,14 @@ class MaskRCNN():
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
         # Anchors
-        if mode == "training":
-            anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
-            # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
-        else:
-            anchors = input_anchors
+        # Generated in the graph from the sizes of the feature maps, so any
+        # image size works. Duplicated across the batch dimension because
+        # the proposal layer slices them by image.
+        anchors = KL.Lambda(
+            lambda x: tf.tile(
+                generate_pyramid_anchors_graph(x[1:], tf.shape(x[0])[1:3], config)[None],
+                [tf.shape(x[0])[0], 1, 1]),
+            name="anchors")([input_image] + rpn_feature_maps)
 
         # RPN Model
         rpn = build_rpn_model(config.RPN_ANCHOR_STRIDE,
@@ -1959,11 +2191,15 @@ class MaskRCNN():
         # and zero padded.
         proposal_count = config.POST_NMS_ROIS_TRAINING if mode == "training"\
             else config.POST_NMS_ROIS_INFERENCE
+        proposal_inputs = [rpn_class, rpn_bbox, anchors]
+        if config.PRE_NMS_LIMIT_PER_LEVEL:
+            # The RPN probabilities of each level give the level sizes
+            proposal_inputs += [o[1] for o in layer_outputs]
         rpn_rois = ProposalLayer(
             proposal_count=proposal_count,
             nms_threshold=config.RPN_NMS_THRESHOLD,
             name="ROI",
-            config=config)([rpn_class, rpn_bbox, anchors])
+            config=config)(proposal_inputs)
 
         if mode == "training":
             # Class ID mask to mark class IDs supported by the dataset the image
@@ -2052,7 +2288,7 @@ class MaskRCNN():
                                               config.NUM_CLASSES,
                                               train_bn=config.TRAIN_BN)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            model = KM.Model([input_image, input_image_meta],
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
@@ -2327,12 +2563,12 @@ class MaskRCNN():
             layers = layer_regex[layers]
 
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        train_generator = DataGenerator(train_dataset, self.config, shuffle=True,
+                                        augmentation=augmentation,
+                                        batch_size=self.config.BATCH_SIZE,
+                                        no_augmentation_sources=no_augmentation_sources)
+        val_generator = DataGenerator(val_dataset, self.config, shuffle=True,
+                                      batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -2418,7 +2654,7 @@ class MaskRCNN():
         return molded_images, image_metas, windows
 
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, mask_format="dense"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -2429,13 +2665,21 @@ class MaskRCNN():
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        mask_format: How to return the masks. One of:
+            dense: [height, width, num_instances] array.
+            cropped: utils.InstanceMasks holding masks in the frame of
+                their bounding boxes.
+            rle: utils.InstanceMasks holding RLE runs. See mrcnn.rle.
+            The compact formats never allocate full image sized masks.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: Instance masks in the requested format.
         """
+        assert mask_format in ["dense", "cropped", "rle"], \
+            "Unknown mask format {}".format(mask_format)
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
         zero_ix = np.where(detections[:, 4] == 0)[0]
@@ -2471,27 +2715,32 @@ class MaskRCNN():
             masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
-        # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        # Resize masks to the size of their boxes and set boundary threshold.
+        if mask_format == "dense":
+            full_masks = utils.unmold_masks(masks, boxes, original_image_shape)
+        else:
+            full_masks = utils.InstanceMasks(
+                original_image_shape, boxes=boxes,
+                cropped=utils.unmold_masks_cropped(masks, boxes))
+            if mask_format == "rle":
+                full_masks = utils.InstanceMasks(original_image_shape,
+                                                 runs=full_masks.rle())
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, mask_format="dense"):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
+        mask_format: "dense", "cropped" or "rle". With "cropped" and "rle",
+            masks are returned in a utils.InstanceMasks container, which
+            doesn't allocate full image sized masks. See unmold_detections().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or an InstanceMasks container
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2512,47 +2761,56 @@ class MaskRCNN():
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        # Run object detection
+        detections, mrcnn_mask = self._predict_molded(
+            molded_images, image_metas, verbose=verbose)
+        # Process detections
+        results = []
+        for i, image in enumerate(images):
+            results.append(self._result(self.unmold_detections(
+                detections[i], mrcnn_mask[i], image.shape,
+                molded_images[i].shape, windows[i], mask_format=mask_format)))
+        return results
+
+    def _predict_molded(self, molded_images, image_metas, verbose=0):
+        """Runs the model on a batch of molded images of the same size.
+        Anchors are generated in the graph.
 
+        Returns the detections and mrcnn_mask outputs of the model.
+        """
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
         # Run object detection
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
-        # Process detections
-        results = []
-        for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       windows[i])
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
-        return results
+            self.keras_model.predict([molded_images, image_metas], verbose=0)
+        return detections, mrcnn_mask
+
+    def _result(self, unmolded):
+        """Packs the outputs of unmold_detections() in a result dict."""
+        final_rois, final_class_ids, final_scores, final_masks = unmolded
+        return {
+            "rois": final_rois,
+            "class_ids": final_class_ids,
+            "scores": final_scores,
+            "masks": final_masks,
+        }
 
-    def detect_molded(self, molded_images, image_metas, verbose=0):
+    def detect_molded(self, molded_images, image_metas, verbose=0,
+                      mask_format="dense"):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
         molded_images: List of images loaded using load_image_gt()
         image_metas: image meta data, also returned by load_image_gt()
+        mask_format: "dense", "cropped" or "rle". See detect().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or an InstanceMasks container
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
@@ -2569,35 +2827,366 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
-        if verbose:
-            log("molded_images", molded_images)
-            log("image_metas", image_metas)
-            log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self._predict_molded(
+            molded_images, image_metas, verbose=verbose)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
             window = [0, 0, image.shape[0], image.shape[1]]
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       window)
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
+            results.append(self._result(self.unmold_detections(
+                detections[i], mrcnn_mask[i], image.shape,
+                molded_images[i].shape, window, mask_format=mask_format)))
         return results
 
+    def _batches(self, items):
+        """Groups an iterator of (key, image) pairs into lists of up to
+        BATCH_SIZE pairs. All images of a batch must have the same size
+        after resizing. In "square" and "crop" modes every image is molded
+        to the same size, so images of any size share a batch. In the other
+        modes the molded size follows the image size, and a list is cut
+        short when the image shape changes. Pairs are read from the
+        iterator one batch at a time.
+        """
+        fixed_size = self.config.IMAGE_RESIZE_MODE in ["square", "crop"]
+
+        def batch_key(image):
+            # The number of channels has to match in any mode
+            return image.shape[2:] if fixed_size else image.shape
+
+        batch = []
+        for key, image in items:
+            if batch and batch_key(image) != batch_key(batch[0][1]):
+                yield batch
+                batch = []
+            batch.append((key, image))
+            if len(batch) == self.config.BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _fill_batch(self, batch):
+        """Fills a partial batch with blank images of the same shape."""
+        return batch + [np.zeros_like(batch[-1])] * (self.config.BATCH_SIZE - len(batch))
+
+    def _keyed(self, images, keyed):
+        """Returns an iterator of (key, image) pairs. Images without keys
+        get None keys."""
+        return iter(images) if keyed else ((None, image) for image in images)
+
+    def detect_many(self, images, verbose=0, mask_format="dense", keyed=False):
+        """Runs the detection pipeline on any number of images. Images are
+        grouped into full batches of BATCH_SIZE, and a partial batch is
+        filled with blank images whose results are dropped.
+
+        images: List or iterator of images. Images are read from an iterator
+            one batch at a time, so they can be loaded lazily. In "square"
+            and "crop" resizing modes, images of any size share a batch. In
+            the other modes, a batch is cut short when the image shape
+            changes, because all images of a batch must have the same size
+            after resizing. Use detect_bucketed() for mixed sizes there.
+        mask_format: "dense", "cropped" or "rle". See detect().
+        keyed: If True, images holds (key, image) pairs, and (key, result)
+            pairs are yielded. The key can be anything that identifies the
+            input, such as an image ID or the image itself.
+
+        Yields one dict per image, in the order of the inputs, with the same
+        content as the dicts of detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        for batch in self._batches(self._keyed(images, keyed)):
+            # Results of the blank images are dropped
+            results = self.detect(self._fill_batch([image for _, image in batch]),
+                                  verbose=verbose, mask_format=mask_format)
+            for (key, _), r in zip(batch, results):
+                yield (key, r) if keyed else r
+
+    def detect_bucketed(self, images, max_pending=None, verbose=0,
+                        mask_format="dense"):
+        """Runs the detection pipeline on images of mixed sizes with little
+        padding. Each image is molded as it arrives and put in a bucket of
+        images with the same molded shape. A bucket runs as soon as it holds
+        BATCH_SIZE images. Use it with the "pad64" resizing mode, where
+        molded shapes follow the image shapes, rather than "square" mode,
+        which pads every image to IMAGE_MAX_DIM x IMAGE_MAX_DIM.
+
+        images: List or iterator of images.
+        max_pending: Maximum number of images held at once, either waiting
+            in a bucket or finished but waiting for an earlier image so the
+            results come out in order. When it's reached, the bucket of the
+            oldest waiting image runs as a partial batch. Defaults to
+            4 * BATCH_SIZE.
+        mask_format: "dense", "cropped" or "rle". See detect().
+
+        Yields one dict per image, in the order of the inputs, with the same
+        content as the dicts of detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        batch_size = self.config.BATCH_SIZE
+        if max_pending is None:
+            max_pending = 4 * batch_size
+        assert max_pending >= batch_size, "max_pending must be >= BATCH_SIZE"
+        # Molded shape -> list of (input index, image shape, molded image,
+        # image meta, window), in input order
+        buckets = OrderedDict()
+        # Input index -> result, for results that wait for earlier ones
+        results = {}
+
+        def run(shape):
+            items = buckets.pop(shape)
+            # Fill a partial batch with blank images of the same shape
+            fill = batch_size - len(items)
+            molded_images = np.stack([m for _, _, m, _, _ in items] +
+                                     [np.zeros_like(items[0][2])] * fill)
+            image_metas = np.stack([m for _, _, _, m, _ in items] + [items[0][3]] * fill)
+            detections, mrcnn_mask = self._predict_molded(
+                molded_images, image_metas, verbose=verbose)
+            for i, (index, image_shape, molded_image, _, window) in enumerate(items):
+                results[index] = self._result(self.unmold_detections(
+                    detections[i], mrcnn_mask[i], image_shape,
+                    molded_image.shape, window, mask_format=mask_format))
+
+        def oldest():
+            # Bucket holding the earliest input that hasn't run yet
+            return min(buckets, key=lambda shape: buckets[shape][0][0])
+
+        next_index = 0
+        for index, image in enumerate(images):
+            molded_images, image_metas, windows = self.mold_inputs([image])
+            shape = molded_images[0].shape
+            buckets.setdefault(shape, []).append(
+                (index, image.shape, molded_images[0], image_metas[0], windows[0]))
+            if len(buckets[shape]) == batch_size:
+                run(shape)
+            while buckets and \
+                    sum(len(b) for b in buckets.values()) + len(results) > max_pending:
+                run(oldest())
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+        while buckets:
+            run(oldest())
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+
+    def detect_pipelined(self, images, mold_workers=2, unmold_workers=2,
+                         queue_size=2, verbose=0, mask_format="dense",
+                         keyed=False):
+        """Runs the detection pipeline on any number of images like
+        detect_many(), but overlaps the three stages of detect(). A reader
+        thread pulls batches from the input and hands them to a pool of
+        threads that mold them. The calling thread runs the model on molded
+        batches as they come in, and another pool of threads unmolds the
+        results. The stages are decoupled by bounded queues, so images
+        stream through at the rate of the slowest stage.
+
+        images: List or iterator of images. An iterator is only read from
+            the reader thread.
+        mold_workers: Number of threads that mold batches of images.
+        unmold_workers: Number of threads that unmold the detections.
+        queue_size: Number of batches that can wait between stages. Bounds
+            the number of images held in memory.
+        mask_format: "dense", "cropped" or "rle". See detect().
+        keyed: If True, images holds (key, image) pairs, and (key, result)
+            pairs are yielded. See detect_many().
+
+        Yields one dict per image, in the order of the inputs, with the same
+        content as the dicts of detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        molded = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        mold_pool = ThreadPoolExecutor(max_workers=mold_workers)
+        unmold_pool = ThreadPoolExecutor(max_workers=unmold_workers)
+
+        def put(item):
+            # Wait for space in the queue, unless the consumer has stopped
+            while not stop.is_set():
+                try:
+                    molded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for batch in self._batches(self._keyed(images, keyed)):
+                    future = mold_pool.submit(
+                        self.mold_inputs, self._fill_batch([image for _, image in batch]))
+                    if not put((batch, future)):
+                        return
+                put((None, None))
+            except Exception as e:
+                put((None, e))
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        # (key, unmolding result) pairs, in input order
+        pending = deque()
+        max_pending = queue_size * self.config.BATCH_SIZE
+
+        def result(item):
+            key, future = item
+            r = self._result(future.result())
+            return (key, r) if keyed else r
+
+        try:
+            while True:
+                batch, future = molded.get()
+                if batch is None:
+                    if future is not None:
+                        raise future
+                    break
+                molded_images, image_metas, windows = future.result()
+                if verbose:
+                    log("Processing {} images".format(len(batch)))
+                detections, mrcnn_mask = self._predict_molded(
+                    molded_images, image_metas, verbose=verbose)
+                # Results of the blank images are dropped
+                for i, (key, image) in enumerate(batch):
+                    pending.append((key, unmold_pool.submit(
+                        self.unmold_detections, detections[i], mrcnn_mask[i],
+                        image.shape, molded_images[i].shape, windows[i],
+                        mask_format)))
+                # Yield finished results. Wait for the oldest ones if too
+                # many are in flight.
+                while pending and (pending[0][1].done() or len(pending) > max_pending):
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+        finally:
+            stop.set()
+            mold_pool.shutdown(wait=False)
+            unmold_pool.shutdown(wait=False)
+
+    def detect_tiled(self, image, tile_size, overlap, iou_threshold=0.5,
+                     verbose=0, mask_format="dense"):
+        """Runs the detection pipeline on an image that is too large to
+        process in one pass, such as a whole wafer overview. The image is
+        split into overlapping tiles, the tiles are detected in batches of
+        BATCH_SIZE with detect_many(), and the detections are merged across
+        tile seams.
+
+        image: [H, W, C] image.
+        tile_size: Side length of the square tiles in pixels.
+        overlap: Number of pixels shared by neighbouring tiles. Should be
+            larger than the typical object size.
+        iou_threshold: Detections of the same class from different tiles
+            with a mask IoU above this value are merged into one instance.
+            See utils.merge_tile_detections().
+        mask_format: "dense", "cropped" or "rle". See detect().
+
+        Returns a dict with the same content as the dicts of detect():
+        rois: [N, (y1, x1, y2, x2)] detection bounding boxes
+        class_ids: [N] int class IDs
+        scores: [N] float probability scores for the class IDs
+        masks: [H, W, N] instance binary masks, or an InstanceMasks container
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        tiles = utils.compute_tiles(image.shape, tile_size, overlap)
+        if verbose:
+            log("Processing {} tiles".format(len(tiles)))
+
+        # Run detection on batches of tiles. Keep box-local masks only to
+        # avoid holding a full size mask per detection.
+        tile_ids, boxes, class_ids, scores, masks = [], [], [], [], []
+        images = (image[y1:y2, x1:x2] for y1, x1, y2, x2 in tiles)
+        results = self.detect_many(images, verbose=verbose, mask_format="cropped")
+        for i, (tile, r) in enumerate(zip(tiles, results)):
+            _, cropped = r["masks"].cropped()
+            for j in range(r["class_ids"].shape[0]):
+                y1, x1, y2, x2 = r["rois"][j]
+                tile_ids.append(i)
+                boxes.append([y1 + tile[0], x1 + tile[1],
+                              y2 + tile[0], x2 + tile[1]])
+                class_ids.append(r["class_ids"][j])
+                scores.append(r["scores"][j])
+                masks.append(cropped[j])
+
+        # Merge detections across tile seams
+        boxes, class_ids, scores, masks = utils.merge_tile_detections(
+            tiles, np.array(tile_ids, dtype=np.int32),
+            np.array(boxes, dtype=np.int32).reshape([-1, 4]),
+            np.array(class_ids, dtype=np.int32), np.array(scores), masks,
+            iou_threshold=iou_threshold)
+
+        return self._merged_result(image.shape, boxes, class_ids, scores,
+                                   masks, mask_format)
+
+    def detect_tta(self, image, views=None, iou_threshold=0.5, verbose=0,
+                   mask_format="dense"):
+        """Runs the detection pipeline with test-time augmentation. The
+        image is rotated and flipped into its dihedral views, the same
+        flips and 90 degree rotations used to augment the braintissue
+        training data, and the views are detected together in batches of
+        BATCH_SIZE. With BATCH_SIZE >= len(views) and views of one molded
+        shape, that's a single forward pass. Detections are mapped back to
+        the image and fused with weighted mask voting and non-max
+        suppression. See utils.merge_tta_detections().
+
+        image: [H, W, C] image.
+        views: List of (rotations, flip) tuples. Defaults to all 8 views in
+            utils.DIHEDRAL_VIEWS.
+        iou_threshold: Detections of the same class from different views
+            with a mask IoU above this value vote for one instance.
+        mask_format: "dense", "cropped" or "rle". See detect().
+
+        Returns a dict with the same content as the dicts of detect():
+        rois: [N, (y1, x1, y2, x2)] detection bounding boxes
+        class_ids: [N] int class IDs
+        scores: [N] float probability scores for the class IDs
+        masks: [H, W, N] instance binary masks, or an InstanceMasks container
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        if views is None:
+            views = utils.DIHEDRAL_VIEWS
+        if verbose:
+            log("Processing {} views".format(len(views)))
+
+        # Views of a non-square image come in two shapes, which
+        # detect_bucketed() runs in separate batches.
+        images = [utils.dihedral_transform(image, v) for v in views]
+        results = self.detect_bucketed(images, verbose=verbose,
+                                       mask_format="cropped")
+        view_ids, boxes, class_ids, scores, masks = [], [], [], [], []
+        for i, (view, view_image, r) in enumerate(zip(views, images, results)):
+            view_boxes, cropped = utils.invert_dihedral_detections(
+                *r["masks"].cropped(), view_image.shape, view)
+            view_ids.extend([i] * len(cropped))
+            boxes.append(view_boxes)
+            class_ids.append(r["class_ids"])
+            scores.append(r["scores"])
+            masks.extend(cropped)
+
+        # Fuse the detections of all views
+        boxes, class_ids, scores, masks = utils.merge_tta_detections(
+            np.array(view_ids, dtype=np.int32), np.concatenate(boxes),
+            np.concatenate(class_ids), np.concatenate(scores), masks,
+            len(views), iou_threshold=iou_threshold,
+            nms_threshold=self.config.DETECTION_NMS_THRESHOLD)
+        return self._merged_result(image.shape, boxes, class_ids, scores,
+                                   masks, mask_format)
+
+    def _merged_result(self, image_shape, boxes, class_ids, scores, masks,
+                       mask_format):
+        """Packs merged detections with box-local masks in a result dict
+        with masks in the requested format."""
+        masks = utils.InstanceMasks(image_shape, boxes=boxes, cropped=masks)
+        if mask_format == "dense":
+            masks = masks.to_dense()
+        elif mask_format == "rle":
+            masks = utils.InstanceMasks(image_shape, runs=masks.rle())
+        return {
+            "rois": boxes,
+            "class_ids": class_ids,
+            "scores": scores,
+            "masks": masks,
+        }
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
@@ -2700,13 +3289,7 @@ class MaskRCNN():
             molded_images, image_metas, _ = self.mold_inputs(images)
         else:
             molded_images = images
-        image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        model_in = [molded_images, image_metas]
 
         # Run inference
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
@@ -2720,6 +3303,99 @@ class MaskRCNN():
             log(k, v)
         return outputs_np
 
+    def export_frozen_graph(self, path, image_shape=None):
+        """Exports a frozen inference graph that computes only the outputs
+        detect() uses: the detections and their masks. The weights are
+        stored as constants, the anchors are folded in for one image shape,
+        and every op that the two outputs don't depend on is pruned. Load it
+        with FrozenMaskRCNN.
+
+        path: Path of the binary GraphDef file to write.
+        image_shape: [height, width, channels] of the molded images the
+            graph will be used with. Defaults to config.IMAGE_SHAPE, which
+            is the molded shape in the "square" resizing mode.
+
+        Inputs of the graph: input_image, input_image_meta.
+        Outputs of the graph: output_detections, output_mrcnn_mask.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        if image_shape is None:
+            image_shape = self.config.IMAGE_SHAPE
+        image_shape = np.array(image_shape, dtype=np.int32)
+
+        # Freeze the weights of the sub-graph behind the two outputs
+        detections, mrcnn_mask = self.keras_model.outputs[0], self.keras_model.outputs[3]
+        session = K.get_session()
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, session.graph.as_graph_def(),
+            [detections.op.name, mrcnn_mask.op.name])
+
+        # Re-import it with the output of the anchors layer replaced by a
+        # constant, which prunes the ops that generate them
+        anchors_output = self.keras_model.get_layer("anchors").output
+        graph = tf.Graph()
+        with graph.as_default():
+            anchors = self.get_anchors(image_shape).astype(np.float32)
+            anchors = tf.tile(tf.constant(anchors[np.newaxis]),
+                              [self.config.BATCH_SIZE, 1, 1])
+            input_map = {anchors_output.name: anchors}
+            # Inference mode in case the graph depends on the Keras
+            # learning phase
+            if any(n.name == "keras_learning_phase" for n in graph_def.node):
+                input_map["keras_learning_phase:0"] = tf.constant(False)
+            outputs = tf.import_graph_def(
+                graph_def, input_map=input_map, name="",
+                return_elements=[detections.name, mrcnn_mask.name])
+            tf.identity(outputs[0], name="output_detections")
+            tf.identity(outputs[1], name="output_mrcnn_mask")
+            # Keep the image shape the anchors were made for
+            tf.constant(image_shape, name="anchors_image_shape")
+        graph_def = tf.graph_util.extract_sub_graph(
+            graph.as_graph_def(),
+            ["output_detections", "output_mrcnn_mask", "anchors_image_shape"])
+
+        with open(path, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        return path
+
+
+class FrozenMaskRCNN(MaskRCNN):
+    """Runs a graph exported with MaskRCNN.export_frozen_graph(). Has the
+    detection methods of MaskRCNN: detect(), detect_many(),
+    detect_pipelined() and detect_tiled(), without building the Keras model.
+
+    path: Path of the exported graph.
+    config: The inference config the graph was exported with. Used to
+        mold the inputs and unmold the outputs.
+    """
+
+    def __init__(self, path, config):
+        self.mode = "inference"
+        self.config = config
+        graph_def = tf.GraphDef()
+        with open(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph)
+        self.image_shape = self.session.run("anchors_image_shape:0")
+        self._inputs = [self.graph.get_tensor_by_name("input_image:0"),
+                        self.graph.get_tensor_by_name("input_image_meta:0")]
+        self._outputs = [self.graph.get_tensor_by_name("output_detections:0"),
+                         self.graph.get_tensor_by_name("output_mrcnn_mask:0")]
+
+    def _predict_molded(self, molded_images, image_metas, verbose=0):
+        """Runs the frozen graph on a batch of molded images."""
+        assert tuple(molded_images[0].shape) == tuple(self.image_shape), \
+            "The graph was exported for images of shape {}".format(self.image_shape)
+        if verbose:
+            log("molded_images", molded_images)
+            log("image_metas", image_metas)
+        detections, mrcnn_mask = self.session.run(
+            self._outputs, feed_dict=dict(zip(self._inputs, [molded_images, image_metas])))
+        return detections, mrcnn_mask
+
 
 ############################################################
 #  Data Formatting
@@ -2837,6 +3513,116 @@ def batch_pack_graph(x, counts, num_rows):
     return tf.concat(outputs, axis=0)
 
 
+def batch_gather_graph(x, ix):
+    """Gathers different rows from each item of a batch. The same as
+    tf.gather(x[b], ix[b]) for every item b, but in one op.
+
+    x: [batch, N, ...]
+    ix: [batch, K] int32 indices into the second dimension of x.
+
+    Returns: [batch, K, ...]
+    """
+    shape = tf.shape(x)
+    # Offset the indices of each item to index the flattened batch
+    offsets = tf.range(shape[0]) * shape[1]
+    flat = tf.reshape(x, tf.concat([[-1], shape[2:]], axis=0))
+    result = tf.gather(flat, ix + tf.expand_dims(offsets, 1))
+    result.set_shape(ix.shape.concatenate(x.shape[2:]))
+    return result
+
+
+def batch_non_max_suppression_graph(boxes, scores, max_output_size,
+                                    iou_threshold, name=None):
+    """Runs non-max suppression on each item of a batch.
+
+    boxes: [batch, N, (y1, x1, y2, x2)]
+    scores: [batch, N]
+    max_output_size: Maximum number of boxes to keep per item.
+    iou_threshold: Float. IoU threshold to use for filtering.
+
+    Returns: [batch, max_output_size, (y1, x1, y2, x2)] kept boxes of each
+    item sorted by score, padded with zeros.
+    """
+    if LooseVersion(tf.__version__) >= LooseVersion("1.14"):
+        # Batched NMS in one op. All boxes are of the same class. The op
+        # clips boxes to 0..1, which the callers have done already. Its
+        # clip_boxes argument to turn that off is new in TF 1.15.
+        kept = tf.image.combined_non_max_suppression(
+            tf.expand_dims(boxes, 2), tf.expand_dims(scores, 2),
+            max_output_size, max_output_size, iou_threshold, name=name)[0]
+    else:
+        indices = batch_non_max_suppression_indices_graph(
+            boxes, scores, max_output_size, iou_threshold, name=name)
+        kept = batch_gather_graph(boxes, tf.maximum(indices, 0))
+        kept *= tf.expand_dims(tf.to_float(indices > -1), 2)
+    kept.set_shape([boxes.shape[0], max_output_size, 4])
+    return kept
+
+
+def batch_non_max_suppression_indices_graph(boxes, scores, max_output_size,
+                                            iou_threshold, name=None):
+    """Runs non-max suppression on each item of a batch and returns the
+    indices of the kept boxes.
+
+    boxes: [batch, N, (y1, x1, y2, x2)]
+    scores: [batch, N]
+    max_output_size: Maximum number of boxes to keep per item.
+    iou_threshold: Float. IoU threshold to use for filtering.
+
+    Returns: [batch, max_output_size] int32 indices into the second dimension
+    of boxes, sorted by score and padded with -1.
+    """
+    # Single image NMS in a loop over the batch, which adds it to the graph
+    # once rather than once per item.
+    def nms(inputs):
+        b, s = inputs
+        indices = tf.image.non_max_suppression(
+            b, s, max_output_size, iou_threshold)
+        padding = max_output_size - tf.shape(indices)[0]
+        return tf.pad(indices, [(0, padding)], constant_values=-1)
+    indices = tf.map_fn(nms, [boxes, scores], dtype=tf.int32, name=name)
+    indices.set_shape([boxes.shape[0], max_output_size])
+    return indices
+
+
+def generate_pyramid_anchors_graph(feature_maps, image_shape, config):
+    """Generates the anchors of all pyramid levels in the graph. Same values,
+    in the same order, as utils.generate_pyramid_anchors() followed by
+    utils.norm_boxes(), but works for any image size without feeding
+    anchors in.
+
+    feature_maps: List of the RPN feature maps [batch, height, width, depth],
+        one per level of config.RPN_ANCHOR_SCALES.
+    image_shape: [(height, width)] of the molded image in pixels.
+
+    Returns: [anchor_count, (y1, x1, y2, x2)] in normalized coordinates.
+    """
+    anchors = []
+    for scale, stride, p in zip(config.RPN_ANCHOR_SCALES,
+                                config.BACKBONE_STRIDES, feature_maps):
+        # Heights and widths of the anchors of each ratio. Computed in
+        # float64, like the NumPy version, so the results are identical.
+        ratios = np.array(config.RPN_ANCHOR_RATIOS, dtype=np.float64)
+        sizes = tf.constant(np.stack([scale / np.sqrt(ratios),
+                                      scale * np.sqrt(ratios)], axis=1))
+        # Anchor centers on the feature map grid, row by row
+        shape = tf.shape(p)[1:3]
+        shifts_y = tf.cast(tf.range(0, shape[0], config.RPN_ANCHOR_STRIDE) * stride, tf.float64)
+        shifts_x = tf.cast(tf.range(0, shape[1], config.RPN_ANCHOR_STRIDE) * stride, tf.float64)
+        shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+        centers = tf.stack([tf.reshape(shifts_y, [-1]), tf.reshape(shifts_x, [-1])], axis=1)
+        # [centers, ratios, (y1, x1, y2, x2)]
+        boxes = tf.concat([centers[:, None, :] - 0.5 * sizes[None, :, :],
+                           centers[:, None, :] + 0.5 * sizes[None, :, :]], axis=2)
+        anchors.append(tf.reshape(boxes, [-1, 4]))
+    anchors = tf.concat(anchors, axis=0)
+    # Normalize coordinates
+    h, w = tf.split(tf.cast(image_shape, tf.float64), 2)
+    scale = tf.concat([h, w, h, w], axis=-1) - tf.constant(1.0, dtype=tf.float64)
+    shift = tf.constant([0., 0., 1., 1.], dtype=tf.float64)
+    return tf.cast(tf.divide(anchors - shift, scale), tf.float32)
+
+
 def norm_boxes_graph(boxes, shape):
     """Converts boxes from pixel coordinates to normalized coordinates.
     boxes: [..., (y1, x1, y2, x2)] in pixel coordinates
@@ -0,0 +1,219 @@
+"""
+Mask R-CNN
+Run Length Encoding (RLE) of instance masks.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Masks are flattened column wise (top to bottom, then left to right) and
+encoded as runs of (start, length) pairs, where start is a 1-based pixel
+index. This is the format used in the Kaggle Data Science Bowl submissions.
+Runs are stored in [run_count, (start, length)] integer arrays.
+"""
+
+import numpy as np
+
+
+def encode(mask):
+    """Encodes a mask in Run Length Encoding (RLE).
+    mask: [height, width] binary mask.
+
+    Returns: [run_count, (start, length)] array.
+    """
+    assert mask.ndim == 2, "Mask must be of shape [Height, Width]"
+    # Flatten it column wise
+    m = mask.T.flatten().astype(np.int8)
+    # Compute gradient. Equals 1 or -1 at transition points
+    g = np.diff(np.concatenate([[0], m, [0]]), n=1)
+    # 1-based indicies of transition points (where gradient != 0)
+    runs = np.where(g != 0)[0].reshape([-1, 2]) + 1
+    # Convert second index in each pair to length
+    runs[:, 1] = runs[:, 1] - runs[:, 0]
+    return runs
+
+
+def encode_cropped(mask, box, image_shape):
+    """Encodes a mask given in the frame of its bounding box. The runs are
+    in the frame of the full image, the same as encode() of the mask pasted
+    into an image sized array, but without allocating that array.
+    mask: [y2 - y1, x2 - x1] binary mask.
+    box: [y1, x1, y2, x2] location of the mask in the image.
+    image_shape: [height, width, ...] of the image.
+
+    Returns: [run_count, (start, length)] array.
+    """
+    y1, x1, y2, x2 = [int(v) for v in box[:4]]
+    height = image_shape[0]
+    assert mask.shape[:2] == (y2 - y1, x2 - x1), "Mask doesn't match the box"
+    # Pad each column with a zero at the bottom so runs end in their column
+    m = np.zeros([x2 - x1, y2 - y1 + 1], dtype=np.int8)
+    m[:, :-1] = mask.T
+    g = np.diff(np.concatenate([[0], m.flatten()]), n=1)
+    ix = np.where(g != 0)[0].reshape([-1, 2])
+    lengths = ix[:, 1] - ix[:, 0]
+    # Move the starts from the padded box frame to the image frame
+    col, row = np.divmod(ix[:, 0], y2 - y1 + 1)
+    starts = (x1 + col) * height + y1 + row + 1
+    # Runs that reach the bottom of the image continue at the top of the
+    # next column if the box spans the full height. Merge those.
+    if starts.shape[0] > 1:
+        joined = starts[1:] == starts[:-1] + lengths[:-1]
+        if np.any(joined):
+            # Each run takes the start of the first run of its group
+            group = np.concatenate([[0], np.cumsum(~joined)])
+            first = np.concatenate([[True], ~joined])
+            lengths = np.bincount(group, weights=lengths).astype(lengths.dtype)
+            starts = starts[first]
+    return np.stack([starts, lengths], axis=1).astype(np.int64)
+
+
+def encode_labels(labels):
+    """Encodes all objects of a label image in one pass.
+    labels: [height, width] integer array. 0 is background, and every other
+        value is the ID of one object.
+
+    Returns:
+    ids: [object_count] Sorted IDs of the objects found in the image.
+    runs: List of [run_count, (start, length)] arrays, one per ID. The same
+        as calling encode(labels == id) for every ID.
+    """
+    assert labels.ndim == 2, "Labels must be of shape [Height, Width]"
+    # Flatten it column wise and find the positions where the value changes
+    flat = labels.T.flatten()
+    change = np.where(flat[1:] != flat[:-1])[0] + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [flat.shape[0]]])
+    values = flat[starts]
+    foreground = values != 0
+    starts, ends, values = starts[foreground], ends[foreground], values[foreground]
+    # Group the runs by object, keeping them sorted by start within a group
+    order = np.argsort(values, kind="stable")
+    ids, first = np.unique(values[order], return_index=True)
+    runs = np.stack([starts + 1, ends - starts], axis=1)[order].astype(np.int64)
+    return ids, np.split(runs, first[1:])
+
+
+def decode(runs, shape):
+    """Decodes RLE runs and returns a binary mask.
+    runs: [run_count, (start, length)] array.
+    shape: [height, width] of the mask.
+    """
+    runs = np.asarray(runs).reshape([-1, 2])
+    size = shape[0] * shape[1]
+    starts = runs[:, 0] - 1
+    ends = starts + runs[:, 1]
+    assert np.all(starts >= 0) and np.all(ends <= size), \
+        "Runs out of bounds of shape {}".format(shape)
+    # Mark the start and end of each run and expand them with a running sum
+    edges = np.zeros([size + 1], dtype=np.int32)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, ends, -1)
+    mask = np.cumsum(edges[:-1]) > 0
+    # Reshape and transpose
+    return mask.reshape([shape[1], shape[0]]).T
+
+
+def bbox(runs, shape):
+    """Computes the bounding box of an RLE encoded mask.
+    runs: [run_count, (start, length)] array.
+    shape: [height, width] of the mask.
+
+    Returns: [y1, x1, y2, x2]. Zeros if the mask is empty.
+    """
+    runs = np.asarray(runs).reshape([-1, 2])
+    runs = runs[runs[:, 1] > 0]
+    if runs.shape[0] == 0:
+        return np.zeros([4], dtype=np.int32)
+    height = shape[0]
+    # First and last pixel of each run
+    first_x, first_y = np.divmod(runs[:, 0] - 1, height)
+    last_x, last_y = np.divmod(runs[:, 0] + runs[:, 1] - 2, height)
+    # Runs that continue into the next column cover the full height
+    wrapped = np.any(last_x > first_x)
+    y1 = 0 if wrapped else first_y.min()
+    y2 = height if wrapped else last_y.max() + 1
+    return np.array([y1, first_x.min(), y2, last_x.max() + 1], dtype=np.int32)
+
+
+def intersection(runs1, runs2):
+    """Computes the number of pixels shared by two RLE encoded masks of
+    the same shape.
+    """
+    runs1 = np.asarray(runs1).reshape([-1, 2])
+    runs2 = np.asarray(runs2).reshape([-1, 2])
+    if runs1.shape[0] == 0 or runs2.shape[0] == 0:
+        return 0
+    starts = runs2[:, 0]
+    # Pixels of runs2 before each run of runs2
+    before = np.concatenate([[0], np.cumsum(runs2[:, 1])[:-1]])
+
+    def covered(x):
+        """Number of pixels of runs2 that are < x."""
+        k = np.searchsorted(starts, x, side="right") - 1
+        inside = np.clip(x - starts[np.maximum(k, 0)], 0, runs2[np.maximum(k, 0), 1])
+        return np.where(k >= 0, before[np.maximum(k, 0)] + inside, 0)
+
+    return int(np.sum(covered(runs1[:, 0] + runs1[:, 1]) - covered(runs1[:, 0])))
+
+
+def to_coco(runs, shape):
+    """Converts RLE runs to the uncompressed RLE of the COCO API, which
+    can be compressed with pycocotools.mask.frPyObjects().
+    runs: [run_count, (start, length)] array.
+    shape: [height, width] of the mask.
+
+    Returns: {"size": [height, width], "counts": [...]} dict. Counts are
+    the lengths of alternating runs of zeros and ones, column wise.
+    """
+    runs = np.asarray(runs).reshape([-1, 2])
+    ends = runs[:, 0] - 1 + runs[:, 1]
+    zeros = runs[:, 0] - 1 - np.concatenate([[0], ends[:-1]])
+    counts = np.stack([zeros, runs[:, 1]], axis=1).flatten().tolist()
+    total = int(shape[0]) * int(shape[1])
+    counts.append(total - (int(ends[-1]) if ends.shape[0] else 0))
+    return {"size": [int(shape[0]), int(shape[1])], "counts": counts}
+
+
+def to_string(runs):
+    """Formats RLE runs as a string of space-separated values."""
+    return " ".join(map(str, np.asarray(runs).flatten()))
+
+
+def from_string(rle):
+    """Parses a string of space-separated values into RLE runs."""
+    return np.array(rle.split(), dtype=np.int64).reshape([-1, 2])
+
+
+def write_csv(path, lines, header="ImageId,EncodedPixels"):
+    """Writes a submission CSV file line by line, so lines can be produced
+    by a generator while images are processed rather than collected in
+    memory first.
+    path: Path of the file to write.
+    lines: Iterable of strings, such as "image_id, 1 3 10 5". Each item can
+        hold several lines.
+    header: First line of the file.
+    """
+    with open(path, "w") as f:
+        f.write(header)
+        for line in lines:
+            f.write("\n")
+            f.write(line)
+
+
+def read_csv(path, skip_header=True):
+    """Reads a submission CSV file line by line.
+    path: Path of the file to read.
+    skip_header: Skip the first line of the file.
+
+    Yields (image_id, runs) tuples, one per line, where runs is a
+    [run_count, (start, length)] array. Lines with an image ID only give
+    empty runs.
+    """
+    with open(path) as f:
+        if skip_header:
+            next(f, None)
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            image_id, _, encoded = line.partition(",")
+            yield image_id.strip(), from_string(encoded)
@@ -0,0 +1,433 @@
+"""
+Mask R-CNN
+Local inference server with dynamic batching.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Serves one loaded inference model to several clients over HTTP. Requests
+are queued and a single worker thread groups them into batches of up to
+BATCH_SIZE images, waiting at most max_latency seconds for a batch to fill.
+
+Endpoints:
+    POST /detect   Body is an image file (PNG, TIFF, JPEG, ...) or a .npy
+                   array with Content-Type application/x-npy. The query
+                   parameter format=rle (default) or format=polygon selects
+                   the mask encoding of the response. For RGB models,
+                   grayscale and RGBA images are converted to RGB. Other
+                   shapes are rejected with status 400.
+    GET  /health   Model name and batch settings.
+    GET  /metrics  Request, batch, and latency counters.
+
+Usage:
+    server = DetectionServer(model, port=8765)
+    server.serve_forever()
+
+    client = Client("http://127.0.0.1:8765")
+    r = client.detect(image)
+"""
+
+import io
+import json
+import time
+import threading
+import queue
+import urllib.request
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import skimage.color
+import skimage.io
+import skimage.measure
+import tensorflow as tf
+
+from mrcnn import utils
+from mrcnn import rle
+
+
+############################################################
+#  Encoding
+############################################################
+
+def mask_polygons(box, mask):
+    """Traces the outlines of a mask given in the frame of its box.
+    box: [y1, x1, y2, x2] location of the mask in the image.
+    mask: [y2 - y1, x2 - x1] binary mask.
+
+    Returns: List of polygons, each a list of [x, y] points in image
+    coordinates.
+    """
+    # Pad to make sure the outlines of masks that touch the box are closed
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = mask
+    polygons = []
+    for verts in skimage.measure.find_contours(padded, 0.5):
+        # Subtract the padding and flip (y, x) to (x, y)
+        verts = np.fliplr(verts) - 1 + [box[1], box[0]]
+        polygons.append(np.round(verts, 1).tolist())
+    return polygons
+
+
+def encode_result(result, mask_format="rle"):
+    """Converts a result dict of MaskRCNN.detect() with InstanceMasks to a
+    JSON serializable dict.
+    mask_format: "rle" for RLE strings of mrcnn.rle, or "polygon".
+    """
+    masks = result["masks"]
+    if mask_format == "rle":
+        encoded = [rle.to_string(r) for r in masks.rle()]
+    else:
+        boxes, cropped = masks.cropped()
+        encoded = [mask_polygons(b, m) for b, m in zip(boxes, cropped)]
+    return {
+        "rois": np.asarray(result["rois"]).tolist(),
+        "class_ids": np.asarray(result["class_ids"]).tolist(),
+        "scores": np.asarray(result["scores"]).tolist(),
+        "image_shape": list(masks.image_shape),
+        "mask_format": mask_format,
+        "masks": encoded,
+    }
+
+
+def decode_result(data):
+    """Converts a JSON response of the server back to a result dict like
+    the ones of MaskRCNN.detect(). RLE masks are returned in an
+    InstanceMasks container and polygons as lists.
+    """
+    result = {
+        "rois": np.array(data["rois"], dtype=np.int32).reshape([-1, 4]),
+        "class_ids": np.array(data["class_ids"], dtype=np.int32),
+        "scores": np.array(data["scores"], dtype=np.float32),
+    }
+    if data["mask_format"] == "rle":
+        result["masks"] = utils.InstanceMasks(
+            data["image_shape"], runs=[rle.from_string(r) for r in data["masks"]])
+    else:
+        result["masks"] = data["masks"]
+    return result
+
+
+############################################################
+#  Server
+############################################################
+
+class _Request(object):
+    """An image waiting for detection and, later, its result."""
+
+    def __init__(self, image):
+        self.image = image
+        self.received = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Set when the client stopped waiting. The request is skipped.
+        self.cancelled = False
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routes HTTP requests to the DetectionServer in self.server.detector."""
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        detector = self.server.detector
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, detector.health())
+        elif path == "/metrics":
+            self._send_json(200, detector.metrics())
+        else:
+            self._send_json(404, {"error": "Not found: {}".format(path)})
+
+    def do_POST(self):
+        detector = self.server.detector
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/detect":
+            self._send_json(404, {"error": "Not found: {}".format(url.path)})
+            return
+        mask_format = urllib.parse.parse_qs(url.query).get("format", ["rle"])[0]
+        if mask_format not in ["rle", "polygon"]:
+            self._send_json(400, {"error": "Unknown format {}".format(mask_format)})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type") == "application/x-npy":
+                image = np.load(io.BytesIO(body))
+            else:
+                image = skimage.io.imread(io.BytesIO(body))
+            image = detector.prepare_image(image)
+        except Exception as e:
+            self._send_json(400, {"error": "Can't read image: {}".format(e)})
+            return
+        try:
+            result = detector.detect(image)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, encode_result(result, mask_format))
+
+    def log_message(self, format, *args):
+        if self.server.detector.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class DetectionServer(object):
+    """Serves a MaskRCNN inference model over HTTP with dynamic batching.
+
+    model: MaskRCNN model in inference mode. Only the worker thread of the
+        server uses it.
+    host, port: Address to listen on. Defaults to the local host only.
+    max_latency: Seconds to wait for more requests after the first request
+        of a batch arrives. A batch runs as soon as it has BATCH_SIZE images
+        or when this deadline passes.
+    timeout: Seconds a request waits for its result before failing.
+    """
+
+    def __init__(self, model, host="127.0.0.1", port=8765, max_latency=0.05,
+                 timeout=60, verbose=0):
+        assert model.mode == "inference", "Create model in inference mode."
+        self.model = model
+        self.max_latency = max_latency
+        self.timeout = timeout
+        self.verbose = verbose
+        # The worker thread runs the model in the graph it was built in
+        self.graph = tf.get_default_graph()
+        self.requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._counters = {
+            "requests": 0, "errors": 0, "cancelled": 0, "batches": 0, "images": 0,
+            "latency_total": 0., "latency_max": 0., "predict_total": 0.,
+        }
+        self._started = time.time()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.detector = self
+
+    @property
+    def address(self):
+        """The (host, port) the server listens on."""
+        return self.httpd.server_address[:2]
+
+    def start(self):
+        """Starts the worker and the HTTP server in background threads."""
+        self._worker.start()
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        """Starts the worker and serves HTTP requests on this thread."""
+        self._worker.start()
+        if self.verbose:
+            print("Serving on http://{}:{}".format(*self.address))
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stops the HTTP server and the worker."""
+        self._stop.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def prepare_image(self, image):
+        """Converts a decoded image to the channels of the model, the same
+        way Dataset.load_image() does for RGB models: grayscale images are
+        converted to RGB and alpha channels are removed.
+
+        Raises ValueError if the image doesn't have the shape
+        [height, width, IMAGE_CHANNEL_COUNT] after that.
+        """
+        image = np.asarray(image)
+        channels = self.model.config.IMAGE_CHANNEL_COUNT
+        if channels == 3:
+            # If grayscale. Convert to RGB for consistency.
+            if image.ndim == 2:
+                image = skimage.color.gray2rgb(image)
+            # If has an alpha channel, remove it for consistency
+            if image.ndim == 3 and image.shape[-1] == 4:
+                image = image[..., :3]
+        if image.ndim != 3 or image.shape[-1] != channels or \
+                image.shape[0] == 0 or image.shape[1] == 0:
+            raise ValueError("Expected an image of shape [height, width, {}], "
+                             "got {}".format(channels, image.shape))
+        return image
+
+    def detect(self, image):
+        """Queues an image for detection and waits for its result. Can be
+        called from any thread.
+
+        Returns a dict of MaskRCNN.detect() with masks in an InstanceMasks
+        container.
+        """
+        request = _Request(image)
+        self.requests.put(request)
+        if not request.done.wait(self.timeout):
+            # Don't run it if it's still waiting in the queue
+            request.cancelled = True
+            raise Exception("Detection timed out after {}s".format(self.timeout))
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _get(self, timeout):
+        """Takes the next request that wasn't cancelled from the queue.
+        Returns None if there is none within timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                return None
+            if not request.cancelled:
+                return request
+            with self._lock:
+                self._counters["cancelled"] += 1
+
+    def _next_batch(self):
+        """Waits for a request, then collects more until the batch is full
+        or max_latency has passed since the first one."""
+        batch = []
+        while not batch:
+            if self._stop.is_set():
+                return batch
+            request = self._get(0.1)
+            if request is not None:
+                batch.append(request)
+        deadline = batch[0].received + self.max_latency
+        while len(batch) < self.model.config.BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            request = self._get(remaining)
+            if request is None:
+                break
+            batch.append(request)
+        return batch
+
+    def _detect_batch(self, batch):
+        """Runs a batch of requests through the model and sets their results.
+        If the batch fails, its requests are retried one at a time, so an
+        error only reaches the request that caused it."""
+        try:
+            with self.graph.as_default():
+                results = list(self.model.detect_many(
+                    [r.image for r in batch], mask_format="cropped"))
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                for request in batch:
+                    self._detect_batch([request])
+            return
+        for request, result in zip(batch, results):
+            request.result = result
+
+    def _run(self):
+        """Worker loop. Runs batches of requests through the model."""
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            t = time.time()
+            self._detect_batch(batch)
+            now = time.time()
+            with self._lock:
+                c = self._counters
+                c["batches"] += 1
+                c["images"] += len(batch)
+                c["predict_total"] += now - t
+                for request in batch:
+                    latency = now - request.received
+                    c["requests"] += 1
+                    c["errors"] += request.error is not None
+                    c["latency_total"] += latency
+                    c["latency_max"] = max(c["latency_max"], latency)
+            for request in batch:
+                request.done.set()
+
+    def health(self):
+        """Returns a dict describing the state of the server."""
+        return {
+            "status": "ok" if self._worker.is_alive() else "stopped",
+            "model": self.model.config.NAME,
+            "batch_size": self.model.config.BATCH_SIZE,
+            "max_latency": self.max_latency,
+        }
+
+    def metrics(self):
+        """Returns a dict of counters: requests, errors, requests cancelled
+        after a timeout, batches, images, mean batch size, mean and max
+        request latency in seconds, mean model time per batch, queue depth,
+        and uptime."""
+        with self._lock:
+            c = dict(self._counters)
+        return {
+            "requests": c["requests"],
+            "errors": c["errors"],
+            "cancelled": c["cancelled"],
+            "batches": c["batches"],
+            "images": c["images"],
+            "mean_batch_size": c["images"] / c["batches"] if c["batches"] else 0.,
+            "mean_latency": c["latency_total"] / c["requests"] if c["requests"] else 0.,
+            "max_latency": c["latency_max"],
+            "mean_batch_time": c["predict_total"] / c["batches"] if c["batches"] else 0.,
+            "queue_depth": self.requests.qsize(),
+            "uptime": time.time() - self._started,
+        }
+
+
+############################################################
+#  Client
+############################################################
+
+class Client(object):
+    """Client of a DetectionServer.
+
+    url: Base URL of the server, such as "http://127.0.0.1:8765".
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as f:
+            return json.loads(f.read().decode("utf-8"))
+
+    def detect(self, image, mask_format="rle"):
+        """Runs detection on one image on the server.
+        image: [H, W, C] array.
+        mask_format: "rle" or "polygon".
+
+        Returns a dict like the ones of MaskRCNN.detect(). See
+        decode_result().
+        """
+        buf = io.BytesIO()
+        np.save(buf, np.asarray(image))
+        request = urllib.request.Request(
+            "{}/detect?format={}".format(self.url, mask_format),
+            data=buf.getvalue(), headers={"Content-Type": "application/x-npy"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as f:
+            return decode_result(json.loads(f.read().decode("utf-8")))
+
+    def health(self):
+        return self._get("/health")
+
+    def metrics(self):
+        return self._get("/metrics")
@@ -22,6 +22,8 @@ import shutil
 import warnings
 from distutils.version import LooseVersion
 
+from mrcnn import rle
+
 # URL from which to download the latest COCO trained weights
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
 
@@ -77,25 +79,79 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def _pairwise_iou(boxes1, boxes2, area1, area2):
+    """Computes the IoU of every box in boxes1 with every box in boxes2 with
+    the same operations as compute_iou(), so results match it exactly.
+
+    Returns: [len(boxes1), len(boxes2)] matrix.
+    """
+    # Work in place where possible. These arrays can be large.
+    height = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    height -= np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    np.maximum(height, 0, out=height)
+    width = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    width -= np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    np.maximum(width, 0, out=width)
+    intersection = width
+    intersection *= height
+    union = area1[:, None] + area2[None, :]
+    union -= intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if union.dtype.kind == "f":
+            return np.divide(intersection, union, out=union)
+        return intersection / union
+
+
+def compute_overlaps(boxes1, boxes2, block_size=1024, dtype=np.float64):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    block_size: Number of boxes1 to process at once. Bounds the memory of
+        the intermediate arrays to a few times block_size * len(boxes2).
+    dtype: np.float64, or np.float32 to compute in single precision, which
+        is faster and halves the memory of the result.
 
     For better performance, pass the largest set first and the smaller second.
     """
+    if dtype == np.float32:
+        boxes1 = boxes1.astype(np.float32)
+        boxes2 = boxes2.astype(np.float32)
     # Areas of anchors and GT boxes
     area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
     # Each cell contains the IoU value.
-    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]), dtype=dtype)
+    for s in range(0, boxes1.shape[0], block_size):
+        overlaps[s:s + block_size] = _pairwise_iou(
+            boxes1[s:s + block_size], boxes2, area1[s:s + block_size], area2)
     return overlaps
 
 
+def compute_overlaps_sparse(boxes1, boxes2, iou_floor=0, block_size=1024,
+                            dtype=np.float64):
+    """Computes IoU overlaps between two sets of boxes, and keeps only the
+    pairs with an IoU above iou_floor. Same as compute_overlaps() otherwise.
+    Useful when both sets are large and most pairs don't overlap, because
+    the dense matrix is never built.
+
+    Returns a [len(boxes1), len(boxes2)] scipy.sparse.csr_matrix.
+    """
+    import scipy.sparse
+    rows, cols, values = [], [], []
+    for s in range(0, boxes1.shape[0], block_size):
+        block = compute_overlaps(boxes1[s:s + block_size], boxes2, dtype=dtype)
+        r, c = np.nonzero(block > iou_floor)
+        rows.append(r + s)
+        cols.append(c)
+        values.append(block[r, c])
+    if not rows:
+        return scipy.sparse.csr_matrix((0, boxes2.shape[0]), dtype=dtype)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(boxes1.shape[0], boxes2.shape[0]))
+
+
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
     masks1, masks2: [Height, Width, instances]
@@ -118,15 +174,165 @@ def compute_overlaps_masks(masks1, masks2):
     return overlaps
 
 
-def non_max_suppression(boxes, scores, threshold):
+def cropped_masks(masks):
+    """Converts instance masks to masks cropped to their bounding boxes.
+    masks: One of:
+        [Height, Width, instances] dense masks,
+        an InstanceMasks container, or
+        a (boxes, cropped) tuple of [instances, (y1, x1, y2, x2)] boxes and
+        a list of box-local masks, as returned by InstanceMasks.cropped().
+
+    Returns:
+    boxes: [instances, (y1, x1, y2, x2)] int32 boxes.
+    cropped: List of boolean masks, each of shape [y2 - y1, x2 - x1].
+    """
+    if isinstance(masks, InstanceMasks):
+        masks = masks.cropped()
+    if isinstance(masks, tuple):
+        boxes, cropped = masks
+        boxes = np.asarray(boxes).astype(np.int32).reshape([-1, 4])
+        cropped = [np.asarray(m) > .5 for m in cropped]
+        return boxes, cropped
+    masks = masks > .5
+    boxes = extract_bboxes_batched(masks)
+    cropped = [masks[y1:y2, x1:x2, i] for i, (y1, x1, y2, x2) in enumerate(boxes)]
+    return boxes, cropped
+
+
+def compute_mask_intersections(masks1, masks2):
+    """Counts the pixels shared by each pair of masks. Pixels are only
+    compared inside the intersection of the bounding boxes of each pair,
+    and pairs whose boxes don't intersect are skipped.
+
+    masks1, masks2: [Height, Width, instances] masks, InstanceMasks, or
+        (boxes, cropped) tuples. See cropped_masks().
+
+    Returns:
+    intersections: [instances1, instances2] int64 pixel counts.
+    area1, area2: [instances] int64 pixel counts of each mask.
+    """
+    boxes1, cropped1 = cropped_masks(masks1)
+    boxes2, cropped2 = cropped_masks(masks2)
+    area1 = np.array([np.count_nonzero(m) for m in cropped1], dtype=np.int64)
+    area2 = np.array([np.count_nonzero(m) for m in cropped2], dtype=np.int64)
+    intersections = np.zeros([len(cropped1), len(cropped2)], dtype=np.int64)
+    if len(cropped1) == 0 or len(cropped2) == 0:
+        return intersections, area1, area2
+
+    # Intersection windows of all pairs. Only pairs with a non-empty window
+    # can share pixels.
+    y1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    x1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    y2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    x2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    for i, j in np.argwhere((y2 > y1) & (x2 > x1)):
+        a = cropped1[i][y1[i, j] - boxes1[i, 0]:y2[i, j] - boxes1[i, 0],
+                        x1[i, j] - boxes1[i, 1]:x2[i, j] - boxes1[i, 1]]
+        b = cropped2[j][y1[i, j] - boxes2[j, 0]:y2[i, j] - boxes2[j, 0],
+                        x1[i, j] - boxes2[j, 1]:x2[i, j] - boxes2[j, 1]]
+        intersections[i, j] = np.count_nonzero(a & b)
+    return intersections, area1, area2
+
+
+def compute_overlaps_masks_sparse(masks1, masks2):
+    """Computes IoU overlaps between two sets of masks. Same result as
+    compute_overlaps_masks(), but built on compute_mask_intersections(), so
+    memory doesn't grow with the image size times the number of instances.
+
+    masks1, masks2: [Height, Width, instances] masks, InstanceMasks, or
+        (boxes, cropped) tuples. See cropped_masks().
+
+    Returns: [instances1, instances2] float32 IoU overlaps.
+    """
+    intersections, area1, area2 = compute_mask_intersections(masks1, masks2)
+    # If either set of masks is empty return empty result
+    if intersections.size == 0:
+        return np.zeros(intersections.shape)
+    intersections = intersections.astype(np.float32)
+    area1 = area1.astype(np.float32)
+    area2 = area2.astype(np.float32)
+
+    # Empty masks give 0/0 = NaN, the same as compute_overlaps_masks()
+    union = area1[:, None] + area2[None, :] - intersections
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overlaps = intersections / union
+    return overlaps
+
+
+def _overlapping_pairs(boxes, area, min_iou, class_ids=None, chunk_size=4096):
+    """Finds all pairs of boxes with an IoU above min_iou with a sweep over
+    the boxes sorted by their left edge. Only boxes that overlap along the
+    x axis are compared, so the cost depends on how crowded the boxes are
+    rather than on the square of their number.
+
+    class_ids: Optional. If given, only boxes of the same class are paired.
+
+    Returns the pairs as a symmetric adjacency list in CSR format:
+    indptr: [N + 1] The neighbours of box i are in indptr[i]:indptr[i + 1].
+    neighbours: Indices of the neighbouring boxes.
+    ious: IoU with each neighbour.
+    """
+    n = boxes.shape[0]
+    order = np.argsort(boxes[:, 1], kind="stable")
+    x1_sorted = boxes[order, 1]
+    # In sorted order, box p overlaps boxes p+1 to end[p] - 1 along x
+    end = np.searchsorted(x1_sorted, boxes[order, 3], side="left")
+    rows, cols, ious = [], [], []
+    for s in range(0, n, chunk_size):
+        counts = np.maximum(end[s:s + chunk_size] - np.arange(s, min(s + chunk_size, n)) - 1, 0)
+        p = np.repeat(np.arange(s, s + counts.shape[0]), counts)
+        q = p + 1 + np.arange(p.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        i, j = order[p], order[q]
+        if class_ids is not None:
+            same = class_ids[i] == class_ids[j]
+            i, j = i[same], j[same]
+        b1, b2 = boxes[i], boxes[j]
+        y1 = np.maximum(b1[:, 0], b2[:, 0])
+        y2 = np.minimum(b1[:, 2], b2[:, 2])
+        x1 = np.maximum(b1[:, 1], b2[:, 1])
+        x2 = np.minimum(b1[:, 3], b2[:, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = area[i] + area[j] - intersection
+        with np.errstate(divide="ignore", invalid="ignore"):
+            iou = intersection / union
+        hit = iou > min_iou
+        rows.append(i[hit])
+        cols.append(j[hit])
+        ious.append(iou[hit])
+    rows, cols, ious = np.concatenate(rows), np.concatenate(cols), np.concatenate(ious)
+    # Add both directions of each pair and group them by box
+    i = np.concatenate([rows, cols])
+    j = np.concatenate([cols, rows])
+    order = np.argsort(i, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(i, minlength=n))])
+    return indptr, j[order], np.concatenate([ious, ious])[order]
+
+
+def non_max_suppression(boxes, scores, threshold, class_ids=None,
+                        method="auto", block_size=512):
     """Performs non-maximum suppression and returns indices of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    class_ids: Optional. [N] class IDs. If given, boxes only suppress boxes
+        of the same class, which runs NMS for all classes in one call.
+    method: How to find the overlapping boxes. The result is the same.
+        "block": Computes the IoU matrix in blocks of block_size boxes.
+        "sweep": Compares only boxes that overlap along the x axis. Faster
+            for large numbers of boxes that are spread over the image.
+        "auto": Uses "sweep" if few boxes overlap along the x axis.
+
+    Returns the indices of the kept boxes, sorted by score (highest first).
     """
     assert boxes.shape[0] > 0
+    assert method in ["auto", "block", "sweep"]
     if boxes.dtype.kind != "f":
         boxes = boxes.astype(np.float32)
+    if method == "auto":
+        # Number of box pairs that the sweep would compare, times two
+        x1_sorted = np.sort(boxes[:, 1])
+        sweep_pairs = np.sum(np.searchsorted(x1_sorted, boxes[:, 3])) - boxes.shape[0]
+        method = "sweep" if sweep_pairs < 0.1 * boxes.shape[0] ** 2 else "block"
 
     # Compute box areas
     y1 = boxes[:, 0]
@@ -138,21 +344,103 @@ def non_max_suppression(boxes, scores, threshold):
     # Get indicies of boxes sorted by scores (highest first)
     ixs = scores.argsort()[::-1]
 
+    if method == "sweep":
+        indptr, neighbours, _ = _overlapping_pairs(boxes, area, threshold, class_ids)
+        suppressed = np.zeros([boxes.shape[0]], dtype=bool)
+        pick = []
+        for i in ixs:
+            if suppressed[i]:
+                continue
+            pick.append(i)
+            # Neighbours that come earlier in score order are either
+            # suppressed already, or they would have suppressed this box.
+            suppressed[neighbours[indptr[i]:indptr[i + 1]]] = True
+        return np.array(pick, dtype=np.int32)
+
+    # Work in score order. A box can only be suppressed by boxes before it.
+    boxes = boxes[ixs]
+    area = area[ixs]
+    if class_ids is not None:
+        class_ids = class_ids[ixs]
+    n = boxes.shape[0]
+    suppressed = np.zeros([n], dtype=bool)
     pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
+    for s in range(0, n, block_size):
+        e = min(s + block_size, n)
+        # Overlaps of the boxes of this block with themselves and all boxes after them
+        overlap = _pairwise_iou(boxes[s:e], boxes[s:], area[s:e], area[s:]) > threshold
+        if class_ids is not None:
+            overlap &= class_ids[s:e, None] == class_ids[None, s:]
+        # Resolve the block in order, then apply its kept boxes to the rest
+        kept = []
+        for i in range(e - s):
+            if suppressed[s + i]:
+                continue
+            kept.append(i)
+            suppressed[s:e] |= overlap[i, :e - s]
+        suppressed[e:] |= np.any(overlap[kept, e - s:], axis=0)
+        pick.extend(s + np.array(kept, dtype=np.int64))
+    return ixs[np.array(pick, dtype=np.int64)].astype(np.int32)
+
+
+def soft_non_max_suppression(boxes, scores, sigma=0.5, threshold=0.3,
+                             score_threshold=0.001, method="gaussian",
+                             class_ids=None):
+    """Soft non-maximum suppression (Bodla et al., 2017). Instead of removing
+    boxes that overlap a picked box, their scores are decayed, and boxes
+    are dropped once their score falls below score_threshold.
+    boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores: 1-D array of box scores.
+    sigma: Decay of the "gaussian" method: score *= exp(-iou^2 / sigma).
+    threshold: IoU above which the "linear" method decays scores:
+        score *= 1 - iou.
+    score_threshold: Boxes with lower scores are dropped.
+    method: "gaussian" or "linear".
+    class_ids: Optional. [N] class IDs. If given, boxes only decay the
+        scores of boxes of the same class.
+
+    Returns:
+    pick: Indices of the kept boxes in the order they were picked.
+    scores: The decayed scores of the kept boxes.
+    """
+    import heapq
+    assert method in ["gaussian", "linear"]
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    # Only boxes that overlap a picked box get decayed
+    indptr, neighbours, ious = _overlapping_pairs(
+        boxes, area, 0 if method == "gaussian" else threshold, class_ids)
+    if method == "gaussian":
+        decay = np.exp(-(ious * ious) / sigma)
+    else:
+        decay = 1 - ious
+
+    current = np.array(scores, dtype=np.float64)
+    # Ties are broken in the same order as non_max_suppression()
+    rank = np.empty([boxes.shape[0]], dtype=np.int64)
+    rank[current.argsort()[::-1]] = np.arange(boxes.shape[0])
+    # Max-heap of (score, rank, index). Scores only decrease, so outdated
+    # entries are skipped when they come up.
+    heap = [(-current[i], rank[i], i) for i in range(boxes.shape[0])]
+    heapq.heapify(heap)
+    done = np.zeros([boxes.shape[0]], dtype=bool)
+    pick = []
+    while heap:
+        score, _, i = heapq.heappop(heap)
+        if done[i] or -score != current[i]:
+            continue
+        done[i] = True
+        if current[i] < score_threshold:
+            continue
         pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indices into ixs[1:], so add 1 to get
-        # indices into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indices of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+        for j, d in zip(neighbours[indptr[i]:indptr[i + 1]],
+                        decay[indptr[i]:indptr[i + 1]]):
+            if not done[j]:
+                current[j] *= d
+                heapq.heappush(heap, (-current[j], rank[j], j))
+    pick = np.array(pick, dtype=np.int32)
+    return pick, current[pick]
 
 
 def apply_box_deltas(boxes, deltas):
@@ -181,27 +469,27 @@ def apply_box_deltas(boxes, deltas):
 
 def box_refinement_graph(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
-    box and gt_box are [N, (y1, x1, y2, x2)]
+    box and gt_box are [..., (y1, x1, y2, x2)], such as [N, 4]
     """
     box = tf.cast(box, tf.float32)
     gt_box = tf.cast(gt_box, tf.float32)
 
-    height = box[:, 2] - box[:, 0]
-    width = box[:, 3] - box[:, 1]
-    center_y = box[:, 0] + 0.5 * height
-    center_x = box[:, 1] + 0.5 * width
+    height = box[..., 2] - box[..., 0]
+    width = box[..., 3] - box[..., 1]
+    center_y = box[..., 0] + 0.5 * height
+    center_x = box[..., 1] + 0.5 * width
 
-    gt_height = gt_box[:, 2] - gt_box[:, 0]
-    gt_width = gt_box[:, 3] - gt_box[:, 1]
-    gt_center_y = gt_box[:, 0] + 0.5 * gt_height
-    gt_center_x = gt_box[:, 1] + 0.5 * gt_width
+    gt_height = gt_box[..., 2] - gt_box[..., 0]
+    gt_width = gt_box[..., 3] - gt_box[..., 1]
+    gt_center_y = gt_box[..., 0] + 0.5 * gt_height
+    gt_center_x = gt_box[..., 1] + 0.5 * gt_width
 
     dy = (gt_center_y - center_y) / height
     dx = (gt_center_x - center_x) / width
     dh = tf.log(gt_height / height)
     dw = tf.log(gt_width / width)
 
-    result = tf.stack([dy, dx, dh, dw], axis=1)
+    result = tf.stack([dy, dx, dh, dw], axis=-1)
     return result
 
 
@@ -209,9 +497,13 @@ def box_refinement(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]. (y2, x2) is
     assumed to be outside the box.
+
+    Integer boxes are computed in float32. Float boxes keep their precision.
     """
-    box = box.astype(np.float32)
-    gt_box = gt_box.astype(np.float32)
+    if box.dtype.kind != "f":
+        box = box.astype(np.float32)
+    if gt_box.dtype.kind != "f":
+        gt_box = gt_box.astype(np.float32)
 
     height = box[:, 2] - box[:, 0]
     width = box[:, 3] - box[:, 1]
@@ -382,6 +674,37 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def gt_version(self, image_id):
+        """Returns a value that changes when the image or the annotations of
+        the given image change. The GT cache of load_image_gt() keys its
+        entries with it, so it doesn't return stale data.
+
+        The default covers the image_info entry, which holds the annotations
+        of datasets such as COCO and balloon, and the modification time and
+        size of the file at its path. Override it in datasets that load
+        annotations from other files. See file_version().
+        """
+        info = self.image_info[image_id]
+        return [repr(info), file_version(info.get("path"))]
+
+
+def file_version(path):
+    """Returns the (name, modification time, size) of a file, or of each
+    file in a directory, to detect changes of annotation files. Returns
+    None if the path doesn't exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    version = []
+    for p in paths:
+        if os.path.isfile(p):
+            stat = os.stat(p)
+            version.append((os.path.basename(p), stat.st_mtime, stat.st_size))
+    return version
+
 
 def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
     """Resizes an image keeping the aspect ratio unchanged.
@@ -550,6 +873,189 @@ def expand_mask(bbox, mini_mask, image_shape):
     return mask
 
 
+def extract_bboxes_batched(mask):
+    """Compute bounding boxes from masks. Same as extract_bboxes() but
+    processes all instances at once.
+    mask: [height, width, num_instances]. Mask pixels are either 1 or 0.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)].
+    """
+    # No pixels, such as the [0, 0, 0] masks of images without instances
+    if mask.shape[0] == 0 or mask.shape[1] == 0:
+        return np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    mask = mask.astype(bool, copy=False)
+    rows = np.any(mask, axis=1)  # [height, num_instances]
+    cols = np.any(mask, axis=0)  # [width, num_instances]
+    boxes = np.stack([
+        np.argmax(rows, axis=0),
+        np.argmax(cols, axis=0),
+        # x2 and y2 should not be part of the box.
+        mask.shape[0] - np.argmax(rows[::-1], axis=0),
+        mask.shape[1] - np.argmax(cols[::-1], axis=0),
+    ], axis=1)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(rows, axis=0)] = 0
+    return boxes.astype(np.int32)
+
+
+def _bilinear_sample_points(starts, sizes, out_size):
+    """Computes the source coordinates and weights of a bilinear resize of
+    several 1D ranges to the same number of samples. Samples are aligned to
+    pixel centers, like skimage.transform.resize().
+
+    starts, sizes: [N] First index and length of each source range.
+    out_size: Number of output samples per range.
+
+    Returns [N, out_size] arrays:
+    lo, hi: Indices of the two neighbouring source pixels.
+    lo_weight, hi_weight: Their weights. Weights of neighbours that fall
+        outside of their range are set to zero.
+    """
+    sizes = sizes.astype(np.float64)[:, np.newaxis]
+    coords = (np.arange(out_size) + 0.5) * (sizes / out_size) - 0.5
+    lo = np.floor(coords)
+    hi_weight = coords - lo
+    lo_weight = 1 - hi_weight
+    lo_weight[lo < 0] = 0
+    hi_weight[lo + 1 > sizes - 1] = 0
+    hi = np.clip(lo + 1, 0, sizes - 1).astype(np.int64)
+    lo = np.clip(lo, 0, sizes - 1).astype(np.int64)
+    starts = starts[:, np.newaxis]
+    return lo + starts, hi + starts, lo_weight, hi_weight
+
+
+def minimize_mask_batched(bbox, mask, mini_shape):
+    """Resize masks to a smaller version to reduce memory load. Like
+    minimize_mask() but resizes all instances at once with a single
+    bilinear gather, rather than calling resize() per instance.
+
+    Output pixels whose interpolated value is exactly 0.5 are ties. Both
+    functions set them to False, but they don't add up the neighbours in
+    the same order as resize(), which differs between skimage versions.
+    A tie can come out a rounding error above 0.5 in one and not the
+    other, so the masks can differ in single tie pixels.
+    """
+    bbox = np.asarray(bbox)[:, :4].astype(np.int64)
+    if np.any((bbox[:, 2] <= bbox[:, 0]) | (bbox[:, 3] <= bbox[:, 1])):
+        raise Exception("Invalid bounding box with area of zero")
+    # Source rows and columns of each output pixel
+    y_lo, y_hi, wy_lo, wy_hi = _bilinear_sample_points(
+        bbox[:, 0], bbox[:, 2] - bbox[:, 0], mini_shape[0])
+    x_lo, x_hi, wx_lo, wx_hi = _bilinear_sample_points(
+        bbox[:, 1], bbox[:, 3] - bbox[:, 1], mini_shape[1])
+    # Gather the four neighbours of each output pixel: [N, height, width]
+    ids = np.arange(bbox.shape[0])[:, np.newaxis, np.newaxis]
+    y_lo, y_hi = y_lo[:, :, np.newaxis], y_hi[:, :, np.newaxis]
+    wy_lo, wy_hi = wy_lo[:, :, np.newaxis], wy_hi[:, :, np.newaxis]
+    x_lo, x_hi = x_lo[:, np.newaxis], x_hi[:, np.newaxis]
+    wx_lo, wx_hi = wx_lo[:, np.newaxis], wx_hi[:, np.newaxis]
+    # Cast to bool in case load_mask() returned wrong dtype
+    m = mask.astype(bool, copy=False)
+    v00, v01 = m[y_lo, x_lo, ids], m[y_lo, x_hi, ids]
+    v10, v11 = m[y_hi, x_lo, ids], m[y_hi, x_hi, ids]
+    values = wy_lo * (wx_lo * v00 + wx_hi * v01) + wy_hi * (wx_lo * v10 + wx_hi * v11)
+    # np.around() rounds 0.5 down to 0
+    mini_mask = values > 0.5
+    # resize() clips its output to the range of the input, so a box that's
+    # completely filled stays filled, including at the zero padded edges.
+    # Every pixel of the box is a neighbour of some output pixel, unless
+    # downsampling, in which case the edges don't reach into the padding.
+    solid = np.all(v00 & v01 & v10 & v11, axis=(1, 2))
+    mini_mask[solid] = True
+    return np.transpose(mini_mask, (1, 2, 0))
+
+
+def _resize_to_boxes(masks, heights, widths, max_elements=2**22):
+    """Resizes many small masks to the sizes of their boxes. Gives the same
+    values as calling resize() with bilinear interpolation on each of them.
+
+    The bilinear resize is separable, so it's done as two batched matrix
+    products with interpolation matrices. Masks are processed in chunks,
+    largest boxes first, and each chunk is computed in a frame the size
+    of the largest box in it.
+
+    masks: [N, height, width] Masks to resize.
+    heights, widths: [N] Target size of each mask.
+    max_elements: Approximate limit of the size of a chunk, in pixels.
+
+    Yields (ids, values) tuples for each chunk of masks, where ids are the
+    indices of the masks in the chunk and values is a float array
+    [len(ids), max height, max width] of the resized masks. Mask i of the
+    chunk is in values[i, :heights[ids[i]], :widths[ids[i]]].
+    """
+    masks = masks.astype(np.float64)
+    in_h, in_w = masks.shape[1:3]
+    # resize() clips its output to the value range of the input, but keeps
+    # the zero padding value if it's outside of that range.
+    mins = masks.min(axis=(1, 2)) if masks.size else np.zeros([masks.shape[0]])
+    maxs = masks.max(axis=(1, 2)) if masks.size else np.zeros([masks.shape[0]])
+
+    def interpolation_matrix(sizes, in_size):
+        """[n, max(sizes), in_size] matrix that resizes in_size samples to
+        sizes[i] samples. Rows beyond sizes[i] are zero."""
+        max_size = max(sizes.max(), 1)
+        out = np.arange(max_size)
+        coords = (out + 0.5) * (in_size / sizes.astype(np.float64))[:, np.newaxis] - 0.5
+        lo = np.floor(coords)
+        hi_weight = coords - lo
+        lo_weight = 1 - hi_weight
+        valid = out < sizes[:, np.newaxis]
+        matrix = np.zeros((sizes.shape[0], max_size, in_size + 2))
+        n = np.arange(sizes.shape[0])[:, np.newaxis]
+        # Shift by one so that neighbours at -1 and in_size land in the
+        # extra first and last columns, which are dropped (zero padding).
+        lo = np.where(valid, lo, 0).astype(np.int64) + 1
+        matrix[n, out, lo] += np.where(valid, lo_weight, 0)
+        matrix[n, out, lo + 1] += np.where(valid, hi_weight, 0)
+        return matrix[:, :, 1:-1]
+
+    order = np.argsort(-(heights.astype(np.int64) * widths), kind="stable")
+    start = 0
+    while start < order.shape[0]:
+        # Grow the chunk while its frame stays within the limit. Boxes get
+        # smaller along the order, but heights and widths on their own don't.
+        end = start + 1
+        max_h, max_w = heights[order[start]], widths[order[start]]
+        while end < order.shape[0]:
+            h = max(max_h, heights[order[end]])
+            w = max(max_w, widths[order[end]])
+            if (end - start + 1) * h * w > max_elements:
+                break
+            max_h, max_w = h, w
+            end += 1
+        ids = order[start:end]
+        start = end
+
+        ry = interpolation_matrix(heights[ids], in_h)  # [n, H, in_h]
+        rx = interpolation_matrix(widths[ids], in_w)  # [n, W, in_w]
+        values = np.matmul(np.matmul(ry, masks[ids]), np.transpose(rx, (0, 2, 1)))
+        zero = values == 0
+        values = np.clip(values, mins[ids, np.newaxis, np.newaxis],
+                         maxs[ids, np.newaxis, np.newaxis])
+        values[zero & (mins[ids] > 0)[:, np.newaxis, np.newaxis]] = 0
+        yield ids, values
+
+
+def expand_mask_batched(bbox, mini_mask, image_shape):
+    """Resizes mini masks back to image size. Reverses the change
+    of minimize_mask_batched(). Same as expand_mask() but resizes all
+    instances at once.
+    """
+    bbox = np.asarray(bbox)[:, :4].astype(np.int64)
+    mask = np.zeros(image_shape[:2] + (bbox.shape[0],), dtype=bool)
+    heights = bbox[:, 2] - bbox[:, 0]
+    widths = bbox[:, 3] - bbox[:, 1]
+    m = np.transpose(mini_mask, (2, 0, 1))
+    for ids, values in _resize_to_boxes(m, heights, widths):
+        # np.around() rounds 0.5 down to 0
+        values = values > 0.5
+        for i, v in zip(ids, values):
+            y1, x1, y2, x2 = bbox[i]
+            mask[y1:y2, x1:x2, i] = v[:y2 - y1, :x2 - x1]
+    return mask
+
+
 # TODO: Build and use this function to reduce code duplication
 def mold_mask(mask, config):
     pass
@@ -574,6 +1080,45 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def unmold_masks_cropped(masks, boxes):
+    """Batched version of unmold_mask() that returns the masks in the frame
+    of their bounding boxes instead of the full image.
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+
+    Returns a list of N binary masks, each of shape [y2 - y1, x2 - x1].
+    """
+    threshold = 0.5
+    boxes = np.asarray(boxes).astype(np.int64)
+    heights = boxes[:, 2] - boxes[:, 0]
+    widths = boxes[:, 3] - boxes[:, 1]
+    cropped = [None] * boxes.shape[0]
+    for ids, values in _resize_to_boxes(masks, heights, widths):
+        for i, v in zip(ids, values):
+            cropped[i] = v[:heights[i], :widths[i]] >= threshold
+    return cropped
+
+
+def unmold_masks(masks, boxes, image_shape):
+    """Batched version of unmold_mask(). Pastes all masks directly into
+    one preallocated array.
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+
+    Returns binary masks [height, width, N] of the size of the original image.
+    """
+    threshold = 0.5
+    boxes = np.asarray(boxes).astype(np.int64)
+    full_masks = np.zeros(tuple(image_shape[:2]) + (boxes.shape[0],), dtype=np.bool)
+    heights = boxes[:, 2] - boxes[:, 0]
+    widths = boxes[:, 3] - boxes[:, 1]
+    for ids, values in _resize_to_boxes(masks, heights, widths):
+        for i, v in zip(ids, values):
+            y1, x1, y2, x2 = boxes[i]
+            full_masks[y1:y2, x1:x2, i] = v[:y2 - y1, :x2 - x1] >= threshold
+    return full_masks
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -637,6 +1182,551 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class AnchorIndex(object):
+    """A spatial index over a fixed set of anchors to quickly find the
+    anchors that overlap a set of boxes, rather than computing the IoU of
+    every anchor with every box.
+
+    Anchors are grouped by size (roughly one group per FPN level) and, within
+    a group, bucketed into a grid of cells by their centers. The cell size of
+    a group is the largest anchor side in it, so only the cells around a box
+    can hold anchors that intersect it.
+
+    anchors: [N, (y1, x1, y2, x2)]. Usually the output of
+        generate_pyramid_anchors().
+    """
+
+    def __init__(self, anchors):
+        self.anchors = anchors
+        self.areas = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+        heights = anchors[:, 2] - anchors[:, 0]
+        widths = anchors[:, 3] - anchors[:, 1]
+        center_y = anchors[:, 0] + 0.5 * heights
+        center_x = anchors[:, 1] + 0.5 * widths
+        # Group by size. Anchors of one FPN level share a scale, and so
+        # land in the same group regardless of their ratio.
+        size_level = np.round(np.log2(np.sqrt(np.maximum(self.areas, 1))))
+        self.groups = []
+        for level in np.unique(size_level):
+            ids = np.where(size_level == level)[0]
+            cell = max(heights[ids].max(), widths[ids].max(), 1)
+            rows = np.floor(center_y[ids] / cell).astype(np.int64)
+            cols = np.floor(center_x[ids] / cell).astype(np.int64)
+            row0, col0 = rows.min(), cols.min()
+            num_rows = rows.max() - row0 + 1
+            num_cols = cols.max() - col0 + 1
+            keys = (rows - row0) * num_cols + (cols - col0)
+            order = np.argsort(keys, kind="stable")
+            self.groups.append({
+                "ids": ids[order],
+                "keys": keys[order],
+                "cell": cell,
+                "origin": (row0, col0),
+                "grid": (num_rows, num_cols),
+                # Largest distance from an anchor center to its edge
+                "reach": (heights[ids].max() / 2, widths[ids].max() / 2),
+            })
+
+    def query(self, boxes):
+        """Finds the anchors that intersect each box.
+
+        boxes: [M, (y1, x1, y2, x2)]
+
+        Returns:
+        anchor_ids: [K] Indices of anchors.
+        box_ids: [K] Indices of the box that each anchor intersects.
+        Every pair of an anchor and a box with a non-zero intersection area
+        is returned exactly once.
+        """
+        anchor_ids = []
+        box_ids = []
+        for group in self.groups:
+            cell = group["cell"]
+            row0, col0 = group["origin"]
+            num_rows, num_cols = group["grid"]
+            reach_y, reach_x = group["reach"]
+            # Range of cells whose anchors could reach into each box
+            r1 = np.clip(np.floor((boxes[:, 0] - reach_y) / cell) - row0, 0, num_rows - 1)
+            r2 = np.clip(np.floor((boxes[:, 2] + reach_y) / cell) - row0, 0, num_rows - 1)
+            c1 = np.clip(np.floor((boxes[:, 1] - reach_x) / cell) - col0, 0, num_cols - 1)
+            c2 = np.clip(np.floor((boxes[:, 3] + reach_x) / cell) - col0, 0, num_cols - 1)
+            r1, r2, c1, c2 = [x.astype(np.int64) for x in [r1, r2, c1, c2]]
+            # One entry per (box, row of cells). The cells of a row form a
+            # contiguous run of the sorted keys.
+            row_counts = r2 - r1 + 1
+            row_box = np.repeat(np.arange(boxes.shape[0]), row_counts)
+            row = r1[row_box] + np.arange(row_box.shape[0]) - \
+                np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+            start = np.searchsorted(group["keys"], row * num_cols + c1[row_box], "left")
+            end = np.searchsorted(group["keys"], row * num_cols + c2[row_box], "right")
+            # Expand the runs into (anchor, box) candidate pairs
+            lengths = end - start
+            pair_box = np.repeat(row_box, lengths)
+            pair_pos = np.arange(pair_box.shape[0]) + \
+                np.repeat(start - (np.cumsum(lengths) - lengths), lengths)
+            anchor_ids.append(group["ids"][pair_pos])
+            box_ids.append(pair_box)
+        anchor_ids = np.concatenate(anchor_ids).astype(np.int64)
+        box_ids = np.concatenate(box_ids).astype(np.int64)
+        # Drop candidates that don't actually intersect
+        a = self.anchors[anchor_ids]
+        b = boxes[box_ids]
+        hit = (np.minimum(a[:, 2], b[:, 2]) > np.maximum(a[:, 0], b[:, 0])) & \
+            (np.minimum(a[:, 3], b[:, 3]) > np.maximum(a[:, 1], b[:, 1]))
+        return anchor_ids[hit], box_ids[hit]
+
+    def overlaps(self, boxes):
+        """Computes the non-zero IoU overlaps between the anchors and boxes.
+        The values are identical to those of compute_overlaps(anchors, boxes);
+        all pairs that aren't returned have an IoU of 0.
+
+        boxes: [M, (y1, x1, y2, x2)]
+
+        Returns:
+        anchor_ids: [K] Indices of anchors.
+        box_ids: [K] Indices of boxes.
+        overlaps: [K] IoU of each (anchor, box) pair.
+        """
+        anchor_ids, box_ids = self.query(boxes)
+        box_areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        # Same operations as compute_iou() so the values match bit for bit
+        a = self.anchors[anchor_ids]
+        b = boxes[box_ids]
+        y1 = np.maximum(b[:, 0], a[:, 0])
+        y2 = np.minimum(b[:, 2], a[:, 2])
+        x1 = np.maximum(b[:, 1], a[:, 1])
+        x2 = np.minimum(b[:, 3], a[:, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = box_areas[box_ids] + self.areas[anchor_ids] - intersection
+        return anchor_ids, box_ids, intersection / union
+
+
+############################################################
+#  Tiling
+############################################################
+
+def compute_tiles(image_shape, tile_size, overlap):
+    """Splits an image into overlapping square tiles.
+
+    image_shape: [height, width, ...] of the image to split.
+    tile_size: Side length of the tiles in pixels.
+    overlap: Number of pixels shared by neighbouring tiles.
+
+    Tiles on the bottom and right edges are shifted inwards so that all
+    tiles have the same size. If the image is smaller than tile_size in
+    one dimension then the tiles span the full image in that dimension.
+
+    Returns: [N, (y1, x1, y2, x2)] tile windows in pixels.
+    """
+    assert 0 <= overlap < tile_size, "overlap must be smaller than tile_size"
+    step = tile_size - overlap
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        s = list(range(0, length - tile_size, step))
+        s.append(length - tile_size)
+        return s
+
+    h, w = image_shape[:2]
+    th, tw = min(h, tile_size), min(w, tile_size)
+    tiles = [(y, x, y + th, x + tw) for y in starts(h) for x in starts(w)]
+    return np.array(tiles, dtype=np.int32)
+
+
+def _paste_mask(window, box, mask):
+    """Renders a box-local mask into the given window.
+    window: [y1, x1, y2, x2] area to render, in image pixels.
+    box: [y1, x1, y2, x2] location of the mask in the image.
+    mask: [y2 - y1, x2 - x1] mask in the frame of box.
+
+    Returns: [wy2 - wy1, wx2 - wx1] binary mask. Parts of the mask outside
+    the window are cut off.
+    """
+    wy1, wx1, wy2, wx2 = window
+    y1, x1, y2, x2 = box
+    out = np.zeros((wy2 - wy1, wx2 - wx1), dtype=bool)
+    iy1, ix1 = max(y1, wy1), max(x1, wx1)
+    iy2, ix2 = min(y2, wy2), min(x2, wx2)
+    if iy2 > iy1 and ix2 > ix1:
+        out[iy1 - wy1:iy2 - wy1, ix1 - wx1:ix2 - wx1] = \
+            mask[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1]
+    return out
+
+
+def merge_tile_detections(tiles, tile_ids, boxes, class_ids, scores, masks,
+                          iou_threshold=0.5):
+    """Merges detections of overlapping tiles into one set of detections.
+
+    The same object is often detected in more than one tile when it lies on
+    a tile seam. Two detections of the same class that come from different
+    tiles are considered duplicates if the IoU of their masks, measured
+    inside the area covered by both tiles, is above iou_threshold. Groups of
+    duplicates are merged into one detection with the joined mask and the
+    highest score, so objects larger than the overlap are not cut at seams.
+    A group holds at most one detection per tile. Pairs are joined from the
+    highest IoU down, and a pair is skipped if it would put two detections
+    of the same tile in one group.
+
+    tiles: [T, (y1, x1, y2, x2)] tile windows in image pixels.
+    tile_ids: [N] index of the tile that produced each detection.
+    boxes: [N, (y1, x1, y2, x2)] detection boxes in image pixels.
+    class_ids: [N] int class IDs.
+    scores: [N] float scores.
+    masks: List of N box-local binary masks. Mask i has the shape
+        [y2 - y1, x2 - x1] of boxes[i].
+
+    Returns the merged detections, sorted by score from high to low:
+    boxes: [M, (y1, x1, y2, x2)], class_ids: [M], scores: [M] and
+    masks: list of M box-local binary masks.
+    """
+    # Candidate pairs: same class, different tiles and overlapping boxes
+    n = boxes.shape[0]
+    y1 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    x1 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    y2 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    x2 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    candidates = (y2 > y1) & (x2 > x1) & \
+        (class_ids[:, None] == class_ids[None, :]) & \
+        (tile_ids[:, None] != tile_ids[None, :])
+    pairs = np.argwhere(np.triu(candidates, 1))
+
+    # Mask IoU of the candidate pairs
+    matches = []
+    for i, j in pairs:
+        # Compare the masks in the area seen by both tiles, cropped to
+        # the two boxes.
+        t1, t2 = tiles[tile_ids[i]], tiles[tile_ids[j]]
+        window = (max(t1[0], t2[0], min(boxes[i, 0], boxes[j, 0])),
+                  max(t1[1], t2[1], min(boxes[i, 1], boxes[j, 1])),
+                  min(t1[2], t2[2], max(boxes[i, 2], boxes[j, 2])),
+                  min(t1[3], t2[3], max(boxes[i, 3], boxes[j, 3])))
+        if window[2] <= window[0] or window[3] <= window[1]:
+            continue
+        m1 = _paste_mask(window, boxes[i], masks[i])
+        m2 = _paste_mask(window, boxes[j], masks[j])
+        if not np.any(m1 | m2):
+            continue
+        iou = compute_overlaps_masks(m1[..., None], m2[..., None])[0, 0]
+        if iou > iou_threshold:
+            matches.append((iou, i, j))
+
+    # Group duplicates with a union-find, best matches first. Two groups
+    # are only joined if no tile has detections in both. Otherwise two
+    # instances of one tile, such as touching nuclei cut by a seam, would
+    # be merged through a detection of the neighbouring tile that overlaps
+    # both of them.
+    parent = np.arange(n)
+    group_tiles = [{t} for t in tile_ids]
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for _, i, j in sorted(matches, key=lambda m: m[0], reverse=True):
+        root_i, root_j = find(i), find(j)
+        if root_i == root_j or group_tiles[root_i] & group_tiles[root_j]:
+            continue
+        parent[root_i] = root_j
+        group_tiles[root_j] |= group_tiles[root_i]
+
+    # Merge each group into one detection
+    roots = np.array([find(i) for i in range(n)], dtype=np.int64)
+    merged_boxes, merged_class_ids, merged_scores, merged_masks = [], [], [], []
+    for root in np.unique(roots):
+        ix = np.where(roots == root)[0]
+        box = np.concatenate([boxes[ix, :2].min(axis=0),
+                              boxes[ix, 2:].max(axis=0)])
+        mask = np.zeros((box[2] - box[0], box[3] - box[1]), dtype=bool)
+        for i in ix:
+            mask |= _paste_mask(box, boxes[i], masks[i])
+        merged_boxes.append(box)
+        merged_class_ids.append(class_ids[ix[0]])
+        merged_scores.append(scores[ix].max())
+        merged_masks.append(mask)
+
+    # Sort by score
+    order = np.argsort(merged_scores)[::-1]
+    boxes = np.array(merged_boxes, dtype=boxes.dtype).reshape([-1, 4])[order]
+    class_ids = np.array(merged_class_ids, dtype=class_ids.dtype)[order]
+    scores = np.array(merged_scores, dtype=scores.dtype)[order]
+    masks = [merged_masks[i] for i in order]
+    return boxes, class_ids, scores, masks
+
+
+############################################################
+#  Test-time Augmentation
+############################################################
+
+# The 8 dihedral views of an image as (rotations, flip) tuples: the number
+# of 90 degree counter-clockwise rotations, followed by an optional left-right
+# flip. These are the images that the flips and rotations of the braintissue
+# training augmentation produce.
+DIHEDRAL_VIEWS = [(k, flip) for flip in [False, True] for k in range(4)]
+
+
+def dihedral_transform(image, view):
+    """Rotates and flips an image into one of its dihedral views.
+    image: [height, width, ...] array.
+    view: (rotations, flip) tuple. See DIHEDRAL_VIEWS.
+
+    Returns the view. Height and width are swapped for odd rotations.
+    """
+    k, flip = view
+    image = np.rot90(image, k, axes=(0, 1))
+    if flip:
+        image = image[:, ::-1]
+    return np.ascontiguousarray(image)
+
+
+def invert_dihedral_detections(boxes, masks, view_shape, view):
+    """Maps detections made on a view of an image back to the frame of the
+    image. The inverse of dihedral_transform().
+    boxes: [N, (y1, x1, y2, x2)] boxes in pixels of the view.
+    masks: List of N box-local masks, each of shape [y2 - y1, x2 - x1].
+    view_shape: [height, width, ...] of the view.
+    view: (rotations, flip) tuple the view was made with.
+
+    Returns:
+    boxes: [N, (y1, x1, y2, x2)] boxes in pixels of the image.
+    masks: List of N box-local masks in the frame of the image.
+    """
+    k, flip = view
+    boxes = np.array(boxes).reshape([-1, 4])
+    height, width = view_shape[:2]
+    if flip:
+        boxes[:, [1, 3]] = width - boxes[:, [3, 1]]
+        masks = [m[:, ::-1] for m in masks]
+    # Undo the rotations one clockwise turn at a time
+    for _ in range(k):
+        boxes = np.stack([boxes[:, 1], height - boxes[:, 2],
+                          boxes[:, 3], height - boxes[:, 0]], axis=1)
+        height, width = width, height
+    masks = [np.ascontiguousarray(np.rot90(m, -k)) for m in masks]
+    return boxes, masks
+
+
+def merge_tta_detections(view_ids, boxes, class_ids, scores, masks,
+                         view_count, iou_threshold=0.5, nms_threshold=0.3):
+    """Fuses the detections of several views of one image, mapped back to
+    the frame of the image, with weighted mask voting and non-max
+    suppression.
+
+    Detections are visited from the highest score down. Each one that isn't
+    grouped yet starts a group with the detections of the same class whose
+    mask IoU with it is above iou_threshold, keeping the best one of each
+    view. The masks of a group vote for each pixel with their scores, and
+    the pixels that get more than half of the votes form the fused mask.
+    The score of a group is the sum of its scores divided by view_count, so
+    objects found in few views rank lower. Fused detections that still
+    overlap are removed with non_max_suppression().
+
+    view_ids: [N] index of the view that produced each detection.
+    boxes: [N, (y1, x1, y2, x2)] detection boxes in image pixels.
+    class_ids: [N] int class IDs.
+    scores: [N] float scores.
+    masks: List of N box-local binary masks. Mask i has the shape
+        [y2 - y1, x2 - x1] of boxes[i].
+    view_count: Number of views the detections come from.
+    iou_threshold: Mask IoU above which detections are grouped.
+    nms_threshold: Box IoU threshold of the final non-max suppression.
+
+    Returns the fused detections, sorted by score from high to low:
+    boxes: [M, (y1, x1, y2, x2)] tight boxes of the fused masks,
+    class_ids: [M], scores: [M] and masks: list of M box-local binary masks.
+    """
+    boxes = np.asarray(boxes).astype(np.int32).reshape([-1, 4])
+    n = boxes.shape[0]
+    fused_boxes, fused_class_ids, fused_scores, fused_masks = [], [], [], []
+    if n > 0:
+        # Empty masks have a NaN IoU and don't join any group
+        overlaps = compute_overlaps_masks_sparse((boxes, masks), (boxes, masks))
+        candidates = (np.nan_to_num(overlaps) > iou_threshold) & \
+            (class_ids[:, None] == class_ids[None, :])
+    grouped = np.zeros([n], dtype=bool)
+    for i in np.argsort(scores)[::-1]:
+        if grouped[i]:
+            continue
+        # The group starts with detection i. Other detections of the same
+        # view are duplicates and are dropped.
+        others = np.where(candidates[i] & ~grouped)[0]
+        others = others[others != i]
+        ix = np.concatenate([[i], others[np.argsort(scores[others])[::-1]]])
+        grouped[ix] = True
+        _, first = np.unique(view_ids[ix], return_index=True)
+        members = ix[np.sort(first)]
+
+        # Weighted mask voting
+        window = np.concatenate([boxes[members, :2].min(axis=0),
+                                 boxes[members, 2:].max(axis=0)])
+        votes = np.zeros(window[2:] - window[:2], dtype=np.float32)
+        for j in members:
+            votes += scores[j] * _paste_mask(window, boxes[j], masks[j])
+        mask = votes > 0.5 * np.sum(scores[members])
+        if not np.any(mask):
+            continue
+        # Crop the fused mask to its bounding box
+        y1, x1, y2, x2 = extract_bboxes(mask[..., None])[0]
+        fused_boxes.append([window[0] + y1, window[1] + x1,
+                            window[0] + y2, window[1] + x2])
+        fused_class_ids.append(class_ids[i])
+        fused_scores.append(np.sum(scores[members]) / view_count)
+        fused_masks.append(mask[y1:y2, x1:x2])
+
+    boxes = np.array(fused_boxes, dtype=np.int32).reshape([-1, 4])
+    class_ids = np.array(fused_class_ids, dtype=np.int32)
+    scores = np.array(fused_scores, dtype=np.float32)
+    if boxes.shape[0] == 0:
+        return boxes, class_ids, scores, []
+    keep = non_max_suppression(boxes, scores, nms_threshold, class_ids=class_ids)
+    return boxes[keep], class_ids[keep], scores[keep], [fused_masks[i] for i in keep]
+
+
+############################################################
+#  Instance Masks
+############################################################
+
+class InstanceMasks(object):
+    """A compact container of the instance masks of one image.
+
+    Holds the masks either cropped to their bounding boxes or as RLE runs
+    (see mrcnn.rle), so memory scales with the size of the objects rather
+    than with the size of the image times the number of instances. Full
+    image sized masks are only built when requested.
+
+    image_shape: [height, width, ...] of the image the masks belong to.
+    boxes: [N, (y1, x1, y2, x2)] Location of cropped masks. Required with
+        cropped and ignored otherwise.
+    cropped: List of N masks, each of shape [y2 - y1, x2 - x1].
+    runs: List of N RLE runs arrays [run_count, (start, length)].
+    Pass either cropped or runs.
+    """
+
+    def __init__(self, image_shape, boxes=None, cropped=None, runs=None):
+        assert (cropped is None) != (runs is None), "Pass either cropped or runs"
+        self.image_shape = tuple(image_shape[:2])
+        if cropped is not None:
+            assert boxes is not None, "Cropped masks require boxes"
+            self._boxes = np.asarray(boxes).astype(np.int32).reshape([-1, 4])
+            assert self._boxes.shape[0] == len(cropped)
+            self._cropped = list(cropped)
+        else:
+            self._boxes = None
+            self._cropped = None
+        self._runs = list(runs) if runs is not None else None
+        self._area = None
+        self._bbox = None
+
+    @classmethod
+    def from_dense(cls, masks):
+        """Creates a container from dense [height, width, N] masks."""
+        boxes = extract_bboxes_batched(masks)
+        cropped = [masks[y1:y2, x1:x2, i].astype(bool)
+                   for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return cls(masks.shape, boxes=boxes, cropped=cropped)
+
+    @property
+    def format(self):
+        """The format the masks are stored in: "cropped" or "rle"."""
+        return "cropped" if self._cropped is not None else "rle"
+
+    def __len__(self):
+        return len(self._cropped if self._cropped is not None else self._runs)
+
+    def __getitem__(self, i):
+        """Returns the [height, width] mask of instance i."""
+        if self._cropped is not None:
+            mask = np.zeros(self.image_shape, dtype=bool)
+            y1, x1, y2, x2 = self._boxes[i]
+            mask[y1:y2, x1:x2] = self._cropped[i]
+            return mask
+        return rle.decode(self._runs[i], self.image_shape)
+
+    def to_dense(self):
+        """Returns all masks as a [height, width, N] array."""
+        masks = np.zeros(self.image_shape + (len(self),), dtype=bool)
+        if self._cropped is not None:
+            for i, (y1, x1, y2, x2) in enumerate(self._boxes):
+                masks[y1:y2, x1:x2, i] = self._cropped[i]
+        else:
+            for i, runs in enumerate(self._runs):
+                masks[:, :, i] = rle.decode(runs, self.image_shape)
+        return masks
+
+    def cropped(self):
+        """Returns the masks cropped to their bounding boxes.
+
+        Returns:
+        boxes: [N, (y1, x1, y2, x2)]
+        masks: List of N masks, each of shape [y2 - y1, x2 - x1].
+        """
+        if self._cropped is None:
+            self._boxes = self.bbox
+            self._cropped = [
+                self[i][y1:y2, x1:x2] for i, (y1, x1, y2, x2) in enumerate(self._boxes)]
+        return self._boxes, self._cropped
+
+    def rle(self):
+        """Returns the masks as a list of RLE runs. See mrcnn.rle."""
+        if self._runs is None:
+            self._runs = [rle.encode_cropped(m, b, self.image_shape)
+                          for m, b in zip(self._cropped, self._boxes)]
+        return self._runs
+
+    @property
+    def area(self):
+        """[N] Number of pixels of each mask."""
+        if self._area is None:
+            if self._runs is not None:
+                self._area = np.array([np.sum(r[:, 1]) for r in self._runs],
+                                      dtype=np.int64)
+            else:
+                self._area = np.array([np.sum(m) for m in self._cropped],
+                                      dtype=np.int64)
+        return self._area
+
+    @property
+    def bbox(self):
+        """[N, (y1, x1, y2, x2)] Tight bounding boxes of the masks. Empty
+        masks get zero boxes, like extract_bboxes()."""
+        if self._bbox is None:
+            if self._cropped is not None:
+                self._bbox = np.zeros([len(self), 4], dtype=np.int32)
+                for i, m in enumerate(self._cropped):
+                    if m.size:
+                        b = extract_bboxes_batched(m[:, :, np.newaxis])[0]
+                        if b[2] > b[0]:
+                            self._bbox[i] = b + np.tile(self._boxes[i, :2], 2)
+            else:
+                self._bbox = np.array([rle.bbox(r, self.image_shape) for r in self._runs],
+                                      dtype=np.int32).reshape([-1, 4])
+        return self._bbox
+
+    def iou(self, other):
+        """Computes IoU overlaps between these masks and the masks of another
+        container of the same image, directly on their RLE runs.
+
+        Returns: [N, M] float32 matrix, like compute_overlaps_masks().
+        """
+        assert self.image_shape == other.image_shape, "Masks of different images"
+        overlaps = np.zeros([len(self), len(other)], dtype=np.float32)
+        if not len(self) or not len(other):
+            return overlaps
+        runs1, runs2 = self.rle(), other.rle()
+        area1, area2 = self.area, other.area
+        # Only masks with overlapping bounding boxes can intersect
+        b1, b2 = self.bbox, other.bbox
+        candidates = np.argwhere(
+            (np.minimum(b1[:, None, 2], b2[None, :, 2]) > np.maximum(b1[:, None, 0], b2[None, :, 0])) &
+            (np.minimum(b1[:, None, 3], b2[None, :, 3]) > np.maximum(b1[:, None, 1], b2[None, :, 1])))
+        for i, j in candidates:
+            intersection = rle.intersection(runs1[i], runs2[j])
+            overlaps[i, j] = intersection / (area1[i] + area2[j] - intersection)
+        return overlaps
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -651,22 +1741,76 @@ def trim_zeros(x):
     return x[~np.all(x == 0, axis=1)]
 
 
-def compute_matches(gt_boxes, gt_class_ids, gt_masks,
-                    pred_boxes, pred_class_ids, pred_scores, pred_masks,
-                    iou_threshold=0.5, score_threshold=0.0):
-    """Finds matches between prediction and ground truth instances.
+def _greedy_matches(overlaps, pred_class_ids, gt_class_ids, iou_thresholds,
+                    score_threshold=0.0):
+    """Greedy matching of predictions to ground truth at several IoU
+    thresholds at once.
+
+    overlaps: [pred_count, gt_count] IoU overlaps. Predictions sorted by
+        score from high to low.
+    pred_class_ids, gt_class_ids: Class IDs of the predictions and GT.
+    iou_thresholds: [threshold_count] IoU thresholds.
 
     Returns:
-        gt_match: 1-D array. For each GT box it has the index of the matched
-                  predicted box.
-        pred_match: 1-D array. For each predicted box, it has the index of
-                    the matched ground truth box.
+        gt_match: [threshold_count, gt_count] Index of the matched prediction
+                  for each GT instance at each threshold, or -1.
+        pred_match: [threshold_count, pred_count] Index of the matched GT
+                    instance for each prediction at each threshold, or -1.
+    """
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64).reshape([-1])
+    pred_match = -1 * np.ones([iou_thresholds.shape[0], overlaps.shape[0]])
+    gt_match = -1 * np.ones([iou_thresholds.shape[0], overlaps.shape[1]])
+    if overlaps.size == 0:
+        return gt_match, pred_match
+    # Pairs below the lowest threshold can't match at any threshold
+    min_iou = max(iou_thresholds.min(), score_threshold)
+    same_class = pred_class_ids[:, None] == gt_class_ids[None, :]
+    candidate = same_class & (overlaps >= min_iou)
+    gt_taken = np.zeros(gt_match.shape, dtype=bool)
+    for i in np.where(np.any(candidate, axis=1))[0]:
+        # Candidates sorted by IoU from high to low, as compute_matches()
+        # has always ordered them. A GT instance of another class doesn't
+        # stop the search, so drop those up front.
+        sorted_ixs = np.argsort(overlaps[i])[::-1]
+        sorted_ixs = sorted_ixs[candidate[i, sorted_ixs]]
+        iou = overlaps[i, sorted_ixs]
+        # [thresholds, candidates] Free GT instances above each threshold.
+        # The match is the first one in the sorted order.
+        free = ~gt_taken[:, sorted_ixs] & (iou[None, :] >= iou_thresholds[:, None])
+        t = np.where(np.any(free, axis=1))[0]
+        j = sorted_ixs[np.argmax(free[t], axis=1)]
+        gt_taken[t, j] = True
+        gt_match[t, j] = i
+        pred_match[t, i] = j
+    return gt_match, pred_match
+
+
+def compute_matches_range(gt_boxes, gt_class_ids, gt_masks,
+                          pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                          iou_thresholds, score_threshold=0.0):
+    """Finds matches between prediction and ground truth instances at
+    several IoU thresholds. The mask overlaps are computed once and shared
+    by all thresholds.
+
+    gt_masks, pred_masks: [Height, Width, instances] masks, InstanceMasks,
+        or (boxes, cropped) tuples. See compute_overlaps_masks_sparse().
+
+    Returns:
+        gt_match: [thresholds, gt_boxes]. For each threshold and GT box it
+                  has the index of the matched predicted box.
+        pred_match: [thresholds, pred_boxes]. For each threshold and
+                    predicted box, it has the index of the matched ground
+                    truth box.
         overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
+    # Masks cropped to their boxes. Dense masks, InstanceMasks, and
+    # (boxes, cropped) tuples are all accepted.
+    gt_mask_boxes, gt_masks = cropped_masks(gt_masks)
+    pred_mask_boxes, pred_masks = cropped_masks(pred_masks)
     # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
-    gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+    gt_masks = (gt_mask_boxes[:gt_boxes.shape[0]], gt_masks[:gt_boxes.shape[0]])
     pred_boxes = trim_zeros(pred_boxes)
     pred_scores = pred_scores[:pred_boxes.shape[0]]
     # Sort predictions by score from high to low
@@ -674,62 +1818,48 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
     pred_boxes = pred_boxes[indices]
     pred_class_ids = pred_class_ids[indices]
     pred_scores = pred_scores[indices]
-    pred_masks = pred_masks[..., indices]
+    pred_masks = (pred_mask_boxes[indices], [pred_masks[i] for i in indices])
 
     # Compute IoU overlaps [pred_masks, gt_masks]
-    overlaps = compute_overlaps_masks(pred_masks, gt_masks)
-
-    # Loop through predictions and find matching ground truth boxes
-    match_count = 0
-    pred_match = -1 * np.ones([pred_boxes.shape[0]])
-    gt_match = -1 * np.ones([gt_boxes.shape[0]])
-    for i in range(len(pred_boxes)):
-        # Find best matching ground truth box
-        # 1. Sort matches by score
-        sorted_ixs = np.argsort(overlaps[i])[::-1]
-        # 2. Remove low scores
-        low_score_idx = np.where(overlaps[i, sorted_ixs] < score_threshold)[0]
-        if low_score_idx.size > 0:
-            sorted_ixs = sorted_ixs[:low_score_idx[0]]
-        # 3. Find the match
-        for j in sorted_ixs:
-            # If ground truth box is already matched, go to next one
-            if gt_match[j] > -1:
-                continue
-            # If we reach IoU smaller than the threshold, end the loop
-            iou = overlaps[i, j]
-            if iou < iou_threshold:
-                break
-            # Do we have a match?
-            if pred_class_ids[i] == gt_class_ids[j]:
-                match_count += 1
-                gt_match[j] = i
-                pred_match[i] = j
-                break
+    overlaps = compute_overlaps_masks_sparse(pred_masks, gt_masks)
 
+    gt_match, pred_match = _greedy_matches(
+        overlaps, pred_class_ids, gt_class_ids[:gt_boxes.shape[0]],
+        iou_thresholds, score_threshold)
     return gt_match, pred_match, overlaps
 
 
-def compute_ap(gt_boxes, gt_class_ids, gt_masks,
-               pred_boxes, pred_class_ids, pred_scores, pred_masks,
-               iou_threshold=0.5):
-    """Compute Average Precision at a set IoU threshold (default 0.5).
+def compute_matches(gt_boxes, gt_class_ids, gt_masks,
+                    pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                    iou_threshold=0.5, score_threshold=0.0):
+    """Finds matches between prediction and ground truth instances.
 
     Returns:
-    mAP: Mean Average Precision
-    precisions: List of precisions at different class score thresholds.
-    recalls: List of recall values at different class score thresholds.
-    overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+        gt_match: 1-D array. For each GT box it has the index of the matched
+                  predicted box.
+        pred_match: 1-D array. For each predicted box, it has the index of
+                    the matched ground truth box.
+        overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
-    # Get matches and overlaps
-    gt_match, pred_match, overlaps = compute_matches(
+    gt_match, pred_match, overlaps = compute_matches_range(
         gt_boxes, gt_class_ids, gt_masks,
         pred_boxes, pred_class_ids, pred_scores, pred_masks,
-        iou_threshold)
+        [iou_threshold], score_threshold)
+    return gt_match[0], pred_match[0], overlaps
 
+
+def _ap_from_matches(matched, gt_count):
+    """Computes Average Precision from the match flags of predictions
+    sorted by score from high to low.
+
+    matched: [pred_count] True for predictions that matched a GT instance.
+    gt_count: Number of GT instances.
+
+    Returns: mAP, precisions, recalls
+    """
     # Compute precision and recall at each prediction box step
-    precisions = np.cumsum(pred_match > -1) / (np.arange(len(pred_match)) + 1)
-    recalls = np.cumsum(pred_match > -1).astype(np.float32) / len(gt_match)
+    precisions = np.cumsum(matched) / (np.arange(len(matched)) + 1)
+    recalls = np.cumsum(matched).astype(np.float32) / gt_count
 
     # Pad with start and end values to simplify the math
     precisions = np.concatenate([[0], precisions, [0]])
@@ -738,31 +1868,54 @@ def compute_ap(gt_boxes, gt_class_ids, gt_masks,
     # Ensure precision values decrease but don't increase. This way, the
     # precision value at each recall threshold is the maximum it can be
     # for all following recall thresholds, as specified by the VOC paper.
-    for i in range(len(precisions) - 2, -1, -1):
-        precisions[i] = np.maximum(precisions[i], precisions[i + 1])
+    precisions = np.maximum.accumulate(precisions[::-1])[::-1]
 
     # Compute mean AP over recall range
     indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
     mAP = np.sum((recalls[indices] - recalls[indices - 1]) *
                  precisions[indices])
+    return mAP, precisions, recalls
+
+
+def compute_ap(gt_boxes, gt_class_ids, gt_masks,
+               pred_boxes, pred_class_ids, pred_scores, pred_masks,
+               iou_threshold=0.5):
+    """Compute Average Precision at a set IoU threshold (default 0.5).
+
+    Returns:
+    mAP: Mean Average Precision
+    precisions: List of precisions at different class score thresholds.
+    recalls: List of recall values at different class score thresholds.
+    overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+    """
+    # Get matches and overlaps
+    gt_match, pred_match, overlaps = compute_matches(
+        gt_boxes, gt_class_ids, gt_masks,
+        pred_boxes, pred_class_ids, pred_scores, pred_masks,
+        iou_threshold)
 
+    mAP, precisions, recalls = _ap_from_matches(pred_match > -1, len(gt_match))
     return mAP, precisions, recalls, overlaps
 
 
 def compute_ap_range(gt_box, gt_class_id, gt_mask,
                      pred_box, pred_class_id, pred_score, pred_mask,
                      iou_thresholds=None, verbose=1):
-    """Compute AP over a range or IoU thresholds. Default range is 0.5-0.95."""
+    """Compute AP over a range or IoU thresholds. Default range is 0.5-0.95.
+    To accumulate AP and AR over a dataset, use mrcnn.evaluate.Evaluator.
+    """
     # Default is 0.5 to 0.95 with increments of 0.05
-    iou_thresholds = iou_thresholds or np.arange(0.5, 1.0, 0.05)
-    
-    # Compute AP over range of IoU thresholds
+    if iou_thresholds is None:
+        iou_thresholds = np.arange(0.5, 1.0, 0.05)
+
+    # Match once for all thresholds, then compute AP for each of them
+    gt_match, pred_match, overlaps = compute_matches_range(
+        gt_box, gt_class_id, gt_mask,
+        pred_box, pred_class_id, pred_score, pred_mask,
+        iou_thresholds)
     AP = []
-    for iou_threshold in iou_thresholds:
-        ap, precisions, recalls, overlaps =\
-            compute_ap(gt_box, gt_class_id, gt_mask,
-                        pred_box, pred_class_id, pred_score, pred_mask,
-                        iou_threshold=iou_threshold)
+    for iou_threshold, matches in zip(iou_thresholds, pred_match):
+        ap, _, _ = _ap_from_matches(matches > -1, gt_match.shape[1])
         if verbose:
             print("AP @{:.2f}:\t {:.3f}".format(iou_threshold, ap))
         AP.append(ap)
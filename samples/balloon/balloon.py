@@ -249,24 +249,27 @@ def detect_and_color_splash(model, image_path=None, video_path=None):
                                   cv2.VideoWriter_fourcc(*'MJPG'),
                                   fps, (width, height))
 
-        count = 0
-        success = True
-        while success:
-            print("frame: ", count)
-            # Read next image
-            success, image = vcapture.read()
-            if success:
+        def read_frames():
+            while True:
+                # Read next image
+                success, image = vcapture.read()
+                if not success:
+                    return
                 # OpenCV returns images as BGR, convert to RGB
                 image = image[..., ::-1]
-                # Detect objects
-                r = model.detect([image], verbose=0)[0]
-                # Color splash
-                splash = color_splash(image, r['masks'])
-                # RGB -> BGR to save image to video
-                splash = splash[..., ::-1]
-                # Add image to video writer
-                vwriter.write(splash)
-                count += 1
+                # Key each frame with itself to get it back with its results
+                yield image, image
+
+        # Detect objects
+        results = model.detect_many(read_frames(), verbose=0, keyed=True)
+        for count, (image, r) in enumerate(results):
+            print("frame: ", count)
+            # Color splash
+            splash = color_splash(image, r['masks'])
+            # RGB -> BGR to save image to video
+            splash = splash[..., ::-1]
+            # Add image to video writer
+            vwriter.write(splash)
         vwriter.release()
     print("Saved to ", file_name)
 
@@ -24,6 +24,15 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
     # Generate submission file
     python3 Braintissue.py detect --dataset=/path/to/dataset --subset=train --weights=<last or /path/to/weights.h5>
+
+    # Generate submission file with flip and rotation test-time augmentation
+    python3 Braintissue.py detect --dataset=/path/to/dataset --subset=train --weights=<last or /path/to/weights.h5> --tta
+
+    # Compute COCO-style AP and AR on the validation images
+    python3 Braintissue.py evaluate --dataset=/path/to/dataset --subset=val --weights=<last or /path/to/weights.h5>
+
+    # Serve the model to local clients over HTTP (see mrcnn/server.py)
+    python3 Braintissue.py serve --weights=<last or /path/to/weights.h5> --port=8765
 """
 
 # Set matplotlib backend
@@ -58,6 +67,9 @@ from mrcnn.config import Config
 from mrcnn import utils
 from mrcnn import model as modellib
 from mrcnn import visualize
+from mrcnn import rle
+from mrcnn import evaluate as evaluation
+from mrcnn import server
 
 from braintissue_config import *
 
@@ -177,6 +189,14 @@ class BraintissueDataset(utils.Dataset):
         else:
             super(self.__class__, self).image_reference(image_id)
 
+    def gt_version(self, image_id):
+        """Adds the mask files of the image, which the GT cache can't see."""
+        info = self.image_info[image_id]
+        mask_dirs = [os.path.join(os.path.dirname(info['path']), d)
+                     for d in ["tissue_masks", "magnetic_masks"]]
+        return super(BraintissueDataset, self).gt_version(image_id) + \
+            [utils.file_version(d) for d in mask_dirs]
+
 
 ############################################################
 #  Training
@@ -233,33 +253,13 @@ def rle_encode(mask):
     """Encodes a mask in Run Length Encoding (RLE).
     Returns a string of space-separated values.
     """
-    assert mask.ndim == 2, "Mask must be of shape [Height, Width]"
-    # Flatten it column wise
-    m = mask.T.flatten()
-    # Compute gradient. Equals 1 or -1 at transition points
-    g = np.diff(np.concatenate([[0], m, [0]]), n=1)
-    # 1-based indicies of transition points (where gradient != 0)
-    rle = np.where(g != 0)[0].reshape([-1, 2]) + 1
-    # Convert second index in each pair to lenth
-    rle[:, 1] = rle[:, 1] - rle[:, 0]
-    return " ".join(map(str, rle.flatten()))
-
-
-def rle_decode(rle, shape):
+    return rle.to_string(rle.encode(mask))
+
+
+def rle_decode(rle_string, shape):
     """Decodes an RLE encoded list of space separated
     numbers and returns a binary mask."""
-    rle = list(map(int, rle.split()))
-    rle = np.array(rle, dtype=np.int32).reshape([-1, 2])
-    rle[:, 1] += rle[:, 0]
-    rle -= 1
-    mask = np.zeros([shape[0] * shape[1]], np.bool)
-    for s, e in rle:
-        assert 0 <= s < mask.shape[0]
-        assert 1 <= e <= mask.shape[0], "shape: {}  s {}  e {}".format(shape, s, e)
-        mask[s:e] = 1
-    # Reshape and transpose
-    mask = mask.reshape([shape[1], shape[0]]).T
-    return mask
+    return rle.decode(rle.from_string(rle_string), shape)
 
 
 def mask_to_rle(image_id, mask, scores):
@@ -273,15 +273,10 @@ def mask_to_rle(image_id, mask, scores):
     # then take the maximum across the last dimension
     order = np.argsort(scores)[::-1] + 1  # 1-based descending
     mask = np.max(mask * np.reshape(order, [1, 1, -1]), -1)
-    # Loop over instance masks
-    lines = []
-    for o in order:
-        m = np.where(mask == o, 1, 0)
-        # Skip if empty
-        if m.sum() == 0.0:
-            continue
-        rle = rle_encode(m)
-        lines.append("{}, {}".format(image_id, rle))
+    # Encode all instance masks in one pass, skipping empty ones
+    runs = dict(zip(*rle.encode_labels(mask)))
+    lines = ["{}, {}".format(image_id, rle.to_string(runs[o]))
+             for o in order if o in runs]
     return "\n".join(lines)
 
 
@@ -289,8 +284,11 @@ def mask_to_rle(image_id, mask, scores):
 #  Detection
 ############################################################
 
-def detect(model, dataset_dir, subset):
-    """Run detection on images in the given directory."""
+def detect(model, dataset_dir, subset, tta=False):
+    """Run detection on images in the given directory.
+    tta: Fuse the detections of the flipped and rotated views of each image.
+        See MaskRCNN.detect_tta().
+    """
     print("Running on {}".format(dataset_dir))
 
     # Create directory
@@ -304,32 +302,57 @@ def detect(model, dataset_dir, subset):
     dataset = BraintissueDataset()
     dataset.load_braintissue(dataset_dir, subset)
     dataset.prepare()
-    # Load over images
-    submission = []
-    for image_id in dataset.image_ids:
-        # Load image and run detection
-        image = dataset.load_image(image_id)
-        # Detect objects
-        r = model.detect([image], verbose=0)[0]
-        # Encode image to RLE. Returns a string of multiple lines
-        source_id = dataset.image_info[image_id]["id"]
-        rle = mask_to_rle(source_id, r["masks"], r["scores"])
-        submission.append(rle)
-        # Save image with masks
-        visualize.display_instances(
-            image, r['rois'], r['masks'], r['class_ids'],
-            dataset.class_names, r['scores'],
-            show_bbox=False, show_mask=False,
-            title="Predictions")
-        plt.savefig("{}/{}.png".format(submit_dir, dataset.image_info[image_id]["id"]))
-
-    # Save to csv file
-    submission = "ImageId,EncodedPixels\n" + "\n".join(submission)
+    # Load over images. Each image is keyed with its ID and the image
+    # itself, which is needed again to draw the results.
+    def load_images():
+        for image_id in dataset.image_ids:
+            image = dataset.load_image(image_id)
+            yield (image_id, image), image
+
+    def encode_images():
+        if tta:
+            results = ((key, model.detect_tta(image)) for key, image in load_images())
+        else:
+            # Loads and molds images in background threads while the
+            # model runs
+            results = model.detect_pipelined(load_images(), verbose=0, keyed=True)
+        for (image_id, image), r in results:
+            # Encode image to RLE. Returns a string of multiple lines
+            source_id = dataset.image_info[image_id]["id"]
+            encoded = mask_to_rle(source_id, r["masks"], r["scores"])
+            # Save image with masks
+            visualize.display_instances(
+                image, r['rois'], r['masks'], r['class_ids'],
+                dataset.class_names, r['scores'],
+                show_bbox=False, show_mask=False,
+                title="Predictions")
+            plt.savefig("{}/{}.png".format(submit_dir, dataset.image_info[image_id]["id"]))
+            yield encoded
+
+    # Save to csv file as the images are processed
     file_path = os.path.join(submit_dir, "submit.csv")
-    with open(file_path, "w") as f:
-        f.write(submission)
+    rle.write_csv(file_path, encode_images())
     print("Saved to ", submit_dir)
 
+############################################################
+#  Evaluation
+############################################################
+
+def evaluate(model, dataset_dir, subset):
+    """Computes COCO-style AP and AR of the model on the given subset.
+    Images are processed in batches and only match statistics are kept,
+    so memory doesn't grow with the number of images."""
+    print("Evaluating on {}".format(dataset_dir))
+
+    # Read dataset
+    dataset = BraintissueDataset()
+    dataset.load_braintissue(dataset_dir, subset)
+    dataset.prepare()
+
+    evaluator = evaluation.Evaluator(iou_type="segm")
+    evaluation.evaluate_model(model, dataset, evaluator)
+    return evaluator.summarize(class_names=dataset.class_names)
+
 ############################################################
 #  Config saving
 ############################################################
@@ -365,7 +388,7 @@ if __name__ == '__main__':
         description='Mask R-CNN for braintissue wafer segmentation')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'detect'")
+                        help="'train', 'detect', 'evaluate' or 'serve'")
     parser.add_argument('--dataset', required=False,
                         metavar="/path/to/dataset/",
                         help='Root directory of the dataset')
@@ -379,12 +402,19 @@ if __name__ == '__main__':
     parser.add_argument('--subset', required=False,
                         metavar="Dataset sub-directory",
                         help="Subset of dataset to run prediction on")
+    parser.add_argument('--port', required=False,
+                        default=8765, type=int,
+                        metavar="<port>",
+                        help="Port of the detection server (default=8765)")
+    parser.add_argument('--tta', required=False,
+                        action="store_true",
+                        help="Detect with flip and rotation test-time augmentation")
     args = parser.parse_args()
 
     # Validate arguments
     if args.command == "train":
         assert args.dataset, "Argument --dataset is required for training"
-    elif args.command == "detect":
+    elif args.command in ["detect", "evaluate"]:
         assert args.subset, "Provide --subset to run prediction on"
 
     print("Weights: ", args.weights)
@@ -399,6 +429,8 @@ if __name__ == '__main__':
 
         # Copy the used config file to the log dir for reproducibility after training
         save_config(args.logs)
+    elif args.tta:
+        config = BraintissueTTAConfig()
     else:
         config = BraintissueInferenceConfig()
     config.display()
@@ -441,8 +473,12 @@ if __name__ == '__main__':
     if args.command == "train":
         train(model, args.dataset, args.subset)
     elif args.command == "detect":
-        detect(model, args.dataset, args.subset)
+        detect(model, args.dataset, args.subset, tta=args.tta)
+    elif args.command == "evaluate":
+        evaluate(model, args.dataset, args.subset)
+    elif args.command == "serve":
+        server.DetectionServer(model, port=args.port, verbose=1).serve_forever()
     else:
         print("'{}' is not recognized. "
-              "Use 'train' or 'detect'".format(args.command))
+              "Use 'train', 'detect', 'evaluate' or 'serve'".format(args.command))
 
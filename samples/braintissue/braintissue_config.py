@@ -113,3 +113,9 @@ class BraintissueInferenceConfig(BraintissueConfig):
     # Non-max suppression threshold to filter RPN proposals.
     # You can increase this during training to generate more proposals.
     RPN_NMS_THRESHOLD = 0.7
+
+
+class BraintissueTTAConfig(BraintissueInferenceConfig):
+    # Run the 8 flipped and rotated views of an image in one batch for
+    # test-time augmentation. See MaskRCNN.detect_tta().
+    IMAGES_PER_GPU = 8
@@ -25,6 +25,9 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
     # Run COCO evaluatoin on the last model you trained
     python3 coco.py evaluate --dataset=/path/to/coco/ --model=last
+
+    # Run streaming COCO-style evaluation with flat memory
+    python3 coco.py evaluate_streaming --dataset=/path/to/coco/ --model=last
 """
 
 import os
@@ -53,7 +56,7 @@ ROOT_DIR = os.path.abspath("../../")
 # Import Mask RCNN
 sys.path.append(ROOT_DIR)  # To find local version of the library
 from mrcnn.config import Config
-from mrcnn import model as modellib, utils
+from mrcnn import model as modellib, utils, rle, evaluate
 
 # Path to trained weights file
 COCO_MODEL_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
@@ -314,11 +317,18 @@ class CocoDataset(utils.Dataset):
 
 def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     """Arrange resutls to match COCO specs in http://cocodataset.org/#format
+
+    masks: [H, W, N] uint8 masks, or a utils.InstanceMasks container, which
+        is converted from its RLE runs without building full size masks.
     """
     # If no results, return an empty list
     if rois is None:
         return []
 
+    if isinstance(masks, utils.InstanceMasks):
+        height, width = masks.image_shape
+        runs = masks.rle()
+
     results = []
     for image_id in image_ids:
         # Loop through detections
@@ -326,14 +336,18 @@ def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
             class_id = class_ids[i]
             score = scores[i]
             bbox = np.around(rois[i], 1)
-            mask = masks[:, :, i]
+            if isinstance(masks, utils.InstanceMasks):
+                segmentation = maskUtils.frPyObjects(
+                    rle.to_coco(runs[i], (height, width)), height, width)
+            else:
+                segmentation = maskUtils.encode(np.asfortranarray(masks[:, :, i]))
 
             result = {
                 "image_id": image_id,
                 "category_id": dataset.get_source_class_id(class_id, "coco"),
                 "bbox": [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
                 "score": score,
-                "segmentation": maskUtils.encode(np.asfortranarray(mask))
+                "segmentation": segmentation
             }
             results.append(result)
     return results
@@ -356,24 +370,32 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
     coco_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
 
     t_prediction = 0
+    t_loading = 0
     t_start = time.time()
 
+    def load_images():
+        nonlocal t_loading
+        for image_id in image_ids:
+            t = time.time()
+            image = dataset.load_image(image_id)
+            t_loading += (time.time() - t)
+            yield image
+
+    # Run detection in full batches. Images are loaded as they're needed,
+    # and the loading time is kept out of the prediction time.
+    detections = model.detect_many(load_images(), verbose=0, mask_format="rle")
+
     results = []
     for i, image_id in enumerate(image_ids):
-        # Load image
-        image = dataset.load_image(image_id)
-
-        # Run detection
         t = time.time()
-        r = model.detect([image], verbose=0)[0]
-        t_prediction += (time.time() - t)
+        loading = t_loading
+        r = next(detections)
+        t_prediction += (time.time() - t) - (t_loading - loading)
 
         # Convert results to COCO format
-        # Cast masks to uint8 because COCO tools errors out on bool
         image_results = build_coco_results(dataset, coco_image_ids[i:i + 1],
                                            r["rois"], r["class_ids"],
-                                           r["scores"],
-                                           r["masks"].astype(np.uint8))
+                                           r["scores"], r["masks"])
         results.extend(image_results)
 
     # Load results. This modifies results with additional attributes.
@@ -391,6 +413,29 @@ def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0, image_ids=Non
     print("Total time: ", time.time() - t_start)
 
 
+def evaluate_coco_streaming(model, dataset, eval_type="segm", limit=0, image_ids=None):
+    """Runs COCO-style evaluation without collecting the results first.
+    Detections are matched to the ground truth batch by batch and only
+    their match statistics are kept, so memory stays flat. Reports the
+    AP and AR metrics of COCOeval for the given eval_type, with the ground
+    truth of load_mask(). Note that the default eval_type is "segm", while
+    the evaluate command runs evaluate_coco() with "bbox".
+    dataset: A Dataset object with valiadtion data
+    eval_type: "bbox" or "segm" for bounding box or segmentation evaluation
+    limit: if not 0, it's the number of images to use for evaluation
+    """
+    # Pick COCO images from the dataset
+    image_ids = image_ids or dataset.image_ids
+
+    # Limit to a subset
+    if limit:
+        image_ids = image_ids[:limit]
+
+    evaluator = evaluate.Evaluator(iou_type=eval_type)
+    evaluate.evaluate_model(model, dataset, evaluator, image_ids=image_ids)
+    return evaluator.summarize(class_names=dataset.class_names)
+
+
 ############################################################
 #  Training
 ############################################################
@@ -404,7 +449,7 @@ if __name__ == '__main__':
         description='Train Mask R-CNN on MS COCO.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'evaluate' on MS COCO")
+                        help="'train', 'evaluate' or 'evaluate_streaming' on MS COCO")
     parser.add_argument('--dataset', required=True,
                         metavar="/path/to/coco/",
                         help='Directory of the MS-COCO dataset')
@@ -529,6 +574,14 @@ if __name__ == '__main__':
         dataset_val.prepare()
         print("Running COCO evaluation on {} images.".format(args.limit))
         evaluate_coco(model, dataset_val, coco, "bbox", limit=int(args.limit))
+    elif args.command == "evaluate_streaming":
+        # Validation dataset
+        dataset_val = CocoDataset()
+        val_type = "val" if args.year in '2017' else "minival"
+        dataset_val.load_coco(args.dataset, val_type, year=args.year, auto_download=args.download)
+        dataset_val.prepare()
+        print("Running streaming evaluation on {} images.".format(args.limit))
+        evaluate_coco_streaming(model, dataset_val, "segm", limit=int(args.limit))
     else:
         print("'{}' is not recognized. "
-              "Use 'train' or 'evaluate'".format(args.command))
+              "Use 'train', 'evaluate' or 'evaluate_streaming'".format(args.command))
@@ -52,6 +52,7 @@ from mrcnn.config import Config
 from mrcnn import utils
 from mrcnn import model as modellib
 from mrcnn import visualize
+from mrcnn import rle
 
 # Path to trained weights file
 COCO_WEIGHTS_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
@@ -247,6 +248,13 @@ class NucleusDataset(utils.Dataset):
         else:
             super(self.__class__, self).image_reference(image_id)
 
+    def gt_version(self, image_id):
+        """Adds the mask files of the image, which the GT cache can't see."""
+        info = self.image_info[image_id]
+        mask_dir = os.path.join(os.path.dirname(os.path.dirname(info['path'])), "masks")
+        return super(NucleusDataset, self).gt_version(image_id) + \
+            [utils.file_version(mask_dir)]
+
 
 ############################################################
 #  Training
@@ -303,33 +311,13 @@ def rle_encode(mask):
     """Encodes a mask in Run Length Encoding (RLE).
     Returns a string of space-separated values.
     """
-    assert mask.ndim == 2, "Mask must be of shape [Height, Width]"
-    # Flatten it column wise
-    m = mask.T.flatten()
-    # Compute gradient. Equals 1 or -1 at transition points
-    g = np.diff(np.concatenate([[0], m, [0]]), n=1)
-    # 1-based indicies of transition points (where gradient != 0)
-    rle = np.where(g != 0)[0].reshape([-1, 2]) + 1
-    # Convert second index in each pair to lenth
-    rle[:, 1] = rle[:, 1] - rle[:, 0]
-    return " ".join(map(str, rle.flatten()))
-
-
-def rle_decode(rle, shape):
+    return rle.to_string(rle.encode(mask))
+
+
+def rle_decode(rle_string, shape):
     """Decodes an RLE encoded list of space separated
     numbers and returns a binary mask."""
-    rle = list(map(int, rle.split()))
-    rle = np.array(rle, dtype=np.int32).reshape([-1, 2])
-    rle[:, 1] += rle[:, 0]
-    rle -= 1
-    mask = np.zeros([shape[0] * shape[1]], np.bool)
-    for s, e in rle:
-        assert 0 <= s < mask.shape[0]
-        assert 1 <= e <= mask.shape[0], "shape: {}  s {}  e {}".format(shape, s, e)
-        mask[s:e] = 1
-    # Reshape and transpose
-    mask = mask.reshape([shape[1], shape[0]]).T
-    return mask
+    return rle.decode(rle.from_string(rle_string), shape)
 
 
 def mask_to_rle(image_id, mask, scores):
@@ -343,15 +331,10 @@ def mask_to_rle(image_id, mask, scores):
     # then take the maximum across the last dimension
     order = np.argsort(scores)[::-1] + 1  # 1-based descending
     mask = np.max(mask * np.reshape(order, [1, 1, -1]), -1)
-    # Loop over instance masks
-    lines = []
-    for o in order:
-        m = np.where(mask == o, 1, 0)
-        # Skip if empty
-        if m.sum() == 0.0:
-            continue
-        rle = rle_encode(m)
-        lines.append("{}, {}".format(image_id, rle))
+    # Encode all instance masks in one pass, skipping empty ones
+    runs = dict(zip(*rle.encode_labels(mask)))
+    lines = ["{}, {}".format(image_id, rle.to_string(runs[o]))
+             for o in order if o in runs]
     return "\n".join(lines)
 
 
@@ -374,30 +357,31 @@ def detect(model, dataset_dir, subset):
     dataset = NucleusDataset()
     dataset.load_nucleus(dataset_dir, subset)
     dataset.prepare()
-    # Load over images
-    submission = []
-    for image_id in dataset.image_ids:
-        # Load image and run detection
-        image = dataset.load_image(image_id)
-        # Detect objects
-        r = model.detect([image], verbose=0)[0]
-        # Encode image to RLE. Returns a string of multiple lines
-        source_id = dataset.image_info[image_id]["id"]
-        rle = mask_to_rle(source_id, r["masks"], r["scores"])
-        submission.append(rle)
-        # Save image with masks
-        visualize.display_instances(
-            image, r['rois'], r['masks'], r['class_ids'],
-            dataset.class_names, r['scores'],
-            show_bbox=False, show_mask=False,
-            title="Predictions")
-        plt.savefig("{}/{}.png".format(submit_dir, dataset.image_info[image_id]["id"]))
-
-    # Save to csv file
-    submission = "ImageId,EncodedPixels\n" + "\n".join(submission)
+    # Load over images. Each image is keyed with its ID and the image
+    # itself, which is needed again to draw the results.
+    def load_images():
+        for image_id in dataset.image_ids:
+            image = dataset.load_image(image_id)
+            yield (image_id, image), image
+
+    def encode_images():
+        for (image_id, image), r in model.detect_many(
+                load_images(), verbose=0, keyed=True):
+            # Encode image to RLE. Returns a string of multiple lines
+            source_id = dataset.image_info[image_id]["id"]
+            encoded = mask_to_rle(source_id, r["masks"], r["scores"])
+            # Save image with masks
+            visualize.display_instances(
+                image, r['rois'], r['masks'], r['class_ids'],
+                dataset.class_names, r['scores'],
+                show_bbox=False, show_mask=False,
+                title="Predictions")
+            plt.savefig("{}/{}.png".format(submit_dir, dataset.image_info[image_id]["id"]))
+            yield encoded
+
+    # Save to csv file as the images are processed
     file_path = os.path.join(submit_dir, "submit.csv")
-    with open(file_path, "w") as f:
-        f.write(submission)
+    rle.write_csv(file_path, encode_images())
     print("Saved to ", submit_dir)
 
 
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT_DIR)  # To find local version of the library
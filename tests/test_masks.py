@@ -0,0 +1,64 @@
+"""
+Checks the batched mask functions against the per-instance ones.
+"""
+
+import numpy as np
+
+from mrcnn import utils
+
+
+def random_masks(rng, height=96, width=128, count=8):
+    """Random blobs of different sizes, plus an instance without pixels."""
+    mask = np.zeros([height, width, count], dtype=bool)
+    for i in range(count - 1):
+        y1, x1 = rng.randint(0, height - 4), rng.randint(0, width - 4)
+        y2, x2 = rng.randint(y1 + 2, height + 1), rng.randint(x1 + 2, width + 1)
+        mask[y1:y2, x1:x2, i] = rng.rand(y2 - y1, x2 - x1) < 0.7
+    return mask
+
+
+def test_extract_bboxes_batched():
+    rng = np.random.RandomState(0)
+    mask = random_masks(rng)
+    np.testing.assert_array_equal(utils.extract_bboxes_batched(mask),
+                                  utils.extract_bboxes(mask))
+    # Images without instances
+    empty = np.zeros([0, 0, 0], dtype=bool)
+    np.testing.assert_array_equal(utils.extract_bboxes_batched(empty),
+                                  utils.extract_bboxes(empty))
+
+
+def test_minimize_mask_batched():
+    rng = np.random.RandomState(1)
+    mask = random_masks(rng)[:, :, :-1]
+    bbox = utils.extract_bboxes(mask)
+    for mini_shape in [(56, 56), (28, 40)]:
+        expected = utils.minimize_mask(bbox, mask, mini_shape)
+        mini_mask = utils.minimize_mask_batched(bbox, mask, mini_shape)
+        assert mini_mask.shape == expected.shape
+        assert mini_mask.dtype == bool
+        # Pixels that interpolate to exactly 0.5 may round either way.
+        # See minimize_mask_batched().
+        for i in range(mask.shape[-1]):
+            y1, x1, y2, x2 = bbox[i]
+            m = utils.resize(mask[y1:y2, x1:x2, i].astype(np.float64), mini_shape)
+            tie = np.abs(m - 0.5) < 1e-6
+            np.testing.assert_array_equal(mini_mask[:, :, i][~tie],
+                                          expected[:, :, i][~tie])
+
+
+def test_expand_mask_batched():
+    rng = np.random.RandomState(2)
+    mask = random_masks(rng)[:, :, :-1]
+    bbox = utils.extract_bboxes(mask)
+    mini_mask = utils.minimize_mask(bbox, mask, (56, 56))
+    expected = utils.expand_mask(bbox, mini_mask, mask.shape)
+    full_mask = utils.expand_mask_batched(bbox, mini_mask, mask.shape)
+    assert full_mask.shape == expected.shape
+    for i in range(mask.shape[-1]):
+        y1, x1, y2, x2 = bbox[i]
+        m = utils.resize(mini_mask[:, :, i].astype(np.float64), (y2 - y1, x2 - x1))
+        tie = np.zeros(mask.shape[:2], dtype=bool)
+        tie[y1:y2, x1:x2] = np.abs(m - 0.5) < 1e-6
+        np.testing.assert_array_equal(full_mask[:, :, i][~tie],
+                                      expected[:, :, i][~tie])
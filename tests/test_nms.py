@@ -0,0 +1,70 @@
+"""
+Checks non_max_suppression() against the original greedy implementation.
+"""
+
+import numpy as np
+import pytest
+
+from mrcnn import utils
+
+
+def greedy_non_max_suppression(boxes, scores, threshold, class_ids=None):
+    """The original non_max_suppression(): picks the top box, removes the
+    boxes that overlap it, and repeats.
+    """
+    y1 = boxes[:, 0]
+    x1 = boxes[:, 1]
+    y2 = boxes[:, 2]
+    x2 = boxes[:, 3]
+    area = (y2 - y1) * (x2 - x1)
+    ixs = scores.argsort()[::-1]
+    pick = []
+    while len(ixs) > 0:
+        i = ixs[0]
+        pick.append(i)
+        iou = utils.compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
+        remove_ixs = iou > threshold
+        if class_ids is not None:
+            remove_ixs &= class_ids[ixs[1:]] == class_ids[i]
+        ixs = np.delete(ixs, np.where(remove_ixs)[0] + 1)
+        ixs = np.delete(ixs, 0)
+    return np.array(pick, dtype=np.int32)
+
+
+def random_boxes(rng, count, image_size=512, max_size=96):
+    """Random boxes in pixels. Integer coordinates and scores on a coarse
+    grid, so that some boxes and scores are identical.
+    """
+    y1 = rng.randint(0, image_size - max_size, count)
+    x1 = rng.randint(0, image_size - max_size, count)
+    h = rng.randint(8, max_size, count)
+    w = rng.randint(8, max_size, count)
+    boxes = np.stack([y1, x1, y1 + h, x1 + w], axis=1).astype(np.float32)
+    boxes[1::7] = boxes[::7][:boxes[1::7].shape[0]]
+    scores = rng.randint(0, 50, count).astype(np.float32) / 50
+    return boxes, scores
+
+
+@pytest.mark.parametrize("method", ["block", "sweep", "auto"])
+@pytest.mark.parametrize("threshold", [0.3, 0.7])
+def test_non_max_suppression(method, threshold):
+    rng = np.random.RandomState(0)
+    for count in [1, 2, 50, 700]:
+        boxes, scores = random_boxes(rng, count)
+        expected = greedy_non_max_suppression(boxes, scores, threshold)
+        # Small blocks to cover boxes suppressed by earlier blocks
+        pick = utils.non_max_suppression(boxes, scores, threshold,
+                                         method=method, block_size=64)
+        assert pick.dtype == np.int32
+        np.testing.assert_array_equal(pick, expected)
+
+
+@pytest.mark.parametrize("method", ["block", "sweep", "auto"])
+def test_non_max_suppression_class_ids(method):
+    rng = np.random.RandomState(1)
+    boxes, scores = random_boxes(rng, 500)
+    class_ids = rng.randint(1, 4, boxes.shape[0])
+    expected = greedy_non_max_suppression(boxes, scores, 0.5, class_ids)
+    pick = utils.non_max_suppression(boxes, scores, 0.5, class_ids=class_ids,
+                                     method=method, block_size=64)
+    np.testing.assert_array_equal(pick, expected)
@@ -0,0 +1,59 @@
+"""
+Checks PyramidROIAlign against cropping each box on its own pyramid level.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from mrcnn import model as modellib
+
+
+def roi_levels(boxes, image_shape):
+    """Pyramid level of each box, P2 to P5. Same as PyramidROIAlign."""
+    h = boxes[..., 2] - boxes[..., 0]
+    w = boxes[..., 3] - boxes[..., 1]
+    image_area = float(image_shape[0] * image_shape[1])
+    with np.errstate(divide="ignore"):
+        level = np.log2(np.sqrt(h * w) / (224.0 / np.sqrt(image_area)))
+    return np.clip(4 + np.round(level), 2, 5).astype(np.int32)
+
+
+def test_pyramid_roi_align():
+    rng = np.random.RandomState(0)
+    batch_size, num_boxes, channels = 2, 40, 4
+    image_shape = np.array([512, 512, 3])
+    pool_shape = (7, 7)
+    # Box sides from 16 to 512 pixels, to cover all levels
+    size = 2 ** rng.uniform(4, 9, [batch_size, num_boxes, 2]) / image_shape[:2]
+    y1x1 = rng.uniform(0, 1, [batch_size, num_boxes, 2]) * (1 - size)
+    boxes = np.concatenate([y1x1, y1x1 + size], axis=2).astype(np.float32)
+    # Padding
+    boxes[:, -5:] = 0
+    image_meta = np.stack([
+        modellib.compose_image_meta(i, image_shape, image_shape,
+                                    (0, 0, 512, 512), 1.0, np.ones([3]))
+        for i in range(batch_size)]).astype(np.float32)
+    feature_maps = [
+        rng.rand(batch_size, 512 // stride, 512 // stride, channels).astype(np.float32)
+        for stride in [4, 8, 16, 32]]
+    levels = roi_levels(boxes, image_shape)
+    assert set(np.unique(levels)) == {2, 3, 4, 5}
+
+    with tf.Graph().as_default():
+        pooled = modellib.PyramidROIAlign(pool_shape).call(
+            [tf.constant(boxes), tf.constant(image_meta)] +
+            [tf.constant(f) for f in feature_maps])
+        # Reference: crop each box from the feature map of its level
+        expected = []
+        for b in range(batch_size):
+            for n in range(num_boxes):
+                expected.append(tf.image.crop_and_resize(
+                    feature_maps[levels[b, n] - 2], boxes[b, n][np.newaxis],
+                    [b], pool_shape, method="bilinear"))
+        expected = tf.concat(expected, axis=0)
+        with tf.Session() as sess:
+            pooled, expected = sess.run([pooled, expected])
+
+    assert pooled.shape == (batch_size, num_boxes) + pool_shape + (channels,)
+    np.testing.assert_allclose(
+        pooled, expected.reshape(pooled.shape), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,54 @@
+"""
+Checks that build_rpn_targets() gives the same targets with and without
+an AnchorIndex.
+"""
+
+import numpy as np
+import pytest
+
+from mrcnn import utils
+from mrcnn import model as modellib
+from mrcnn.config import Config
+
+
+class RPNConfig(Config):
+    NAME = "rpn_targets"
+    IMAGE_MIN_DIM = 256
+    IMAGE_MAX_DIM = 256
+    RPN_ANCHOR_SCALES = (16, 32, 64, 128, 256)
+
+
+def random_gt_boxes(rng, count, image_size):
+    y1 = rng.randint(0, image_size - 8, count)
+    x1 = rng.randint(0, image_size - 8, count)
+    y2 = np.minimum(y1 + rng.randint(4, 160, count), image_size)
+    x2 = np.minimum(x1 + rng.randint(4, 160, count), image_size)
+    return np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+
+
+@pytest.mark.parametrize("num_crowds", [0, 2])
+def test_build_rpn_targets_anchor_index(num_crowds):
+    config = RPNConfig()
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                             config.RPN_ANCHOR_RATIOS,
+                                             backbone_shapes,
+                                             config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    anchor_index = utils.AnchorIndex(anchors)
+    rng = np.random.RandomState(0)
+    for count in [1, 5, 40]:
+        gt_boxes = random_gt_boxes(rng, count + num_crowds, config.IMAGE_SHAPE[0])
+        gt_class_ids = rng.randint(1, config.NUM_CLASSES + 1, count + num_crowds)
+        # Crowd boxes have negative class IDs
+        gt_class_ids[:num_crowds] *= -1
+        # build_rpn_targets() subsamples anchors at random. Use the same seed.
+        np.random.seed(count)
+        expected = modellib.build_rpn_targets(
+            config.IMAGE_SHAPE, anchors, gt_class_ids, gt_boxes, config)
+        np.random.seed(count)
+        result = modellib.build_rpn_targets(
+            config.IMAGE_SHAPE, anchors, gt_class_ids, gt_boxes, config,
+            anchor_index=anchor_index)
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_allclose(result[1], expected[1], rtol=1e-6, atol=1e-6)